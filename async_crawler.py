@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+
+from book_io import input_total, progress_message
+from bulk_writer import BATCH_SIZE
+from database import DONE, FAILED as JOB_FAILED, NOT_FOUND as JOB_NOT_FOUND
+from job_state import JobState
+from metrics import SEARCH_HTTP, count, timer
+from page_cache import SEARCH, cached_fetch_async
+from rate_limiter import MAX_RETRIES, RETRY_STATUSES, backoff_delay, get_rate_limiter, parse_retry_after
+from scraping_common import HTTP_HEADERS, build_search_url, fetch_book_page_html, parse_book_page, \
+    prepare_search_terms, step_find_book_in_search_results
+from scraping_sql import book_not_found_in_search_results_title, close_crawl_session, create_crawl_session, \
+    save_book_details_to_database
+
+SEARCH_TIMEOUT = 30
+
+# outcomes of scraping a single input row
+FOUND = "found"
+NOT_FOUND = "not_found"
+FAILED = "failed"
+
+
+class AsyncCrawler:
+    """Scrape many books at once while keeping database writes sequential and in input order.
+
+    Searching, matching and rendering run concurrently for up to `concurrency` books, paced by the shared
+    rate limiter. Finished books are written by a single writer thread that owns the SQLAlchemy session, in
+    the same order as the input. Recommended books go onto the crawl `frontier`: scraped inline, they would
+    be scraped one after the other on the writer thread.
+    """
+
+    def __init__(self, http_session, concurrency, batch_size=BATCH_SIZE, frontier=None, job_state=None):
+        if frontier is None:
+            raise ValueError("The async engine queues recommended books on a crawl frontier, none was given")
+        self.http_session = http_session
+        self.job_state = job_state if job_state is not None else JobState()
+        self.batch_size = batch_size
+        self.frontier = frontier
+        self.concurrency = concurrency
+        self.limiter = get_rate_limiter()
+        self.workers = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="crawl")
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+
+    async def search(self, title):
+        """Async counterpart of query_saxo_with_title_or_isbn"""
+        search_url = build_search_url(title)
+        return await cached_fetch_async(SEARCH, search_url, lambda: self.fetch_search_page(search_url))
+
+    async def fetch_search_page(self, search_url):
+        with timer(SEARCH_HTTP):
+            return await self.fetch_with_retries(search_url)
+
+    async def fetch_with_retries(self, url):
+        """Async counterpart of rate_limiter.get_with_retries, returning the page text or None"""
+        for attempt in range(MAX_RETRIES + 1):
+            await self.limiter.acquire_async()
+            try:
+                async with self.http_session.get(url) as response:
+                    self.limiter.record_status(response.status,
+                                               parse_retry_after(response.headers.get("Retry-After")))
+                    if response.status == 200:
+                        return await response.text()
+                    if response.status not in RETRY_STATUSES:
+                        logging.error(f"Failed to fetch search results from Saxo.com. Status code: {response.status}")
+                        return None
+                    reason = str(response.status)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.limiter.record_failure()
+                logging.warning(f"Request to {url} failed ({e}), retrying")
+                reason = "error"
+            if attempt < MAX_RETRIES:
+                count("retries", reason=reason)
+                await asyncio.sleep(backoff_delay(attempt))
+        logging.error(f"Giving up on {url} after {MAX_RETRIES + 1} attempts")
+        return None
+
+    async def scrape_book(self, row, title, author):
+        """Search, match and render one input row. Return the outcome and the data needed to save it."""
+        loop = asyncio.get_running_loop()
+        title, author = prepare_search_terms(title, author)
+        try:
+            search_page = await self.search(title)
+            search_page_book_info = await loop.run_in_executor(self.workers, step_find_book_in_search_results,
+                                                               search_page, author, title)
+            if search_page_book_info == 'N/A':
+                return NOT_FOUND, (title, author)
+            if not search_page_book_info:
+                return FAILED, "Failed to parse the search results"
+
+            book_details_dict = await loop.run_in_executor(self.workers, render_and_extract_book,
+                                                           search_page_book_info["Url"])
+            book_details_dict["Top10k"] = row
+            return FOUND, book_details_dict
+
+        except Exception as e:
+            logging.error(f"Failed to scrape book {row}: {title} by {author}: {e}")
+            logging.error(traceback.format_exc())
+            return FAILED, str(e)
+
+    async def write(self, session, row, outcome, payload):
+        loop = asyncio.get_running_loop()
+        if outcome == FOUND:
+            logging.debug(payload)
+            saved = await loop.run_in_executor(self.writer, save_book_details_to_database, payload, session)
+            status, error = (DONE, None) if saved else (JOB_FAILED, "Saving the book failed")
+        elif outcome == NOT_FOUND:
+            title, author = payload
+            await loop.run_in_executor(self.writer, book_not_found_in_search_results_title, title, author, session)
+            status, error = JOB_NOT_FOUND, None
+        else:
+            print(f"Failed to scrape book {row}")
+            status, error = JOB_FAILED, payload
+        await loop.run_in_executor(self.writer, self.job_state.record, session, row, status, error)
+
+    async def run(self, book_info):
+        loop = asyncio.get_running_loop()
+        session = await loop.run_in_executor(self.writer, create_crawl_session, self.batch_size, self.frontier)
+        in_flight = deque()
+        total = input_total(book_info)
+
+        try:
+            for row, title, author in book_info:
+                print(progress_message(row, total))
+                if not self.job_state.should_scrape(row):
+                    print(f"Book {row} is {self.job_state.status(row)} in a previous session")
+                    continue
+                await loop.run_in_executor(self.writer, self.job_state.start, row, title)
+
+                in_flight.append((row, asyncio.ensure_future(self.scrape_book(row, title, author))))
+                if len(in_flight) >= self.concurrency:
+                    await self.write_oldest(session, in_flight)
+
+            while in_flight:
+                await self.write_oldest(session, in_flight)
+        finally:
+            # on an error or interrupt the books written so far are still flushed; rows left in progress
+            # are scraped again by the next run
+            for _, task in in_flight:
+                task.cancel()
+            await loop.run_in_executor(self.writer, close_crawl_session, session)
+
+    async def write_oldest(self, session, in_flight):
+        row, task = in_flight.popleft()
+        outcome, payload = await task
+        await self.write(session, row, outcome, payload)
+
+    def close(self):
+        self.workers.shutdown(wait=True)
+        self.writer.shutdown(wait=True)
+
+
+def render_and_extract_book(book_detail_page_url):
+    return parse_book_page(fetch_book_page_html(book_detail_page_url))
+
+
+async def run_async(book_info, concurrency=4, job_state=None, batch_size=BATCH_SIZE, frontier=None):
+    """Scrape the input rows with up to `concurrency` books in flight"""
+    timeout = aiohttp.ClientTimeout(total=SEARCH_TIMEOUT)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector, headers=HTTP_HEADERS) as http_session:
+        crawler = AsyncCrawler(http_session, concurrency, batch_size, frontier, job_state)
+        try:
+            await crawler.run(book_info)
+        finally:
+            crawler.close()
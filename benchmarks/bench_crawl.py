@@ -0,0 +1,144 @@
+"""Benchmark the whole crawl offline against recorded pages served by a local fake Saxo.com.
+
+    python benchmarks/bench_crawl.py --fixtures data_cache --input data_csv/top3.csv --concurrency 1 4 8
+    python benchmarks/bench_crawl.py --fixtures data_cache --engines async pipeline --json bench.json \\
+        --baseline bench_previous.json
+
+Record the fixtures by crawling a sample of the input list once with the page cache on (the default),
+e.g. `python main.py --input sample.csv --cache-dir data_cache`. Every benchmark run starts main.py in its
+own process with a fresh SQLite database and the page cache off, so that all searches and book pages go
+to the fake server, and reads the run's metrics summary afterwards. Reported per run: books saved per
+minute, per-stage latency, peak RSS of the crawler process and database rows written per second.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_saxo import FakeSaxoServer  # noqa: E402
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN = os.path.join(REPO_DIR, "main.py")
+ENGINES = ("sequential", "async", "pipeline")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_crawl(args, server, engine, concurrency):
+    """Run main.py once against the server and return its measurements"""
+    with tempfile.TemporaryDirectory(prefix="bench_crawl_") as workdir:
+        os.makedirs(os.path.join(workdir, "data_csv"))
+        metrics_path = os.path.join(workdir, "metrics.json")
+        command = [sys.executable, MAIN, "--input", os.path.abspath(args.input),
+                   "--db", os.path.join(workdir, "bench.db"), "--no-cache", "--fetch-mode", args.fetch_mode,
+                   "--engine", engine, "--concurrency", str(concurrency), "--batch-size", str(args.batch_size),
+                   "--rps", str(args.rps), "--max-rps", str(args.rps), "--metrics-json", metrics_path]
+        env = dict(os.environ, SAXO_BASE_URL=server.base_url)
+
+        with open(os.path.join(workdir, "crawl.log"), "w") as log:
+            start = time.perf_counter()
+            process = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+            _, status, usage = os.wait4(process.pid, 0)
+            elapsed = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if process.returncode != 0:
+            with open(os.path.join(workdir, "crawl.log")) as log:
+                sys.exit(f"The {engine} crawl failed with exit code {process.returncode}:\n{log.read()[-2000:]}")
+        with open(metrics_path) as f:
+            metrics = json.load(f)
+
+    counters = metrics["counters"]
+    db_rows = counters.get("db_rows", {})
+    books = db_rows.get("table=book", 0)
+    written = sum(db_rows.values())
+    return {
+        "engine": engine,
+        "concurrency": concurrency,
+        "fetch_mode": args.fetch_mode,
+        "elapsed_seconds": round(elapsed, 3),
+        "input_rows": metrics.get("input_rows"),
+        "books": books,
+        "books_per_minute": round(60 * books / elapsed, 1),
+        "peak_rss_mb": round(usage.ru_maxrss / 1024, 1),
+        "db_rows": written,
+        "db_rows_per_second": round(written / elapsed, 1),
+        "db_write_seconds": metrics["stages"].get("db_write", {}).get("total_seconds", 0.0),
+        "stages": metrics["stages"],
+        "counters": counters,
+    }
+
+
+def compare(results, baseline):
+    """Print the change of every run against the same engine and concurrency in a baseline result file"""
+    previous = {(run["engine"], run["concurrency"]): run for run in baseline["runs"]}
+    print(f"compared with {baseline.get('commit') or 'the baseline'}")
+    for run in results["runs"]:
+        old = previous.get((run["engine"], run["concurrency"]))
+        if old is None:
+            continue
+        speed = 100 * (run["books_per_minute"] / old["books_per_minute"] - 1) if old["books_per_minute"] else 0.0
+        memory = run["peak_rss_mb"] - old["peak_rss_mb"]
+        print(f"{run['engine']:<12}{run['concurrency']:>5}  books/min {speed:+.1f}%  peak RSS {memory:+.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fixtures", default="data_cache", help="page cache directory with the recorded pages")
+    parser.add_argument("--input", default="data_csv/top3.csv", help="CSV with book_title and book_author")
+    parser.add_argument("--engines", nargs="+", choices=ENGINES, default=["async"])
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 4])
+    parser.add_argument("--fetch-mode", choices=("http", "browser"), default="http",
+                        help="'browser' needs Chrome and measures rendering as well")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--rps", type=float, default=1000.0,
+                        help="request rate of the crawler; high, so the rate limiter does not dominate")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="delay the fake server adds to every response")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="results of an earlier benchmark to compare with")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.fixtures):
+        sys.exit(f"No recorded pages at {args.fixtures}; crawl a sample with --cache-dir {args.fixtures} first")
+
+    server = FakeSaxoServer(args.fixtures, latency=args.latency_ms / 1000).start()
+    results = {"commit": git_commit(), "python": platform.python_version(), "fixtures": args.fixtures,
+               "input": args.input, "latency_ms": args.latency_ms, "runs": []}
+    try:
+        for engine in args.engines:
+            for concurrency in args.concurrency:
+                run = run_crawl(args, server, engine, concurrency)
+                results["runs"].append(run)
+                print(f"{engine:<12}{concurrency:>5}  {run['books']:>6} books  {run['books_per_minute']:>9.1f}/min  "
+                      f"peak RSS {run['peak_rss_mb']:>7.1f} MB  {run['db_rows_per_second']:>8.1f} rows/s")
+    finally:
+        server.stop()
+    results["server"] = dict(server.stats)
+
+    for run in results["runs"]:
+        print(f"\n{run['engine']} x{run['concurrency']}")
+        for stage, latency in run["stages"].items():
+            print(f"  {stage:<26}{latency['count']:>7} x  mean {latency['mean_ms']:>9.1f} ms  "
+                  f"p95 {latency['p95_ms']:>9.1f} ms")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
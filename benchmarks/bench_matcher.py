@@ -0,0 +1,123 @@
+"""Compare the search result matcher with the original first-match loop over cached search pages.
+
+    python benchmarks/bench_matcher.py --input data_csv/top_10k_books.csv --cache-dir data_cache
+
+The input rows are looked up in the page cache the way the crawler searches for them, so only rows that
+were searched before are matched. Reports the time per page and how many rows each matcher finds.
+"""
+import argparse
+import csv
+import json
+import os
+import statistics
+import sys
+import time
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from book_matcher import find_book_in_search_results, normalize_author_name  # noqa: E402
+from page_cache import SEARCH, PageCache  # noqa: E402
+from scraping_common import build_search_url, prepare_search_terms, translate_danish_to_english  # noqa: E402
+
+
+def legacy_is_book_correct(author_local, book_parsed):
+    author_local = translate_danish_to_english(author_local.lower().replace('"', "").split(',')[0])
+    author_local_normalized = normalize_author_name(author_local)
+    author_extracted = [translate_danish_to_english(auth.lower()) for auth in list(book_parsed["Authors"])]
+    return author_local_normalized in [normalize_author_name(auth) for auth in author_extracted]
+
+
+def legacy_find_book_in_search_results(html_content_search_page, author=None, title=None):
+    """The matcher before book_matcher: the first teaser by the author wins"""
+    try:
+        soup_search_page = BeautifulSoup(html_content_search_page, "html.parser")
+        for book in soup_search_page.find_all("div", class_="product-list-teaser"):
+            book_parsed = json.loads(translate_danish_to_english(book.find("a").get("data-val")))
+            if author is None or legacy_is_book_correct(author, book_parsed):
+                return book_parsed
+        return 'N/A'
+    except Exception:
+        return False
+
+
+MATCHERS = {
+    "legacy": legacy_find_book_in_search_results,
+    "ranked": find_book_in_search_results,
+}
+
+
+def load_searches(input_csv, cache_dir, limit=None):
+    """Return (search page, author, title) for every input row with a cached search page"""
+    cache = PageCache(cache_dir, replay_only=True)
+    searches = []
+    with open(input_csv, encoding="ISO-8859-1", newline="") as f:
+        for row in csv.DictReader(f):
+            if not row["book_author"]:
+                continue
+            title, author = prepare_search_terms(row["book_title"], row["book_author"])
+            search_page = cache.get(SEARCH, build_search_url(title))
+            if search_page:
+                searches.append((search_page, author, title))
+            if limit and len(searches) >= limit:
+                break
+    cache.close()
+    return searches
+
+
+def bench_matcher(matcher, searches, repeat):
+    timings = []
+    results = []
+    for _ in range(repeat):
+        results = []
+        for search_page, author, title in searches:
+            start = time.perf_counter()
+            results.append(matcher(search_page, author, title))
+            timings.append(time.perf_counter() - start)
+    return {
+        "pages": len(searches),
+        "mean_ms": 1000 * statistics.mean(timings),
+        "median_ms": 1000 * statistics.median(timings),
+        "p95_ms": 1000 * sorted(timings)[int(0.95 * (len(timings) - 1))],
+        "matched": sum(isinstance(result, dict) for result in results),
+        "not_found": sum(result == 'N/A' for result in results),
+        "failed": sum(result is False for result in results),
+        "urls": [result.get("Url") if isinstance(result, dict) else None for result in results],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", default="data_csv/top_10k_books.csv", help="CSV with book_title and book_author")
+    parser.add_argument("--cache-dir", default="data_cache", help="page cache directory with the search pages")
+    parser.add_argument("--limit", type=int, help="match at most this many search pages")
+    parser.add_argument("--repeat", type=int, default=3, help="passes over the search pages per matcher")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    searches = load_searches(args.input, args.cache_dir, args.limit)
+    if not searches:
+        sys.exit("No cached search pages found for the input rows")
+
+    results = {name: bench_matcher(matcher, searches, args.repeat) for name, matcher in MATCHERS.items()}
+    legacy_urls = results["legacy"].pop("urls")
+    ranked_urls = results["ranked"].pop("urls")
+    results["ranked"]["recovered"] = sum(old is None and new is not None for old, new in zip(legacy_urls, ranked_urls))
+    results["ranked"]["changed"] = sum(old is not None and new != old for old, new in zip(legacy_urls, ranked_urls))
+
+    print(f"{len(searches)} search pages, {args.repeat} passes")
+    print(f"{'matcher':<10}{'mean ms':>10}{'median ms':>11}{'p95 ms':>9}{'matched':>9}{'N/A':>7}{'failed':>8}")
+    for name, result in results.items():
+        print(f"{name:<10}{result['mean_ms']:>10.2f}{result['median_ms']:>11.2f}{result['p95_ms']:>9.2f}"
+              f"{result['matched']:>9}{result['not_found']:>7}{result['failed']:>8}")
+    print(f"ranked matcher found {results['ranked']['recovered']} books the legacy one missed and picked a "
+          f"different book for {results['ranked']['changed']}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
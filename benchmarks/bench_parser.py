@@ -0,0 +1,123 @@
+"""Compare the book page parser backends over saved pages.
+
+    python benchmarks/bench_parser.py --pages saved_pages/
+    python benchmarks/bench_parser.py --cache-dir data_cache --limit 500
+
+Every backend runs in its own process so that the peak RSS of one does not hide the other's. tracemalloc
+only sees memory allocated through Python, so the libxml2/lexbor trees show up in the RSS column only.
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from page_cache import PAGE, PageCache  # noqa: E402
+from scraping_common import PARSER_BACKENDS, parse_book_page  # noqa: E402
+
+
+def load_pages(pages_dir=None, cache_dir=None, limit=None):
+    pages = []
+    if pages_dir:
+        for path in sorted(glob.glob(os.path.join(pages_dir, "*.html"))):
+            with open(path, encoding="utf-8") as f:
+                pages.append(f.read())
+    if cache_dir:
+        cache = PageCache(cache_dir, replay_only=True)
+        for url in cache.urls(PAGE):
+            html = cache.get(PAGE, url)
+            if html:
+                pages.append(html)
+        cache.close()
+    return pages[:limit] if limit else pages
+
+
+def bench_backend(backend, pages, repeat, results):
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    timings = []
+    peaks = []
+    parsed = []
+    failures = 0
+
+    for _ in range(repeat):
+        parsed = []
+        for html in pages:
+            start = time.perf_counter()
+            try:
+                parsed.append(parse_book_page(html, backend=backend))
+            except Exception:
+                parsed.append(None)
+                failures += 1
+            timings.append(time.perf_counter() - start)
+
+    # a separate pass, tracing allocations slows the parsers down
+    for html in pages:
+        tracemalloc.start()
+        try:
+            parse_book_page(html, backend=backend)
+        except Exception:
+            pass
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    results[backend] = {
+        "pages": len(pages),
+        "failures": failures // repeat,
+        "mean_ms": 1000 * statistics.mean(timings),
+        "median_ms": 1000 * statistics.median(timings),
+        "p95_ms": 1000 * sorted(timings)[int(0.95 * (len(timings) - 1))],
+        "py_peak_kib_per_page": statistics.mean(peaks) / 1024,
+        # ru_maxrss is in KiB on Linux
+        "rss_growth_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline_rss,
+        "output": parsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", help="directory of saved book pages (*.html)")
+    parser.add_argument("--cache-dir", help="page cache directory to read the book pages from")
+    parser.add_argument("--limit", type=int, help="use at most this many pages")
+    parser.add_argument("--repeat", type=int, default=3, help="passes over the pages per backend")
+    parser.add_argument("--backends", nargs="+", default=list(PARSER_BACKENDS), choices=PARSER_BACKENDS)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    pages = load_pages(args.pages, args.cache_dir, args.limit)
+    if not pages:
+        sys.exit("No pages found, pass --pages or --cache-dir")
+
+    manager = multiprocessing.Manager()
+    results = manager.dict()
+    for backend in args.backends:
+        process = multiprocessing.Process(target=bench_backend, args=(backend, pages, args.repeat, results))
+        process.start()
+        process.join()
+    results = dict(results)
+
+    reference = results.get("bs4", {}).get("output")
+    print(f"{len(pages)} pages, {args.repeat} passes")
+    print(f"{'backend':<12}{'mean ms':>10}{'median ms':>11}{'p95 ms':>9}{'py KiB/page':>13}{'RSS +KiB':>10}"
+          f"{'failed':>8}{'differs':>9}")
+    for backend, result in results.items():
+        output = result.pop("output")
+        result["differs_from_bs4"] = (sum(a != b for a, b in zip(output, reference))
+                                      if reference is not None else None)
+        print(f"{backend:<12}{result['mean_ms']:>10.2f}{result['median_ms']:>11.2f}{result['p95_ms']:>9.2f}"
+              f"{result['py_peak_kib_per_page']:>13.0f}{result['rss_growth_kib']:>10}{result['failures']:>8}"
+              f"{result['differs_from_bs4'] if reference is not None else '-':>9}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""Serve recorded Saxo.com search and book pages from a page cache directory, under Saxo's URL scheme.
+
+    python benchmarks/fake_saxo.py --fixtures data_cache --port 8800
+    SAXO_BASE_URL=http://127.0.0.1:8800 python main.py --no-cache --fetch-mode http
+
+Any page cache filled by a normal crawl (`--cache-dir`) is a set of recorded fixtures. Searches are answered
+the way Saxo answers them: an ISBN with a single book redirects to the book page, while a title, or an ISBN
+with several results, stays on the search page - the 'query' URL that create_browser_and_wait_for_page_load
+treats as the multi-result case. Searches that were never recorded get an empty result page, unknown pages
+a 404. Links to Saxo.com in the pages are rewritten to point back at the server.
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from page_cache import PAGE, SEARCH, PageCache  # noqa: E402
+
+SAXO_ORIGIN = "https://www.saxo.com"
+SEARCH_PATH = "/dk/products/search"
+# where a single-result ISBN search redirects to; Saxo uses the book's own product URL
+PRODUCT_PATH = "/dk/products/isbn/"
+EMPTY_SEARCH_PAGE = "<html><body><div class=\"product-list\"></div></body></html>"
+
+
+class FakeSaxoServer(ThreadingHTTPServer):
+    """HTTP server replaying the pages of a page cache, optionally after a fixed latency per response"""
+
+    daemon_threads = True
+
+    def __init__(self, fixtures_dir, host="127.0.0.1", port=0, latency=0.0):
+        self.cache = PageCache(fixtures_dir, replay_only=True)
+        self.latency = latency
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+        super().__init__((host, port), FakeSaxoHandler)
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def lookup(self, kind, url):
+        return self.cache.get(kind, url)
+
+    def count(self, event):
+        with self._stats_lock:
+            self.stats[event] += 1
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="fake-saxo", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.cache.close()
+
+
+class FakeSaxoHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        path = unquote(self.path)
+        parts = urlsplit(path)
+        if parts.path == SEARCH_PATH:
+            self.search(parse_qs(parts.query, keep_blank_values=True).get("query", [""])[0], path)
+        elif parts.path.startswith(PRODUCT_PATH):
+            query = parts.path[len(PRODUCT_PATH):]
+            self.page(self.server.lookup(PAGE, f"{SAXO_ORIGIN}{SEARCH_PATH}?query={query}"))
+        else:
+            self.page(self.server.lookup(PAGE, SAXO_ORIGIN + path))
+
+    def search(self, query, path):
+        url = SAXO_ORIGIN + path
+        book_page = self.server.lookup(PAGE, url)
+        if book_page is not None:
+            self.server.count("redirect")
+            self.send_response(302)
+            self.send_header("Location", PRODUCT_PATH + quote(query.replace(" ", "+")))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        search_page = self.server.lookup(SEARCH, url)
+        self.server.count("search" if search_page is not None else "empty_search")
+        self.send_html(search_page if search_page is not None else EMPTY_SEARCH_PAGE)
+
+    def page(self, html):
+        if html is None:
+            self.server.count("not_found")
+            self.send_error(404)
+            return
+        self.server.count("page")
+        self.send_html(html)
+
+    def send_html(self, html):
+        base_url = self.server.base_url
+        data = (html.replace(SAXO_ORIGIN, base_url)
+                .replace(SAXO_ORIGIN.replace("/", "\\/"), base_url.replace("/", "\\/"))
+                .encode("utf-8"))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fixtures", default="data_cache", help="page cache directory with the recorded pages")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="delay added to every response")
+    args = parser.parse_args()
+
+    server = FakeSaxoServer(args.fixtures, args.host, args.port, args.latency_ms / 1000)
+    print(f"Serving {args.fixtures} at {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(dict(server.stats))
+
+
+if __name__ == "__main__":
+    main()
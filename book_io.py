@@ -0,0 +1,189 @@
+import csv
+import io
+import json
+import os
+import sys
+import threading
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # optional, only needed for Parquet output
+    pa = None
+
+INPUT_ENCODING = "ISO-8859-1"
+STDIN = "-"
+OUTPUT_BUFFER_SIZE = 1000
+
+FORMAT_CSV = "csv"
+FORMAT_JSONL = "jsonl"
+FORMAT_PARQUET = "parquet"
+OUTPUT_FORMATS = (FORMAT_CSV, FORMAT_JSONL, FORMAT_PARQUET)
+
+# columns of the output files, in the order of the book table
+OUTPUT_COLUMNS = ["ISBN", "Title", "Authors", "PageCount", "PublishedDate", "Publisher", "Format", "Language",
+                  "Rating", "NumOfRatings", "Description", "Top10k", "Recommendations"]
+
+if pa is not None:
+    PARQUET_SCHEMA = pa.schema([
+        ("ISBN", pa.string()), ("Title", pa.string()), ("Authors", pa.list_(pa.string())),
+        ("PageCount", pa.int64()), ("PublishedDate", pa.string()), ("Publisher", pa.string()),
+        ("Format", pa.string()), ("Language", pa.string()), ("Rating", pa.float64()),
+        ("NumOfRatings", pa.int64()), ("Description", pa.string()), ("Top10k", pa.int64()),
+        ("Recommendations", pa.list_(pa.string())),
+    ])
+
+
+class InputRows:
+    """Iterate over the rows of an input CSV, or of stdin with '-', without loading the list into memory.
+
+    Rows are (row, book_title, book_author) with the 1-based row number the crawl keys its progress on;
+    a missing author is None.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._total = None
+
+    def __iter__(self):
+        if self.path == STDIN:
+            yield from read_rows(io.TextIOWrapper(sys.stdin.buffer, encoding=INPUT_ENCODING, newline=""))
+            return
+        with open(self.path, encoding=INPUT_ENCODING, newline="") as f:
+            yield from read_rows(f)
+
+    @property
+    def total(self):
+        """Number of rows, counted in a streaming pass; None for stdin"""
+        if self._total is None and self.path != STDIN:
+            with open(self.path, encoding=INPUT_ENCODING, newline="") as f:
+                self._total = sum(1 for _ in csv.DictReader(f))
+        return self._total
+
+
+def read_rows(f):
+    for row, values in enumerate(csv.DictReader(f), start=1):
+        yield row, values["book_title"], values.get("book_author") or None
+
+
+def input_total(book_info):
+    """Number of input rows if it is known up front"""
+    if isinstance(book_info, InputRows):
+        return book_info.total
+    try:
+        return len(book_info)
+    except TypeError:
+        return None
+
+
+def progress_message(row, total):
+    return f"Scraping book {row} out of {total}" if total else f"Scraping book {row}"
+
+
+class OutputSink:
+    """Buffer scraped books and append them to a file every `buffer_size` books.
+
+    Rows are buffered as columns and written in chunks. A CSV file gets its header only when it is
+    created, so an existing file is appended to. Lists (authors, recommendations) are JSON encoded in CSV.
+    Parquet files can't be appended to: every run rewrites the file, one row group per chunk.
+    """
+
+    def __init__(self, path, output_format=None, buffer_size=OUTPUT_BUFFER_SIZE):
+        self.path = path
+        self.format = output_format or output_format_of(path)
+        if self.format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format {self.format}, expected one of {OUTPUT_FORMATS}")
+        if self.format == FORMAT_PARQUET and pa is None:
+            raise ImportError("Parquet output needs pyarrow")
+        self.buffer_size = buffer_size
+        self.written = 0
+        self._columns = {column: [] for column in OUTPUT_COLUMNS}
+        self._buffered = 0
+        self._lock = threading.Lock()
+        self._file = None
+        self._parquet_writer = None
+
+    def write(self, book_details):
+        with self._lock:
+            for column, values in self._columns.items():
+                values.append(book_details.get(column))
+            self._buffered += 1
+            if self._buffered >= self.buffer_size:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffered:
+            return
+        if self.format == FORMAT_CSV:
+            self._write_csv()
+        elif self.format == FORMAT_JSONL:
+            self._write_jsonl()
+        else:
+            self._write_parquet()
+        self.written += self._buffered
+        self._buffered = 0
+        for values in self._columns.values():
+            values.clear()
+
+    def _write_csv(self):
+        if self._file is None:
+            header = not os.path.isfile(self.path) or os.path.getsize(self.path) == 0
+            self._file = open(self.path, "a", encoding="utf-8", newline="")
+            self._csv = csv.writer(self._file)
+            if header:
+                self._csv.writerow(OUTPUT_COLUMNS)
+        columns = [[json.dumps(value, ensure_ascii=False) if isinstance(value, list) else value for value in values]
+                   for values in self._columns.values()]
+        self._csv.writerows(zip(*columns))
+        self._file.flush()
+
+    def _write_jsonl(self):
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        rows = (dict(zip(OUTPUT_COLUMNS, values)) for values in zip(*self._columns.values()))
+        self._file.write("".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows))
+        self._file.flush()
+
+    def _write_parquet(self):
+        if self._parquet_writer is None:
+            self._parquet_writer = pq.ParquetWriter(self.path, PARQUET_SCHEMA)
+        self._parquet_writer.write_table(pa.Table.from_pydict(self._columns, schema=PARQUET_SCHEMA))
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if self._parquet_writer is not None:
+                self._parquet_writer.close()
+                self._parquet_writer = None
+
+
+def output_format_of(path):
+    extension = os.path.splitext(path)[1].lstrip(".").lower()
+    return {"ndjson": FORMAT_JSONL, "pq": FORMAT_PARQUET}.get(extension, extension)
+
+
+_output_sink = None
+
+
+def configure_output_sink(path=None, output_format=None, buffer_size=OUTPUT_BUFFER_SIZE):
+    """Write every saved book to `path` as well as to the database; no path disables the output file"""
+    global _output_sink
+    close_output_sink()
+    _output_sink = OutputSink(path, output_format, buffer_size) if path else None
+    return _output_sink
+
+
+def get_output_sink():
+    return _output_sink
+
+
+def close_output_sink():
+    if _output_sink is not None:
+        _output_sink.close()
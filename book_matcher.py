@@ -0,0 +1,156 @@
+import json
+import logging
+import re
+from functools import lru_cache
+
+from bs4 import BeautifulSoup
+
+from page_parser import DANISH_TO_ENGLISH, has_class
+
+try:
+    from lxml import etree, html as lxml_html
+except ImportError:  # falls back to BeautifulSoup
+    lxml_html = None
+
+# a candidate needs at least this author similarity to be picked at all; exact matches score 1
+AUTHOR_MATCH_THRESHOLD = 0.8
+# among the candidates by the right author, the title decides
+AUTHOR_WEIGHT = 0.6
+TITLE_WEIGHT = 0.4
+
+NAME_CACHE_SIZE = 65536
+
+SUFFIX_PATTERN = re.compile(r'\b(?:' + '|'.join(['Ltd', 'Inc', 'Co', 'LLC', 'LLP', 'PLC']) + r')\.?\b',
+                            flags=re.IGNORECASE)
+PARENTHESIZED_PATTERN = re.compile(r'\(.*?\)')
+PUNCTUATION_PATTERN = re.compile(r'[^\w\s]')
+WHITESPACE_PATTERN = re.compile(r'\s+')
+
+if lxml_html is not None:
+    XPATH_TEASER_DATA = etree.XPath(f'//div[{has_class("product-list-teaser")}]/descendant::a[1]/@data-val')
+
+
+def normalize_author_name(name):
+    """Strip business suffixes, parenthesized content and punctuation, and lowercase the name"""
+    name = SUFFIX_PATTERN.sub('', name)
+    name = PARENTHESIZED_PATTERN.sub('', name)
+    name = PUNCTUATION_PATTERN.sub('', name)
+    name = WHITESPACE_PATTERN.sub(' ', name).strip()
+    return name.lower()
+
+
+@lru_cache(maxsize=NAME_CACHE_SIZE)
+def normalize_name(name):
+    """Normalized form of an author or title as it is compared, memoized across search pages"""
+    return normalize_author_name(name.lower().replace('"', '').translate(DANISH_TO_ENGLISH))
+
+
+def normalize_input_author(author):
+    """The first author of an input row, normalized"""
+    return normalize_name(author.split(',')[0])
+
+
+@lru_cache(maxsize=NAME_CACHE_SIZE)
+def tokens(normalized):
+    return frozenset(normalized.split())
+
+
+@lru_cache(maxsize=NAME_CACHE_SIZE)
+def trigrams(normalized):
+    padded = f"  {normalized} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def similarity(a, b):
+    """Fuzzy similarity of two normalized strings between 0 and 1.
+
+    The token-set score ignores word order and tolerates missing middle names ("j rowling" vs "j k rowling"),
+    the trigram Dice score tolerates transliteration and spelling differences.
+    """
+    if a == b:
+        return 1.0
+    if not a or not b:
+        return 0.0
+    tokens_a, tokens_b = tokens(a), tokens(b)
+    common = len(tokens_a & tokens_b)
+    token_score = (0.75 * common / min(len(tokens_a), len(tokens_b))
+                   + 0.25 * common / max(len(tokens_a), len(tokens_b)))
+    return max(token_score, trigram_similarity(a, b))
+
+
+def trigram_similarity(a, b):
+    trigrams_a, trigrams_b = trigrams(a), trigrams(b)
+    return 2 * len(trigrams_a & trigrams_b) / (len(trigrams_a) + len(trigrams_b))
+
+
+def author_similarity(a, b):
+    """similarity() of two normalized author names, which have to agree on more than the surname.
+
+    A lone surname shares all its tokens with the full name ("king" vs "stephen king" scores 0.875), so
+    when only one of the names is a single word, only the trigram score counts. When both have given
+    names, their first initials must match unless the names only differ in word order.
+    """
+    if a == b:
+        return 1.0
+    if not a or not b:
+        return 0.0
+    single_a, single_b = len(tokens(a)) == 1, len(tokens(b)) == 1
+    if single_a != single_b:
+        return trigram_similarity(a, b)
+    if not single_a and a[0] != b[0] and tokens(a) != tokens(b):
+        return 0.0
+    return similarity(a, b)
+
+
+def author_score(author, candidate):
+    return max((author_similarity(author, normalize_name(name)) for name in candidate.get("Authors") or ()), default=0.0)
+
+
+def extract_search_candidates(html_content_search_page):
+    """Return the data-val dicts of all teasers on a search page, decoded with a single json.loads"""
+    if not html_content_search_page.strip():
+        return []
+    if lxml_html is not None:
+        values = XPATH_TEASER_DATA(lxml_html.fromstring(html_content_search_page))
+    else:
+        soup_search_page = BeautifulSoup(html_content_search_page, "html.parser")
+        values = [book.find("a").get("data-val")
+                  for book in soup_search_page.find_all("div", class_="product-list-teaser")]
+    if not values:
+        return []
+    return json.loads(("[" + ",".join(values) + "]").translate(DANISH_TO_ENGLISH))
+
+
+def rank_candidates(candidates, author=None, title=None):
+    """Score every candidate in one pass and return (score, candidate) pairs, best first.
+
+    Candidates whose authors are not similar enough to `author` are left out. The sort is stable, so equal
+    scores keep Saxo's order.
+    """
+    if author is None:
+        return [(1.0, candidate) for candidate in candidates]
+
+    author = normalize_input_author(author)
+    title = normalize_name(title) if title else ""
+    ranked = []
+    for candidate in candidates:
+        score = author_score(author, candidate)
+        if score < AUTHOR_MATCH_THRESHOLD:
+            continue
+        title_score = similarity(title, normalize_name(candidate.get("Title") or "")) if title else 0.0
+        ranked.append((AUTHOR_WEIGHT * score + TITLE_WEIGHT * title_score, candidate))
+    ranked.sort(key=lambda pair: pair[0], reverse=True)
+    return ranked
+
+
+def find_book_in_search_results(html_content_search_page, author=None, title=None):
+    """Return the best matching book of a search page, 'N/A' when none matches, or False if it can't be parsed.
+
+    Without an author (ISBN searches) the first result is the book.
+    """
+    try:
+        ranked = rank_candidates(extract_search_candidates(html_content_search_page), author, title)
+    except Exception:
+        logging.error(f"Failed to parse the search results. Title: {title}, Author: {author}")
+        return False
+    return ranked[0][1] if ranked else 'N/A'
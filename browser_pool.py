@@ -0,0 +1,225 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import traceback
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+from selenium.webdriver import Chrome
+from selenium.webdriver.chrome.options import Options
+from selenium.common.exceptions import WebDriverException
+
+from metrics import BROWSER_LAUNCH, count, timer
+
+POOL_SIZE = int(os.environ.get("SAXO_BROWSER_POOL_SIZE", 2))
+MAX_PAGES_PER_BROWSER = int(os.environ.get("SAXO_BROWSER_MAX_PAGES", 50))
+CHECKOUT_TIMEOUT = 300
+
+# "full" is plain headless Chrome; "lean" renders only what the recommendation carousel needs and is opt-in
+# until it is verified against live Saxo pages
+BROWSER_PROFILES = ("lean", "full")
+browser_profile = os.environ.get("SAXO_BROWSER_PROFILE", "full")
+# hosts a lean browser may connect to besides the one searches go to (SAXO_BASE_URL); everything else,
+# trackers and ads included, fails to resolve
+ALLOWED_HOSTS = os.environ.get("SAXO_BROWSER_ALLOWED_HOSTS", "saxo.com,*.saxo.com").split(",")
+# requests a lean browser drops before they are sent: images, fonts and media
+BLOCKED_URL_PATTERNS = ["*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.avif", "*.svg", "*.ico", "*.woff",
+                        "*.woff2", "*.ttf", "*.otf", "*.mp4", "*.webm", "*.mp3", "*.m3u8"]
+# V8 heap cap of a lean browser's renderer, in MB
+RENDERER_HEAP_MB = int(os.environ.get("SAXO_BROWSER_HEAP_MB", 256))
+
+
+def create_chrome_options(profile=None):
+    chrome_options = Options()
+    chrome_options.add_argument("--headless")
+    if (profile or browser_profile) != "lean":
+        return chrome_options
+
+    # return from get() at DOMContentLoaded, the page-ready wait looks for the carousel itself
+    chrome_options.set_capability("pageLoadStrategy", "eager")
+    for argument in ("--disable-gpu", "--disable-extensions", "--disable-dev-shm-usage", "--mute-audio",
+                     "--no-first-run", "--disable-default-apps", "--disable-sync", "--disable-translate",
+                     "--disable-background-networking", "--disable-component-update",
+                     "--blink-settings=imagesEnabled=false", "--renderer-process-limit=1",
+                     f"--js-flags=--max-old-space-size={RENDERER_HEAP_MB}"):
+        chrome_options.add_argument(argument)
+    chrome_options.add_argument(f"--host-resolver-rules=MAP * ~NOTFOUND, "
+                                f"{', '.join(f'EXCLUDE {host}' for host in allowed_hosts())}")
+    chrome_options.add_experimental_option("prefs", {"profile.managed_default_content_settings.images": 2})
+    return chrome_options
+
+
+def set_browser_profile(profile):
+    global browser_profile
+    if profile not in BROWSER_PROFILES:
+        raise ValueError(f"Unknown browser profile {profile}, expected one of {BROWSER_PROFILES}")
+    browser_profile = profile
+
+
+def allowed_hosts():
+    base_host = urlsplit(os.environ.get("SAXO_BASE_URL", "https://www.saxo.com")).hostname
+    return [host.strip() for host in ALLOWED_HOSTS + [base_host] if host and host.strip()]
+
+
+def launch_browser(profile=None):
+    """Start a new headless Chrome session"""
+    profile = profile or browser_profile
+    driver = Chrome(options=create_chrome_options(profile))
+    if profile == "lean":
+        try:
+            driver.execute_cdp_cmd("Network.enable", {})
+            driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": BLOCKED_URL_PATTERNS})
+        except WebDriverException:
+            driver.quit()
+            raise
+    return driver
+
+
+class PooledBrowser:
+    """A long-lived WebDriver session together with its usage bookkeeping"""
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.pages_served = 0
+        self.broken = False
+
+
+class BrowserPool:
+    """Bounded pool of long-lived WebDriver sessions.
+
+    Browsers are checked out for one page at a time and returned afterwards. A browser is recycled
+    once it has served `max_pages` pages, when it crashed while checked out, or when it fails the
+    health check on its next checkout.
+    """
+
+    def __init__(self, size=POOL_SIZE, max_pages=MAX_PAGES_PER_BROWSER, browser_factory=launch_browser):
+        if size < 1:
+            raise ValueError("The browser pool needs at least one browser")
+        self.size = size
+        self.max_pages = max_pages
+        self._browser_factory = browser_factory
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._browsers = set()
+        self._closed = False
+
+    def checkout(self, timeout=CHECKOUT_TIMEOUT):
+        """Take an idle healthy browser from the pool, launching a new one if none is idle"""
+        if self._closed:
+            raise RuntimeError("The browser pool is closed")
+        if not self._slots.acquire(timeout=timeout):
+            raise TimeoutError(f"No browser became available within {timeout} seconds")
+
+        try:
+            while True:
+                try:
+                    pooled = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._launch()
+
+                if self._is_healthy(pooled):
+                    return pooled
+                logging.error("Discarding an unresponsive browser from the pool")
+                count("browsers_discarded")
+                self._discard(pooled)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def checkin(self, pooled):
+        """Return a browser to the pool, or quit it if it should be recycled"""
+        try:
+            pooled.pages_served += 1
+            if self._closed or pooled.broken or pooled.pages_served >= self.max_pages:
+                self._discard(pooled)
+                return
+
+            try:
+                pooled.driver.delete_all_cookies()
+            except WebDriverException:
+                self._discard(pooled)
+                return
+            self._idle.put(pooled)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def browser(self):
+        """Check out a WebDriver for the duration of the with-block"""
+        pooled = self.checkout()
+        try:
+            yield pooled.driver
+        except WebDriverException:
+            pooled.broken = True
+            raise
+        finally:
+            self.checkin(pooled)
+
+    def close(self):
+        """Quit every browser the pool has started"""
+        self._closed = True
+        with self._lock:
+            browsers = list(self._browsers)
+        for pooled in browsers:
+            self._discard(pooled)
+
+    def _launch(self):
+        with timer(BROWSER_LAUNCH):
+            pooled = PooledBrowser(self._browser_factory())
+        with self._lock:
+            self._browsers.add(pooled)
+        return pooled
+
+    def _discard(self, pooled):
+        with self._lock:
+            self._browsers.discard(pooled)
+        try:
+            pooled.driver.quit()
+        except Exception:
+            logging.error("Failed to quit a pooled browser")
+            logging.error(traceback.format_exc())
+
+    @staticmethod
+    def _is_healthy(pooled):
+        try:
+            pooled.driver.current_url
+            return True
+        except WebDriverException:
+            return False
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def get_browser_pool():
+    """Return the process-wide browser pool, creating it on first use"""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = BrowserPool()
+        return _default_pool
+
+
+def configure_browser_pool(size=POOL_SIZE, max_pages=MAX_PAGES_PER_BROWSER):
+    """Replace the process-wide browser pool with one of the given size"""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is not None:
+            _default_pool.close()
+        _default_pool = BrowserPool(size=size, max_pages=max_pages)
+        return _default_pool
+
+
+def shutdown_browser_pool():
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is not None:
+            _default_pool.close()
+            _default_pool = None
+
+
+atexit.register(shutdown_browser_pool)
@@ -0,0 +1,226 @@
+import logging
+import traceback
+
+from sqlalchemy import bindparam, select
+
+from book_io import get_output_sink
+from database import DONE, FAILED, Author, Book, JobRow, book_author, recommendation_table
+from metrics import DB_WRITE, count, timer
+from storage import get_storage
+
+BATCH_SIZE = 100
+
+# key of the writer in Session.info, see attach_bulk_writer
+BULK_WRITER = "bulk_writer"
+
+
+class BulkBookWriter:
+    """Buffer parsed books, authors and recommendation edges and write them in batches.
+
+    The ISBNs and author names already in the database are loaded once, so existence checks are answered
+    from memory. Every flush writes the buffered rows in one transaction through the engine's storage
+    backend with INSERT ... ON CONFLICT, which makes re-flushing rows that already exist harmless.
+    Books go to the output file, if one is configured, once the transaction that saved them has committed.
+    """
+
+    def __init__(self, engine, batch_size=BATCH_SIZE):
+        self.engine = engine
+        self.storage = get_storage(engine)
+        self.batch_size = batch_size
+        self._books = {}
+        self._authors = set()
+        self._book_authors = set()
+        self._recommendations = set()
+        self._job_statuses = {}
+        self._outputs = {}
+        # errors of books that failed to save, by input row, for the row's status if it comes in later
+        self._failed_rows = {}
+
+        with engine.connect() as connection:
+            self.known_isbns = set(connection.execute(select(Book.__table__.c.isbn)).scalars())
+            self.known_authors = set(connection.execute(select(Author.__table__.c.name)).scalars())
+
+    def has_book(self, isbn):
+        return isbn in self.known_isbns
+
+    def add_book(self, book_row, author_names, book_details=None):
+        """Buffer a new book with its authors, or only its top10k rank if the book is already known.
+        `book_details` are written to the output file after the flush."""
+        isbn = book_row["isbn"]
+        if book_details is not None and get_output_sink() is not None:
+            self._outputs[isbn] = book_details
+        if isbn in self.known_isbns:
+            if book_row["top10k"]:
+                if isbn in self._books:
+                    self._books[isbn]["top10k"] = book_row["top10k"]
+                else:
+                    self._books[isbn] = {"isbn": isbn, "top10k": book_row["top10k"], "existing": True}
+        else:
+            self._books[isbn] = dict(book_row)
+            self.known_isbns.add(isbn)
+            for author_name in author_names:
+                if author_name not in self.known_authors:
+                    self._authors.add(author_name)
+                    self.known_authors.add(author_name)
+                self._book_authors.add((isbn, author_name))
+        self.flush_if_full()
+
+    def add_recommendation(self, book_isbn, recommended_isbn):
+        self._recommendations.add((book_isbn, recommended_isbn))
+        self.flush_if_full()
+
+    def add_job_status(self, row, status, error=None):
+        """Buffer the final status of an input row, so it is written together with the row's book"""
+        if status == DONE and row in self._failed_rows:
+            status, error = FAILED, self._failed_rows.pop(row)
+        self._job_statuses[row] = (status, error)
+        self.flush_if_full()
+
+    def pending(self):
+        return (len(self._books) + len(self._authors) + len(self._book_authors) + len(self._recommendations)
+                + len(self._job_statuses) + len(self._outputs))
+
+    def flush_if_full(self):
+        if self.pending() >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write everything buffered so far in one transaction.
+
+        If the batch fails, its books are written one transaction each, together with their authors,
+        recommendations and input row status, so one bad row does not take the rest of the batch, or every
+        later batch, down with it. The input rows of books that still fail are recorded as failed.
+        """
+        if not self.pending():
+            return
+
+        batch = Batch(list(self._books.values()), set(self._authors), set(self._book_authors),
+                      set(self._recommendations), dict(self._job_statuses), dict(self._outputs))
+        self._books.clear()
+        self._authors.clear()
+        self._book_authors.clear()
+        self._recommendations.clear()
+        self._job_statuses.clear()
+        self._outputs.clear()
+        try:
+            self.write(batch)
+        except Exception as e:
+            logging.error(f"Failed to flush a batch of {len(batch.books)} books, writing them one by one: {e}")
+            logging.error(traceback.format_exc())
+            for part in batch.split():
+                self.write_separately(part)
+        else:
+            write_output(batch)
+
+    def write(self, batch):
+        new_books = [row for row in batch.books if not row.get("existing")]
+        rank_updates = [{"b_isbn": row["isbn"], "b_top10k": row["top10k"]}
+                        for row in batch.books if row.get("existing")]
+        with timer(DB_WRITE), self.engine.begin() as connection:
+            self.storage.upsert(connection, Book.__table__, new_books, ["isbn"], ["top10k"],
+                                where=lambda excluded: excluded.top10k > 0)
+            if rank_updates:
+                connection.execute(Book.__table__.update()
+                                   .where(Book.__table__.c.isbn == bindparam("b_isbn"))
+                                   .values(top10k=bindparam("b_top10k")), rank_updates)
+            self.storage.insert_ignore(connection, Author.__table__, [{"name": name} for name in batch.authors])
+            self.storage.insert_ignore(connection, book_author,
+                                       [{"book_isbn": isbn, "author_name": name}
+                                        for isbn, name in batch.book_authors])
+            self.storage.insert_ignore(connection, recommendation_table,
+                                       [{"book_isbn": isbn, "recommended_isbn": recommended}
+                                        for isbn, recommended in batch.recommendations])
+            self.storage.upsert(connection, JobRow.__table__,
+                                [{"row": row, "status": status, "last_error": error}
+                                 for row, (status, error) in batch.job_statuses.items()],
+                                ["row"], ["status", "last_error"])
+
+        count("db_rows", len(batch.books), table="book")
+        count("db_rows", len(batch.recommendations), table="recommendation")
+        count("db_rows", len(batch.job_statuses), table="job_state")
+
+    def write_separately(self, part):
+        try:
+            self.write(part)
+        except Exception as e:
+            isbns = [row["isbn"] for row in part.books]
+            logging.error(f"Dropping the rows of {isbns or 'no book'} that failed to save: {e}")
+            logging.error(traceback.format_exc())
+            count("db_rows_dropped", len(part.books) or 1)
+            # scraped again later, the book and its authors must not count as saved
+            self.known_isbns.difference_update(row["isbn"] for row in part.books if not row.get("existing"))
+            self.known_authors.difference_update(part.authors)
+            error = f"Saving the book failed: {e}"
+            self._failed_rows.update((row["top10k"], error) for row in part.books
+                                     if row["top10k"] and row["top10k"] not in part.job_statuses)
+            failed = {row: (FAILED, error) for row in part.job_statuses}
+            if failed:
+                try:
+                    self.write(Batch([], set(), set(), set(), failed))
+                except Exception:
+                    logging.error(f"Failed to record input rows {sorted(failed)} as failed")
+                    logging.error(traceback.format_exc())
+        else:
+            write_output(part)
+
+
+class Batch:
+    """The rows of one flush"""
+
+    def __init__(self, books, authors, book_authors, recommendations, job_statuses, outputs=None):
+        self.books = books
+        self.authors = authors
+        self.book_authors = book_authors
+        self.recommendations = recommendations
+        self.job_statuses = job_statuses
+        # scraped book details by ISBN, for the output file
+        self.outputs = outputs or {}
+
+    def split(self):
+        """Yield one batch per book with the rows that belong to it, then one per row left over.
+
+        New authors go with every book of theirs, which is harmless since existing rows are skipped.
+        """
+        book_authors, recommendations = set(self.book_authors), set(self.recommendations)
+        job_statuses = dict(self.job_statuses)
+        outputs = dict(self.outputs)
+        authors = self.authors - {name for _, name in book_authors}
+        for row in self.books:
+            isbn = row["isbn"]
+            own_book_authors = {pair for pair in book_authors if pair[0] == isbn}
+            own_authors = {name for _, name in own_book_authors} & self.authors
+            own_recommendations = {edge for edge in recommendations if edge[0] == isbn}
+            own_job_statuses = {rank: job_statuses.pop(rank) for rank in [row["top10k"]] if rank in job_statuses}
+            book_authors -= own_book_authors
+            recommendations -= own_recommendations
+            own_outputs = {isbn: outputs.pop(isbn)} if isbn in outputs else {}
+            yield Batch([row], own_authors, own_book_authors, own_recommendations, own_job_statuses, own_outputs)
+        for name in authors:
+            yield Batch([], {name}, set(), set(), {})
+        for pair in book_authors:
+            yield Batch([], set(), {pair}, set(), {})
+        for edge in recommendations:
+            yield Batch([], set(), set(), {edge}, {})
+        for rank, status in job_statuses.items():
+            yield Batch([], set(), set(), set(), {rank: status})
+        if outputs:
+            yield Batch([], set(), set(), set(), {}, outputs)
+
+
+def write_output(batch):
+    """Write the books of a committed batch to the output file"""
+    sink = get_output_sink()
+    if sink is not None:
+        for book_details in batch.outputs.values():
+            sink.write(book_details)
+
+
+def attach_bulk_writer(session, batch_size=BATCH_SIZE):
+    """Route save_book_details_to_database calls made with this session through a BulkBookWriter"""
+    writer = BulkBookWriter(session.get_bind(), batch_size)
+    session.info[BULK_WRITER] = writer
+    return writer
+
+
+def get_bulk_writer(session):
+    return session.info.get(BULK_WRITER)
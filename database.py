@@ -1,21 +1,47 @@
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, Table, Text
+import logging
+import os
+import threading
+
+from sqlalchemy import inspect, Column, Float, Index, Integer, String, ForeignKey, Table, Text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
 
+from storage import backend_for_url, get_storage
+
+DATABASE_PATH = os.environ.get("SAXO_DB_PATH", "scraped_books_real.db")
+DATABASE_URL = os.environ.get("SAXO_DATABASE_URL", f"sqlite:///{DATABASE_PATH}")
+
+# bumped whenever migrate() learns something new about the schema
+SCHEMA_VERSION = 5
+
 Base = declarative_base()
 
+# statuses of the rows in job_state and crawl_frontier
+PENDING = 'pending'
+IN_PROGRESS = 'in_progress'
+DONE = 'done'
+NOT_FOUND = 'not_found'
+FAILED = 'failed'
+# the ISBN's page is that of a book with another ISBN, so no book is saved under it
+ISBN_MISMATCH = 'isbn_mismatch'
+
 # table for the many-to-many relationship between books and authors
 book_author = Table('book_author', Base.metadata,
                     Column('book_isbn', String, ForeignKey('book.isbn'), primary_key=True),
                     Column('author_name', String, ForeignKey('author.name'), primary_key=True)
                     )
 
-# table for the many-to-many relationship between books and their recommendations
+# table for the many-to-many relationship between books and their recommendations; recommended_isbn has no
+# foreign key, since the frontier and refreshes save edges to books that are not scraped yet
 recommendation_table = Table('recommendation', Base.metadata,
                              Column('book_isbn', ForeignKey('book.isbn'), primary_key=True),
-                             Column('recommended_isbn', ForeignKey('book.isbn'), primary_key=True)
+                             Column('recommended_isbn', String, primary_key=True)
                              )
 
+# reverse lookups: the books recommending a book and the books of an author
+Index('ix_recommendation_recommended_isbn', recommendation_table.c.recommended_isbn)
+Index('ix_book_author_author_name', book_author.c.author_name)
+
 
 class Book(Base):
     __tablename__ = 'book'
@@ -29,7 +55,15 @@ class Book(Base):
     num_of_ratings = Column(Integer)
     rating = Column(String)
     description = Column(Text)
-    top10k = Column(Integer)
+    top10k = Column(Integer, index=True)
+    # when the page was last scraped or checked by a refresh (epoch seconds), and what it contained
+    last_scraped_at = Column(Float)
+    content_hash = Column(String)
+    # validators of the page for conditional requests, when Saxo sends them
+    etag = Column(String)
+    last_modified = Column(String)
+    # the ISBN of the book Saxo shows under this ISBN now; such a book is no longer refreshed
+    superseded_by = Column(String)
 
     authors = relationship('Author', secondary=book_author, back_populates='books')
 
@@ -38,6 +72,8 @@ class Book(Base):
                                    secondary=recommendation_table,
                                    primaryjoin=isbn == recommendation_table.c.book_isbn,
                                    secondaryjoin=isbn == recommendation_table.c.recommended_isbn,
+                                   foreign_keys=[recommendation_table.c.book_isbn,
+                                                 recommendation_table.c.recommended_isbn],
                                    backref='recommended_by')
 
 
@@ -48,11 +84,118 @@ class Author(Base):
     books = relationship('Book', secondary=book_author, back_populates='authors')
 
 
-engine = create_engine('sqlite:///scraped_books_real.db')
-Base.metadata.create_all(engine)
+class FrontierEntry(Base):
+    """A recommended ISBN waiting to be scraped, or already handled, by the recommendation crawler"""
+    __tablename__ = 'crawl_frontier'
+    __table_args__ = (Index('ix_crawl_frontier_claim', 'status', 'depth', 'priority'),)
+
+    isbn = Column(String, primary_key=True)
+    depth = Column(Integer, nullable=False)
+    priority = Column(Integer, nullable=False, default=0)
+    status = Column(String, nullable=False, default=PENDING)
+    parent_isbn = Column(String)
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(Text)
+    # the worker an in-progress ISBN is leased to, and until when (epoch seconds)
+    lease_owner = Column(String)
+    lease_expires_at = Column(Float)
+
+
+class JobRow(Base):
+    """Progress of one row of the input list, identified by its 1-based position like Book.top10k"""
+    __tablename__ = 'job_state'
+    __table_args__ = (Index('ix_job_state_claim', 'status', 'row'),)
+
+    row = Column(Integer, primary_key=True)
+    title = Column(String)
+    author = Column(String)
+    status = Column(String, nullable=False, default=PENDING)
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(Text)
+    lease_owner = Column(String)
+    lease_expires_at = Column(Float)
+
+
+def create_database_engine(url=DATABASE_URL, read_only=False):
+    """Create an engine set up by the storage backend of the URL's database, or for a path to a SQLite file.
+
+    A read-only engine is for readers that must leave the database as it is, see
+    StorageBackend.create_read_only_engine.
+    """
+    if "://" not in url:
+        url = f"sqlite:///{url}"
+    backend = backend_for_url(url)
+    return backend.create_read_only_engine(url) if read_only else backend.create_engine(url)
+
+
+def migrate(engine):
+    """Bring an existing database up to the current schema.
+
+    create_all only creates missing tables, so columns added to a model since the database was created are
+    added with ALTER TABLE, foreign keys the models dropped are dropped (SQLite does not enforce them and
+    keeps its own), and missing indexes are created. Safe to run on every start, and from several
+    processes or crawler nodes at once: the storage backend locks the schema for the whole migration.
+    """
+    with engine.begin() as connection:
+        get_storage(engine).lock_for_migration(connection)
+        Base.metadata.create_all(connection)
+        inspector = inspect(connection)
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    logging.info(f"Adding the column {table.name}.{column.name}")
+                    ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}"
+                    if column.default is not None and column.default.is_scalar:
+                        ddl += f" DEFAULT {column.default.arg!r}"
+                        if not column.nullable:
+                            ddl += " NOT NULL"
+                    connection.exec_driver_sql(ddl)
+            if engine.dialect.name != "sqlite":
+                declared = {tuple(fk.parent.name for fk in constraint.elements)
+                            for constraint in table.foreign_key_constraints}
+                for foreign_key in inspector.get_foreign_keys(table.name):
+                    if tuple(foreign_key["constrained_columns"]) not in declared and foreign_key["name"]:
+                        logging.info(f"Dropping the foreign key {table.name}.{foreign_key['name']}")
+                        connection.exec_driver_sql(f"ALTER TABLE {table.name} DROP CONSTRAINT {foreign_key['name']}")
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+        if engine.dialect.name == "sqlite":
+            connection.exec_driver_sql(f"PRAGMA user_version={SCHEMA_VERSION}")
+
+
+engine = create_database_engine()
+_migrated = False
+_engine_lock = threading.Lock()
+
+
+def configure_database(url=DATABASE_URL):
+    """Use the database at `url` (or a path to a SQLite file) from now on"""
+    global engine, _migrated
+    with _engine_lock:
+        engine.dispose()
+        engine = create_database_engine(url)
+        _migrated = False
+    return get_engine()
+
+
+def configured_database_url():
+    """URL of the database configure_database set up, with its password"""
+    with _engine_lock:
+        return engine.url.render_as_string(hide_password=False)
+
+
+def get_engine():
+    """The configured engine, migrated on first use"""
+    global _migrated
+    with _engine_lock:
+        if not _migrated:
+            migrate(engine)
+            _migrated = True
+        return engine
 
 
 def create_session():
-    Session = sessionmaker(bind=engine)
+    Session = sessionmaker(bind=get_engine())
     session = Session()
     return session
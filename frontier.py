@@ -0,0 +1,214 @@
+import logging
+import queue
+import threading
+import time
+import traceback
+
+from sqlalchemy import bindparam, func, or_, select
+
+from bulk_writer import BATCH_SIZE
+from database import DONE, FAILED, IN_PROGRESS, ISBN_MISMATCH, NOT_FOUND, PENDING, Book, FrontierEntry, get_engine
+from metrics import count
+from scraping_sql import ISBN, book_not_found_in_search_results_isbn, close_crawl_session, create_crawl_session, \
+    save_book_details_to_database, save_recommendation_edges, scrape_book_by_isbn
+from storage import get_storage
+from work_queue import LEASE_TIMEOUT, WORKER_ID, LeaseTable
+
+MAX_DEPTH = 1
+FRONTIER_WORKERS = 2
+IDLE_POLL_INTERVAL = 2
+
+frontier_table = FrontierEntry.__table__
+
+
+class Frontier:
+    """Persistent priority queue of recommended ISBNs to scrape, stored in the crawl_frontier table.
+
+    Books from the input list are depth 0, their recommendations depth 1 and so on; nothing deeper than
+    `max_depth` is queued. ISBNs are claimed breadth-first, and within a depth the ones recommended by the
+    most books go first. Every ISBN is queued at most once: the seen-set covers the frontier and the book
+    table, and the database ignores ISBNs another node queued first.
+
+    Claimed ISBNs are leased to this worker, so crawler nodes sharing the database drain the frontier
+    together without scraping an ISBN twice. ISBNs whose lease expired, because the node that claimed them
+    stopped, are pending again on start and can be claimed by any node meanwhile.
+    """
+
+    def __init__(self, engine=None, max_depth=MAX_DEPTH, worker_id=WORKER_ID, lease_timeout=LEASE_TIMEOUT):
+        self.engine = engine or get_engine()
+        self.storage = get_storage(self.engine)
+        self.max_depth = max_depth
+        self.leases = LeaseTable(self.engine, frontier_table, "isbn",
+                                 [frontier_table.c.depth, frontier_table.c.priority.desc()], worker_id, lease_timeout)
+        self._lock = threading.Lock()
+
+        with self.engine.begin() as connection:
+            connection.execute(frontier_table.update().where(frontier_table.c.status == IN_PROGRESS)
+                               .where(or_(frontier_table.c.lease_expires_at.is_(None),
+                                          frontier_table.c.lease_expires_at < time.time()))
+                               .values(status=PENDING, lease_owner=None, lease_expires_at=None))
+            # books of the last unflushed batch of a crashed run were marked done but never saved
+            connection.execute(frontier_table.update()
+                               .where(frontier_table.c.status == DONE)
+                               .where(frontier_table.c.isbn.not_in(select(Book.__table__.c.isbn)))
+                               .values(status=PENDING))
+            self.seen = set(connection.execute(select(frontier_table.c.isbn)).scalars())
+            self.seen.update(connection.execute(select(Book.__table__.c.isbn)).scalars())
+
+    def push(self, isbns, depth, parent_isbn=None):
+        """Queue the ISBNs that have not been seen yet; bump the priority of those already pending"""
+        if depth > self.max_depth or not isbns:
+            return
+        with self._lock:
+            new = [isbn for isbn in dict.fromkeys(isbns) if isbn not in self.seen]
+            known = [isbn for isbn in isbns if isbn in self.seen]
+            self.seen.update(new)
+            with self.engine.begin() as connection:
+                self.storage.insert_ignore(connection, frontier_table,
+                                           [{"isbn": isbn, "depth": depth, "priority": 0, "status": PENDING,
+                                             "parent_isbn": parent_isbn, "attempts": 0} for isbn in new])
+                if known:
+                    connection.execute(frontier_table.update()
+                                       .where(frontier_table.c.isbn == bindparam("b_isbn"))
+                                       .where(frontier_table.c.status == PENDING)
+                                       .values(priority=frontier_table.c.priority + 1),
+                                       [{"b_isbn": isbn} for isbn in known])
+
+    def claim(self, limit=1):
+        """Lease up to `limit` pending ISBNs to this worker and return them as (isbn, depth) pairs"""
+        with self._lock:
+            rows = self.leases.claim(limit, [frontier_table.c.depth], attempts=frontier_table.c.attempts + 1)
+        return [(isbn, depth) for isbn, depth in rows]
+
+    def mark(self, isbn, status, error=None):
+        count("frontier_isbns", status=status)
+        with self._lock, self.engine.begin() as connection:
+            connection.execute(frontier_table.update().where(frontier_table.c.isbn == isbn)
+                               .values(status=status, last_error=error))
+
+    def retry_failed(self):
+        """Put the ISBNs that failed in earlier runs back in the queue"""
+        with self._lock, self.engine.begin() as connection:
+            connection.execute(frontier_table.update().where(frontier_table.c.status == FAILED)
+                               .values(status=PENDING))
+
+    def remaining(self):
+        """Number of ISBNs this or another node can still claim"""
+        return self.leases.claimable_count()
+
+    def counts(self):
+        with self.engine.connect() as connection:
+            rows = connection.execute(select(frontier_table.c.status, func.count())
+                                      .group_by(frontier_table.c.status)).fetchall()
+        return dict(rows)
+
+
+class FrontierCrawler:
+    """Workers that drain the frontier concurrently, and a single writer that saves what they scrape.
+
+    A scraped book is saved without its recommendations being scraped inline. Below the frontier's max depth,
+    its recommendation edges are saved and the ISBNs are pushed one level deeper.
+    """
+
+    def __init__(self, frontier, workers=FRONTIER_WORKERS, batch_size=BATCH_SIZE):
+        self.frontier = frontier
+        self.workers = workers
+        self.batch_size = batch_size
+        self.results = queue.Queue(maxsize=2 * workers)
+        self._stopping = threading.Event()
+        self._active = 0
+        self._active_lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        self._threads = [threading.Thread(target=self.work_loop, name=f"frontier-{n}", daemon=True)
+                         for n in range(self.workers)]
+        self._writer = threading.Thread(target=self.write_loop, name="frontier-writer", daemon=True)
+        for thread in self._threads + [self._writer]:
+            thread.start()
+        self.frontier.leases.start_heartbeat()
+
+    def finish(self):
+        """Wait until the frontier is drained, then stop the workers and the writer"""
+        try:
+            while True:
+                with self._active_lock:
+                    idle = self._active == 0
+                if idle and self.results.empty() and not self.frontier.remaining():
+                    break
+                time.sleep(IDLE_POLL_INTERVAL)
+        finally:
+            self.stop()
+
+    def stop(self):
+        """Stop without draining the frontier: the workers finish the books they are scraping, the writer
+        saves them, and the ISBNs still leased to this worker go back in the queue"""
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join()
+        self.results.put(None)
+        self._writer.join()
+        self.frontier.leases.stop_heartbeat()
+        self.frontier.leases.release()
+
+    def work_loop(self):
+        while not self._stopping.is_set():
+            with self._active_lock:
+                claimed = self.frontier.claim(1)
+                if claimed:
+                    self._active += 1
+            if not claimed:
+                time.sleep(IDLE_POLL_INTERVAL)
+                continue
+
+            isbn, depth = claimed[0]
+            try:
+                book_details_dict = scrape_book_by_isbn(isbn, with_recommendations=depth < self.frontier.max_depth)
+                self.results.put((isbn, depth, book_details_dict))
+            except Exception as e:
+                logging.error(f"Scraping the recommended book with ISBN {isbn}: {e}")
+                logging.error(traceback.format_exc())
+                self.frontier.mark(isbn, FAILED, str(e))
+                with self._active_lock:
+                    self._active -= 1
+
+    def write_loop(self):
+        session = create_crawl_session(self.batch_size)
+        try:
+            while True:
+                item = self.results.get()
+                if item is None:
+                    return
+                isbn, depth, book_details_dict = item
+                try:
+                    self.save(isbn, depth, book_details_dict, session)
+                except Exception as e:
+                    logging.error(f"Saving the recommended book with ISBN {isbn}: {e}")
+                    logging.error(traceback.format_exc())
+                    self.frontier.mark(isbn, FAILED, str(e))
+                finally:
+                    with self._active_lock:
+                        self._active -= 1
+        finally:
+            close_crawl_session(session)
+
+    def save(self, isbn, depth, book_details_dict, session):
+        if book_details_dict is None:
+            book_not_found_in_search_results_isbn(isbn, session)
+            self.frontier.mark(isbn, NOT_FOUND)
+            return
+
+        if not save_book_details_to_database(book_details_dict, session):
+            self.frontier.mark(isbn, FAILED, "Saving the book failed")
+            return
+        scraped_isbn = book_details_dict[ISBN]
+        recommendations = book_details_dict.get("Recommendations", [])
+        if recommendations and depth < self.frontier.max_depth:
+            save_recommendation_edges(scraped_isbn, recommendations, session)
+            session.commit()
+            self.frontier.push(recommendations, depth + 1, scraped_isbn)
+        if scraped_isbn != isbn:
+            # marked done, the ISBN would go back in the queue on every start for lack of a book row
+            self.frontier.mark(isbn, ISBN_MISMATCH, f"Saxo returns the book with ISBN {scraped_isbn}")
+        else:
+            self.frontier.mark(isbn, DONE)
@@ -0,0 +1,223 @@
+import argparse
+import csv
+import json
+import os
+from array import array
+
+import numpy as np
+from sqlalchemy import select
+
+from database import Book, book_author, configured_database_url, create_database_engine, recommendation_table
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # optional, only needed for Parquet output
+    pa = None
+
+FORMAT_NPZ = "npz"
+FORMAT_PARQUET = "parquet"
+FORMAT_CSV = "csv"
+EXPORT_FORMATS = (FORMAT_NPZ, FORMAT_PARQUET, FORMAT_CSV)
+
+DAMPING = 0.85
+PAGERANK_TOLERANCE = 1e-10
+PAGERANK_MAX_ITERATIONS = 100
+
+
+class RecommendationGraph:
+    """The recommendation graph as integer arrays: node i is isbns[i], edge k goes from src[k] to dst[k].
+
+    Recommended ISBNs that were never scraped are nodes too, with an empty title. Book-author pairs are
+    kept as an edge list into `authors`.
+    """
+
+    def __init__(self, isbns, titles, top10k, src, dst, authors, author_book, author_index):
+        self.isbns = isbns
+        self.titles = titles
+        self.top10k = top10k
+        self.src = src
+        self.dst = dst
+        self.authors = authors
+        self.author_book = author_book
+        self.author_index = author_index
+
+    @property
+    def num_nodes(self):
+        return len(self.isbns)
+
+    def csr(self):
+        """Outgoing adjacency in CSR form: the recommendations of node i are indices[indptr[i]:indptr[i + 1]]"""
+        order = np.argsort(self.src, kind="stable")
+        indptr = np.zeros(self.num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.src, minlength=self.num_nodes), out=indptr[1:])
+        return indptr, self.dst[order]
+
+    def out_degree(self):
+        return np.bincount(self.src, minlength=self.num_nodes)
+
+    def in_degree(self):
+        return np.bincount(self.dst, minlength=self.num_nodes)
+
+    def pagerank(self, damping=DAMPING, tolerance=PAGERANK_TOLERANCE, max_iterations=PAGERANK_MAX_ITERATIONS):
+        """PageRank by power iteration; the rank of books without recommendations is spread evenly"""
+        n = self.num_nodes
+        if n == 0:
+            return np.zeros(0)
+        out_degree = self.out_degree()
+        dangling = out_degree == 0
+        weights = 1.0 / np.maximum(out_degree, 1)
+        rank = np.full(n, 1.0 / n)
+        for _ in range(max_iterations):
+            spread = np.bincount(self.dst, weights=(rank * weights)[self.src], minlength=n)
+            new_rank = (1 - damping) / n + damping * (spread + rank[dangling].sum() / n)
+            converged = np.abs(new_rank - rank).sum() < tolerance
+            rank = new_rank
+            if converged:
+                break
+        return rank
+
+    def components(self):
+        """Weakly connected components, labelled by their smallest node"""
+        labels = np.arange(self.num_nodes)
+        while True:
+            previous = labels.copy()
+            np.minimum.at(labels, self.src, labels[self.dst])
+            np.minimum.at(labels, self.dst, labels[self.src])
+            labels = labels[labels]
+            if np.array_equal(labels, previous):
+                return labels
+
+    def node_columns(self):
+        """Per-book columns with the precomputed metrics"""
+        labels = self.components()
+        return {
+            "node": np.arange(self.num_nodes),
+            "isbn": self.isbns,
+            "title": self.titles,
+            "top10k": np.asarray(self.top10k),
+            "in_degree": self.in_degree(),
+            "out_degree": self.out_degree(),
+            "pagerank": self.pagerank(),
+            "component": labels,
+        }
+
+    def summary(self):
+        labels = self.components()
+        return {
+            "books": self.num_nodes,
+            "recommendations": len(self.src),
+            "authors": len(self.authors),
+            "components": int(len(np.unique(labels))),
+            "largest_component": int(np.bincount(labels).max()) if self.num_nodes else 0,
+        }
+
+
+def load_graph(engine=None):
+    """Read the book, recommendation and book_author tables in one streaming pass each, by default from the
+    configured database through a read-only engine"""
+    index = {}
+    isbns, titles, top10k = [], [], array("q")
+    book_table = Book.__table__
+
+    def node(isbn):
+        i = index.get(isbn)
+        if i is None:
+            i = index[isbn] = len(isbns)
+            isbns.append(isbn)
+            titles.append("")
+            top10k.append(0)
+        return i
+
+    src, dst = array("q"), array("q")
+    authors, author_index = [], {}
+    author_book, author_of = array("q"), array("q")
+    own_engine = engine is None
+    if own_engine:
+        engine = create_database_engine(configured_database_url(), read_only=True)
+    with engine.connect() as connection:
+        connection = connection.execution_options(stream_results=True)
+        for isbn, title, rank in connection.execute(select(book_table.c.isbn, book_table.c.title,
+                                                           book_table.c.top10k)):
+            i = node(isbn)
+            titles[i] = title or ""
+            top10k[i] = rank or 0
+        for book_isbn, recommended_isbn in connection.execute(select(recommendation_table.c.book_isbn,
+                                                                     recommendation_table.c.recommended_isbn)):
+            src.append(node(book_isbn))
+            dst.append(node(recommended_isbn))
+        for book_isbn, author_name in connection.execute(select(book_author.c.book_isbn,
+                                                                book_author.c.author_name)):
+            a = author_index.get(author_name)
+            if a is None:
+                a = author_index[author_name] = len(authors)
+                authors.append(author_name)
+            author_book.append(node(book_isbn))
+            author_of.append(a)
+    if own_engine:
+        engine.dispose()
+
+    return RecommendationGraph(np.array(isbns, dtype=object), np.array(titles, dtype=object),
+                               np.frombuffer(top10k, dtype=np.int64), np.frombuffer(src, dtype=np.int64),
+                               np.frombuffer(dst, dtype=np.int64), np.array(authors, dtype=object),
+                               np.frombuffer(author_book, dtype=np.int64), np.frombuffer(author_of, dtype=np.int64))
+
+
+def export_graph(graph, out_dir, formats=(FORMAT_NPZ,)):
+    """Write the graph and its metrics to `out_dir` in each of the formats; return the written paths"""
+    os.makedirs(out_dir, exist_ok=True)
+    nodes = graph.node_columns()
+    edges = {"src": graph.src, "dst": graph.dst}
+    book_authors = {"node": graph.author_book, "author": graph.author_index}
+    written = []
+
+    if FORMAT_NPZ in formats:
+        indptr, indices = graph.csr()
+        path = os.path.join(out_dir, "graph.npz")
+        np.savez_compressed(path, indptr=indptr, indices=indices, authors=graph.authors.astype(str),
+                            author_book=graph.author_book, author_index=graph.author_index,
+                            **{name: values.astype(str) if values.dtype == object else values
+                               for name, values in nodes.items()})
+        written.append(path)
+
+    if FORMAT_PARQUET in formats:
+        if pa is None:
+            raise ImportError("Parquet export needs pyarrow")
+        for name, columns in (("nodes", nodes), ("edges", edges), ("book_authors", book_authors),
+                              ("authors", {"author": graph.authors})):
+            path = os.path.join(out_dir, f"{name}.parquet")
+            pq.write_table(pa.table({column: values.tolist() if values.dtype == object else values
+                                     for column, values in columns.items()}), path)
+            written.append(path)
+
+    if FORMAT_CSV in formats:
+        for name, columns in (("nodes", nodes), ("edges", edges), ("book_authors", book_authors),
+                              ("authors", {"author": graph.authors})):
+            path = os.path.join(out_dir, f"{name}.csv")
+            with open(path, "w", encoding="utf-8", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(columns)
+                writer.writerows(zip(*(values.tolist() for values in columns.values())))
+            written.append(path)
+
+    with open(os.path.join(out_dir, "summary.json"), "w") as f:
+        json.dump(graph.summary(), f, indent=2)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the recommendation graph with degrees, PageRank and "
+                                                 "connected components")
+    parser.add_argument("--db", default=None, help="database path or URL to read (defaults to the crawler's database)")
+    parser.add_argument("--out", default="graph_export", help="directory to write the export to")
+    parser.add_argument("--formats", nargs="+", choices=EXPORT_FORMATS, default=[FORMAT_NPZ])
+    args = parser.parse_args()
+
+    graph = load_graph(create_database_engine(args.db, read_only=True) if args.db else None)
+    for path in export_graph(graph, args.out, args.formats):
+        print(f"Wrote {path}")
+    print(graph.summary())
+
+
+if __name__ == "__main__":
+    main()
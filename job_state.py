@@ -0,0 +1,70 @@
+import threading
+
+from sqlalchemy import select
+
+from bulk_writer import get_bulk_writer
+from database import DONE, FAILED, IN_PROGRESS, NOT_FOUND, PENDING, Book, JobRow, get_engine
+from metrics import count
+from storage import get_storage
+
+job_table = JobRow.__table__
+
+# statuses of rows that are finished and skipped unless asked to be retried
+FINISHED = (DONE, NOT_FOUND, FAILED)
+
+
+class JobState:
+    """Resumable per-row progress of a crawl over the input list, stored in the job_state table.
+
+    The status of every row is loaded in one query when the crawl starts, so deciding which rows to scrape
+    never touches the database. Books saved with a top10k rank by runs from before the job_state table
+    existed count as done. A row that was in progress when a run stopped is scraped again; finished rows are
+    skipped unless their status is in `retry`.
+    """
+
+    def __init__(self, engine=None, retry=()):
+        self.engine = engine or get_engine()
+        self.storage = get_storage(self.engine)
+        self.retry = set(retry)
+        self._lock = threading.Lock()
+
+        with self.engine.connect() as connection:
+            self.statuses = {row: DONE for row in connection.execute(
+                select(Book.__table__.c.top10k).where(Book.__table__.c.top10k > 0)).scalars()}
+            self.statuses.update(connection.execute(select(job_table.c.row, job_table.c.status)).fetchall())
+
+    def should_scrape(self, row):
+        status = self.statuses.get(row, PENDING)
+        return status not in FINISHED or status in self.retry
+
+    def status(self, row):
+        return self.statuses.get(row, PENDING)
+
+    def start(self, row, title):
+        """Mark the row as in progress and count the attempt"""
+        with self._lock, self.engine.begin() as connection:
+            statement = self.storage.insert(job_table).values(row=row, title=title, status=IN_PROGRESS, attempts=1)
+            connection.execute(statement.on_conflict_do_update(
+                index_elements=["row"],
+                set_={"status": IN_PROGRESS, "title": title, "attempts": job_table.c.attempts + 1}))
+            self.statuses[row] = IN_PROGRESS
+
+    def record(self, session, row, status, error=None):
+        """Record how the row ended, in the same batch or transaction as the data saved for it"""
+        self.statuses[row] = status
+        count("rows", status=status)
+        writer = get_bulk_writer(session)
+        if writer is not None:
+            writer.add_job_status(row, status, error)
+            return
+
+        statement = self.storage.insert(job_table).values(row=row, status=status, last_error=error)
+        session.execute(statement.on_conflict_do_update(index_elements=["row"],
+                                                        set_={"status": status, "last_error": error}))
+        session.commit()
+
+    def summary(self):
+        counts = {}
+        for status in self.statuses.values():
+            counts[status] = counts.get(status, 0) + 1
+        return counts
@@ -1,14 +1,28 @@
+import argparse
+import asyncio
 import logging
-import math
-import time
-import os
-import pandas as pd
-from random import randint
-
-from database import create_session, Book
-from scraping_common import step_find_book_in_search_results, query_saxo_with_title_or_isbn, extract_book_details_dict, \
-    extract_recommendations_list, translate_danish_to_english, create_browser_and_wait_for_page_load
-from scraping_sql import book_not_found_in_search_results_title, save_book_details_to_database
+import traceback
+
+from async_crawler import run_async
+from book_io import OUTPUT_FORMATS, InputRows, close_output_sink, configure_output_sink, input_total, \
+    progress_message
+from browser_pool import BROWSER_PROFILES, browser_profile, configure_browser_pool, set_browser_profile
+from bulk_writer import BATCH_SIZE
+from database import DATABASE_URL, DONE, FAILED, NOT_FOUND, configure_database
+from frontier import FRONTIER_WORKERS, MAX_DEPTH, Frontier, FrontierCrawler
+from job_state import JobState
+from metrics import METRICS_SUMMARY_PATH, stage_summary, start_metrics_server, write_metrics_summary
+from page_cache import CACHE_DIR, cache_stats_summary, configure_page_cache
+from pipeline import PARSE_WORKERS, run_pipeline
+from rate_limiter import MAX_REQUESTS_PER_SECOND, REQUESTS_PER_SECOND, configure_rate_limiter, get_rate_limiter, \
+    rate_limiter_summary
+from refresh import REFRESH_INTERVAL, REFRESH_LIMIT, Refresher, schedule_refresh
+from scraping_common import step_find_book_in_search_results, query_saxo_with_title_or_isbn, parse_book_page, \
+    prepare_search_terms, fetch_book_page_html, FETCH_MODES, fetch_mode, fetch_stats_summary, set_fetch_mode, \
+    PARSER_BACKENDS, parser_backend, set_parser_backend
+from scraping_sql import book_not_found_in_search_results_title, save_book_details_to_database, \
+    close_crawl_session, create_crawl_session
+from work_queue import LEASE_BATCH, LEASE_TIMEOUT, WORKER_ID, WorkQueue
 
 # from scraping_sql import run_sql
 
@@ -17,69 +31,221 @@ logging.basicConfig(filename='data_csv/app_errors.log', level=logging.ERROR,
                     format='%(asctime)s:%(levelname)s:%(message)s')
 
 
-def read_input_csv(file_path):
-    """Read the CSV file to get the list of tuples (book_title, book_author) and return it as a list"""
-    df = pd.read_csv(file_path, encoding="ISO-8859-1")
-    book_info = list(zip(df["book_title"], df["book_author"]))
-    return book_info
-
-
-def save_to_csv(data, output_file):
-    """save the scraped data into a CSV file"""
-    for key in data:
-        if not isinstance(data[key], list):
-            data[key] = [data[key]]
-
-    file_exists = os.path.isfile(output_file)
-
-    df = pd.DataFrame(data)
-    df.to_csv(output_file, mode='a', index=False, header=not file_exists)
-    # df.to_csv(output_file, index=False)
+ENGINES = ("sequential", "async", "pipeline")
 
 
-def is_book_scraped(session, i):
-    """Check if the book is already in the database based on top10k value"""
-    return session.query(Book).filter(Book.top10k == i).first()
-
-
-if __name__ == "__main__":
-
-    input_csv = "data_csv/top_10k_books.csv"
-    # input_csv = "data_csv/top3.csv"
-    output_csv = "data_csv/books-scraped.csv"
-    # run_csv(input_csv, output_csv)
-
-    book_info = read_input_csv(input_csv)
-    session = create_session()
-
-
-
-    for i, (title, author) in enumerate(book_info):
-        print(f"Scraping book {i + 1} out of {len(book_info)}")
+def run_sequential(book_info, session, job_state):
+    """Scrape the books one at a time"""
+    total = input_total(book_info)
+    for row, title, author in book_info:
+        print(progress_message(row, total))
         # if the book has been scraped in the previous session - continue
-        if i <2590:
-            continue
-        if is_book_scraped(session, i + 1):
-            print(f"Book {i + 1} is already in the database")
+        if not job_state.should_scrape(row):
+            print(f"Book {row} is {job_state.status(row)} in a previous session")
             continue
+        job_state.start(row, title)
+
+        try:
+            scrape_row(row, title, author, session, job_state)
+        except Exception as e:
+            logging.error(f"Failed to scrape book {row}: {title} by {author}: {e}")
+            logging.error(traceback.format_exc())
+            job_state.record(session, row, FAILED, str(e))
+
+
+def scrape_row(row, title, author, session, job_state):
+    title, author = prepare_search_terms(title, author)
+
+    search_page = query_saxo_with_title_or_isbn(title)  # get the search page requrst.text
+    search_page_book_info = step_find_book_in_search_results(search_page, author,
+                                                             title)  # find the matching book and return its info
+    if search_page_book_info == 'N/A':  # case when the book can't be found in the saxo database
+        book_not_found_in_search_results_title(title, author, session)
+        job_state.record(session, row, NOT_FOUND)
+        return
+    if not search_page_book_info:
+        raise ValueError("Failed to parse the search results")
+
+    book_page_html = fetch_book_page_html(
+        search_page_book_info["Url"])  # get the book page html, rendered in a browser if needed
+    book_details_dict = parse_book_page(book_page_html)
+    book_details_dict["Top10k"] = row
+
+    logging.debug(book_details_dict)
+    if save_book_details_to_database(book_details_dict, session):
+        job_state.record(session, row, DONE)
+    else:
+        job_state.record(session, row, FAILED, "Saving the book failed")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Scrape book details and recommendations from Saxo.com")
+    parser.add_argument("--input", default="data_csv/top_10k_books.csv",
+                        help="CSV with book_title and book_author, read as a stream; '-' reads stdin")
+    parser.add_argument("--db", default=DATABASE_URL,
+                        help="SQLite file or database URL to save to (SAXO_DB_PATH / SAXO_DATABASE_URL)")
+    parser.add_argument("--output", default=None,
+                        help="also write the saved books to this .csv, .jsonl or .parquet file")
+    parser.add_argument("--output-format", choices=OUTPUT_FORMATS, default=None,
+                        help="format of --output when its extension does not tell")
+    parser.add_argument("--engine", choices=ENGINES, default=None,
+                        help="crawl engine; defaults to async when --concurrency is above 1, else sequential")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="number of books in flight at once (async) or fetcher threads (pipeline)")
+    parser.add_argument("--parse-workers", type=int, default=PARSE_WORKERS,
+                        help="parser processes of the pipeline engine")
+    parser.add_argument("--rps", type=float, default=REQUESTS_PER_SECOND,
+                        help="requests per second to start at; the rate adapts to how Saxo.com responds")
+    parser.add_argument("--max-rps", type=float, default=MAX_REQUESTS_PER_SECOND,
+                        help="ceiling of the adaptive request rate")
+    parser.add_argument("--fetch-mode", choices=FETCH_MODES, default=fetch_mode,
+                        help="'http' fetches detail pages without a browser and renders only when data is missing")
+    parser.add_argument("--parser", choices=PARSER_BACKENDS, default=parser_backend,
+                        help="HTML parser backend for book pages")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="directory of the on-disk search and page cache")
+    parser.add_argument("--no-cache", action="store_true", help="always fetch from Saxo.com")
+    parser.add_argument("--replay-only", action="store_true",
+                        help="serve everything from the cache, including expired entries, and never fetch")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE,
+                        help="rows buffered before a bulk database write; 0 commits every book on its own")
+    parser.add_argument("--frontier", action="store_true",
+                        help="queue recommended books on the crawl frontier instead of scraping them inline; "
+                             "always on with the async and pipeline engines")
+    parser.add_argument("--max-depth", type=int, default=MAX_DEPTH,
+                        help="deepest recommendation level the frontier expands (input books are depth 0)")
+    parser.add_argument("--frontier-workers", type=int, default=None,
+                        help=f"threads scraping the books queued on the frontier (default: --concurrency, at least "
+                             f"{FRONTIER_WORKERS})")
+    parser.add_argument("--drain-frontier", action="store_true",
+                        help="skip the input list and only scrape what is queued on the frontier")
+    parser.add_argument("--retry-failed-isbns", action="store_true",
+                        help="queue the frontier ISBNs that failed in earlier runs again")
+    parser.add_argument("--retry", nargs="+", choices=(FAILED, NOT_FOUND), default=[],
+                        help="scrape the input rows that ended with these statuses in earlier runs again")
+    parser.add_argument("--coordinator", action="store_true",
+                        help="queue the input rows in the database for --worker nodes, then exit")
+    parser.add_argument("--worker", action="store_true",
+                        help="scrape input rows leased from the queue filled by --coordinator instead of --input")
+    parser.add_argument("--worker-id", default=WORKER_ID,
+                        help="name of this node on its leases (SAXO_WORKER_ID, defaults to host and process id)")
+    parser.add_argument("--lease-timeout", type=float, default=LEASE_TIMEOUT,
+                        help="seconds before rows claimed by a node that stopped heartbeating go to another node")
+    parser.add_argument("--lease-batch", type=int, default=LEASE_BATCH,
+                        help="input rows a worker leases at a time")
+    parser.add_argument("--refresh", action="store_true",
+                        help="re-scrape the stalest saved books instead of the input list and update what changed")
+    parser.add_argument("--refresh-limit", type=int, default=REFRESH_LIMIT,
+                        help="most books a --refresh run checks")
+    parser.add_argument("--refresh-interval", type=float, default=REFRESH_INTERVAL / 3600,
+                        help="hours a book of average popularity goes before it is due for a refresh")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve Prometheus metrics on this port at /metrics while crawling")
+    parser.add_argument("--metrics-json", default=METRICS_SUMMARY_PATH,
+                        help="file the JSON summary of stage timings and counters is written to after the run")
+    parser.add_argument("--browser-profile", choices=BROWSER_PROFILES, default=browser_profile,
+                        help="'lean' skips images, fonts, media and third-party hosts and caps browser memory; "
+                             "experimental")
+    parser.add_argument("--browsers", type=int, default=None,
+                        help="size of the browser pool (defaults to SAXO_BROWSER_POOL_SIZE, or --concurrency)")
+    return parser.parse_args()
+
+
+def crawl_engine(args):
+    return args.engine or ("async" if args.concurrency > 1 else "sequential")
+
+
+def run_crawl(args, book_info, job_state, frontier=None):
+    """Scrape the input rows with the selected engine"""
+    engine = crawl_engine(args)
+    if engine == "async":
+        asyncio.run(run_async(book_info, concurrency=args.concurrency, job_state=job_state,
+                              batch_size=args.batch_size, frontier=frontier))
+    elif engine == "pipeline":
+        run_pipeline(book_info, fetchers=args.concurrency, parse_workers=args.parse_workers,
+                     job_state=job_state, batch_size=args.batch_size, frontier=frontier)
+    else:
+        session = create_crawl_session(args.batch_size, frontier)
+        try:
+            run_sequential(book_info, session, job_state)
+        finally:
+            close_crawl_session(session)
 
-        title = translate_danish_to_english(title)
-        author = translate_danish_to_english(author) if not type(author)==float else None
 
-        search_page = query_saxo_with_title_or_isbn(title)  # get the search page requrst.text
-        time.sleep(randint(1, 2))
-        search_page_book_info = step_find_book_in_search_results(search_page, author,
-                                                                 title)  # find the matching book and return its info
-        if search_page_book_info == 'N/A':  # case when the book can't be found in the saxo database
-            book_not_found_in_search_results_title(title, author, session)
-            continue
-
-        book_page_html = create_browser_and_wait_for_page_load(
-            search_page_book_info["Url"])  # get the fully loaded book page html
-        book_details_dict = extract_book_details_dict(book_page_html)
-        book_details_dict["Recommendations"] = extract_recommendations_list(book_page_html)
-        book_details_dict["Top10k"] = i + 1
+if __name__ == "__main__":
+    args = parse_args()
 
-        print(book_details_dict)
-        save_book_details_to_database(book_details_dict, session)
-        time.sleep(randint(1, 2))
+    input_csv = args.input
+    # input_csv = "data_csv/top3.csv"
+    # run_csv(input_csv, args.output)
+
+    configure_database(args.db)
+    set_fetch_mode(args.fetch_mode)
+    set_parser_backend(args.parser)
+    set_browser_profile(args.browser_profile)
+    configure_page_cache(args.cache_dir, replay_only=args.replay_only, enabled=not args.no_cache)
+    configure_rate_limiter(args.rps, args.max_rps)
+    configure_output_sink(args.output, args.output_format)
+
+    if args.browsers or args.concurrency > 1:
+        configure_browser_pool(size=args.browsers or args.concurrency)
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+
+    frontier = None
+    frontier_crawler = None
+    # the concurrent engines never scrape recommended books inline, their single writer would do it all
+    needs_frontier = crawl_engine(args) != "sequential" and not args.refresh
+    if (args.frontier or args.drain_frontier or needs_frontier) and not args.coordinator:
+        frontier = Frontier(max_depth=args.max_depth, worker_id=args.worker_id, lease_timeout=args.lease_timeout)
+        if args.retry_failed_isbns:
+            frontier.retry_failed()
+        frontier_workers = args.frontier_workers or max(FRONTIER_WORKERS, args.concurrency)
+        frontier_crawler = FrontierCrawler(frontier, workers=frontier_workers, batch_size=args.batch_size)
+        frontier_crawler.start()
+
+    job_state = None
+    refresher = None
+    completed = False
+    try:
+        if args.refresh:
+            stale_books = schedule_refresh(limit=args.refresh_limit, interval=args.refresh_interval * 3600)
+            print(f"{len(stale_books)} books are due for a refresh")
+            refresher = Refresher(workers=args.concurrency, batch_size=args.batch_size or 1, frontier=frontier)
+            refresher.run(stale_books)
+        elif args.coordinator:
+            job_state = JobState(retry=args.retry)
+            work_queue = WorkQueue(worker_id=args.worker_id, lease_timeout=args.lease_timeout)
+            print(f"Queued {work_queue.enqueue(InputRows(input_csv), job_state)} input rows for the workers")
+        elif args.worker:
+            job_state = JobState(retry=args.retry)
+            with WorkQueue(batch_size=args.lease_batch, worker_id=args.worker_id, lease_timeout=args.lease_timeout,
+                           job_state=job_state) as work_queue:
+                run_crawl(args, work_queue, job_state, frontier)
+            print(f"Worker {args.worker_id} claimed {work_queue.claimed} input rows")
+        elif not args.drain_frontier:
+            job_state = JobState(retry=args.retry)
+            run_crawl(args, InputRows(input_csv), job_state, frontier)
+        completed = True
+    finally:
+        if frontier_crawler is not None:
+            # drain the frontier only after a normal run; on an error or Ctrl-C leave the rest for later
+            if completed:
+                frontier_crawler.finish()
+            else:
+                frontier_crawler.stop()
+            print(f"Recommendation frontier: {frontier.counts()}")
+        if job_state is not None:
+            print(f"Input rows: {job_state.summary()}")
+        if refresher is not None:
+            print(refresher.summary())
+        close_output_sink()
+
+    print(fetch_stats_summary())
+    print(cache_stats_summary())
+    print(rate_limiter_summary())
+    print(stage_summary())
+    if args.metrics_json:
+        write_metrics_summary(args.metrics_json, input_rows=job_state.summary() if job_state is not None else None,
+                              frontier=frontier.counts() if frontier is not None else None,
+                              rate_limiter=get_rate_limiter().stats())
+        print(f"Metrics summary written to {args.metrics_json}")
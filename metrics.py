@@ -0,0 +1,239 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PREFIX = "saxo"
+METRICS_SUMMARY_PATH = os.environ.get("SAXO_METRICS_SUMMARY", "data_csv/run_metrics.json")
+# upper bounds in seconds of the stage histogram buckets; an implicit +Inf bucket follows
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# stages of scraping a book, timed separately
+SEARCH_HTTP = "search_http"
+SEARCH_MATCH = "search_match"
+DETAIL_HTTP = "detail_http"
+BROWSER_LAUNCH = "browser_launch"
+PAGE_LOAD = "page_load"
+PAGE_READY_WAIT = "page_ready_wait"
+PARSE = "parse"
+DB_WRITE = "db_write"
+RECOMMENDATION_EXPANSION = "recommendation_expansion"
+
+
+class Histogram:
+    """Counts of observed durations per bucket, with their sum and maximum"""
+
+    def __init__(self, buckets=STAGE_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Estimate the q-quantile by interpolating inside the bucket it falls into"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - seen) / bucket_count)
+            seen += bucket_count
+        return self.max
+
+
+class Metrics:
+    """Process-wide stage timers and event counters.
+
+    Stages are timed into histograms, events are counted by name and labels, and gauges are read from
+    callbacks when the metrics are rendered. Everything can be rendered in the Prometheus text format or
+    summarized as a dict at the end of a run.
+    """
+
+    def __init__(self, buckets=STAGE_BUCKETS):
+        self.buckets = buckets
+        self.started_at = time.time()
+        self._stages = {}
+        self._counters = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                histogram = self._stages[stage] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge(self, name, read):
+        """Report the value returned by `read()` as the gauge `name`"""
+        self._gauges[name] = read
+
+    def counter_value(self, name, **labels):
+        with self._lock:
+            return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def render_prometheus(self):
+        lines = []
+        with self._lock:
+            stages = {stage: (list(h.counts), h.count, h.sum) for stage, h in self._stages.items()}
+            counters = dict(self._counters)
+
+        name = f"{METRICS_PREFIX}_stage_seconds"
+        lines += [f"# HELP {name} Time spent in each stage of scraping a book", f"# TYPE {name} histogram"]
+        for stage, (counts, count, total) in sorted(stages.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(list(self.buckets) + ["+Inf"], counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {total}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {count}')
+
+        typed = set()
+        for (counter, labels), value in sorted(counters.items()):
+            name = f"{METRICS_PREFIX}_{counter}_total"
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{format_labels(labels)} {value}")
+
+        for gauge, read in sorted(self._gauges.items()):
+            try:
+                value = read()
+            except Exception as e:
+                logging.error(f"Reading the gauge {gauge} failed: {e}")
+                continue
+            name = f"{METRICS_PREFIX}_{gauge}"
+            lines += [f"# TYPE {name} gauge", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Per-stage latencies in milliseconds, counters and gauges as a JSON-friendly dict"""
+        with self._lock:
+            stages = {stage: {"count": h.count,
+                              "total_seconds": round(h.sum, 3),
+                              "mean_ms": round(1000 * h.sum / h.count, 2) if h.count else 0.0,
+                              "p50_ms": round(1000 * h.quantile(0.5), 2),
+                              "p95_ms": round(1000 * h.quantile(0.95), 2),
+                              "max_ms": round(1000 * h.max, 2)}
+                      for stage, h in sorted(self._stages.items())}
+            counters = {}
+            for (counter, labels), value in sorted(self._counters.items()):
+                counters.setdefault(counter, {})[",".join(f"{k}={v}" for k, v in labels) or "total"] = value
+        gauges = {}
+        for gauge, read in sorted(self._gauges.items()):
+            try:
+                gauges[gauge] = read()
+            except Exception as e:
+                logging.error(f"Reading the gauge {gauge} failed: {e}")
+        return {"elapsed_seconds": round(time.time() - self.started_at, 3), "stages": stages, "counters": counters,
+                "gauges": gauges}
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+_metrics = Metrics()
+
+
+def get_metrics():
+    return _metrics
+
+
+def timer(stage):
+    """Time the with-block as `stage`"""
+    return _metrics.timer(stage)
+
+
+def timed(stage):
+    """Decorator timing every call of the function as `stage`"""
+    def decorate(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with _metrics.timer(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def observe(stage, seconds):
+    _metrics.observe(stage, seconds)
+
+
+def count(name, value=1, **labels):
+    _metrics.count(name, value, **labels)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serve /metrics in the Prometheus text format and /summary as JSON"""
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, content_type = _metrics.render_prometheus(), "text/plain; version=0.0.4"
+        elif self.path == "/summary":
+            body, content_type = json.dumps(_metrics.summary()), "application/json"
+        else:
+            self.send_error(404)
+            return
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, host="0.0.0.0"):
+    """Serve the metrics from a background thread; return the server so it can be shut down"""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
+
+
+def stage_summary():
+    """Describe the latency of every stage timed so far, one line per stage"""
+    stages = _metrics.summary()["stages"]
+    return "\n".join(f"{stage:<26}{s['count']:>7} x  mean {s['mean_ms']:>9.1f} ms  p95 {s['p95_ms']:>9.1f} ms  "
+                     f"total {s['total_seconds']:>9.1f} s" for stage, s in stages.items())
+
+
+def write_metrics_summary(path, **extra):
+    """Write the run's metrics summary, together with `extra` sections, to a JSON file and return it"""
+    summary = dict(_metrics.summary(), **extra)
+    with open(path, "w") as f:
+        json.dump(summary, f, indent=2, default=str)
+    return summary
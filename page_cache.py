@@ -0,0 +1,236 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import Counter
+
+from metrics import count
+
+CACHE_DIR = os.environ.get("SAXO_CACHE_DIR", "data_cache")
+MAX_CACHE_BYTES = int(os.environ.get("SAXO_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+
+# kinds of cached documents and how long (in seconds) they stay fresh
+SEARCH = "search"
+PAGE = "page"
+DEFAULT_TTLS = {
+    SEARCH: 7 * 24 * 3600,
+    PAGE: 30 * 24 * 3600,
+}
+
+
+class PageCache:
+    """Compressed, content-addressed on-disk cache of search responses and book page html.
+
+    Entries are keyed by (kind, url); ISBN lookups are cached under the ISBN search URL. The html itself is
+    stored once per distinct content under blobs/<sha256>, so the same page reached through several URLs
+    takes space only once. Entries expire after their kind's TTL, and the least recently used entries are
+    evicted once the blobs exceed `max_bytes`. In replay-only mode expired entries are still served and
+    nothing is fetched, which allows re-running the parsers over the cached corpus offline.
+    """
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_CACHE_BYTES, ttls=None, replay_only=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.replay_only = replay_only
+        self.stats = Counter()
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.join(directory, "blobs"), exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(directory, "index.db"), check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS entry (
+                kind TEXT NOT NULL,
+                url TEXT NOT NULL,
+                blob TEXT NOT NULL,
+                stored_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (kind, url)
+            );
+            CREATE INDEX IF NOT EXISTS ix_entry_accessed_at ON entry (accessed_at);
+            CREATE INDEX IF NOT EXISTS ix_entry_blob ON entry (blob);
+            CREATE TABLE IF NOT EXISTS blob (
+                hash TEXT PRIMARY KEY,
+                size INTEGER NOT NULL
+            );
+        """)
+
+    def get(self, kind, url):
+        """Return the cached text, or None on a miss or an expired entry"""
+        with self._lock:
+            row = self._db.execute("SELECT blob, stored_at FROM entry WHERE kind = ? AND url = ?",
+                                   (kind, url)).fetchone()
+            if row is None:
+                self.stats["miss"] += 1
+                count("cache_requests", kind=kind, result="miss")
+                return None
+
+            blob, stored_at = row
+            now = time.time()
+            if not self.replay_only and now - stored_at > self.ttls[kind]:
+                self.stats["expired"] += 1
+                count("cache_requests", kind=kind, result="expired")
+                return None
+
+            try:
+                with open(self._blob_path(blob), "rb") as f:
+                    text = zlib.decompress(f.read()).decode("utf-8")
+            except (OSError, zlib.error):
+                logging.error(f"Dropping unreadable cache entry for {url}")
+                self._db.execute("DELETE FROM entry WHERE kind = ? AND url = ?", (kind, url))
+                self._db.commit()
+                self.stats["miss"] += 1
+                return None
+
+            self._db.execute("UPDATE entry SET accessed_at = ? WHERE kind = ? AND url = ?", (now, kind, url))
+            self._db.commit()
+            self.stats["hit"] += 1
+            count("cache_requests", kind=kind, result="hit")
+            return text
+
+    def put(self, kind, url, text):
+        data = text.encode("utf-8")
+        blob = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            if self._db.execute("SELECT 1 FROM blob WHERE hash = ?", (blob,)).fetchone() is None:
+                compressed = zlib.compress(data, 6)
+                path = self._blob_path(blob)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path + ".tmp", "wb") as f:
+                    f.write(compressed)
+                os.replace(path + ".tmp", path)
+                self._db.execute("INSERT INTO blob (hash, size) VALUES (?, ?)", (blob, len(compressed)))
+
+            now = time.time()
+            old = self._db.execute("SELECT blob FROM entry WHERE kind = ? AND url = ?", (kind, url)).fetchone()
+            self._db.execute("INSERT OR REPLACE INTO entry (kind, url, blob, stored_at, accessed_at) "
+                             "VALUES (?, ?, ?, ?, ?)", (kind, url, blob, now, now))
+            if old and old[0] != blob:
+                self._delete_unreferenced_blob(old[0])
+            self._evict()
+            self._db.commit()
+            self.stats["store"] += 1
+
+    def urls(self, kind):
+        """Return the URLs cached for a kind, most recently used first"""
+        with self._lock:
+            rows = self._db.execute("SELECT url FROM entry WHERE kind = ? ORDER BY accessed_at DESC", (kind,))
+            return [url for url, in rows.fetchall()]
+
+    def size(self):
+        with self._lock:
+            return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM blob").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _evict(self):
+        """Drop least recently used entries until the blobs fit in max_bytes"""
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM blob").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        lru = self._db.execute("SELECT kind, url, blob FROM entry ORDER BY accessed_at").fetchall()
+        for kind, url, blob in lru:
+            if total <= self.max_bytes:
+                break
+            self._db.execute("DELETE FROM entry WHERE kind = ? AND url = ?", (kind, url))
+            total -= self._delete_unreferenced_blob(blob)
+            self.stats["evicted"] += 1
+
+    def _delete_unreferenced_blob(self, blob):
+        """Delete the blob if no entry points at it any more. Return the number of bytes freed."""
+        if self._db.execute("SELECT 1 FROM entry WHERE blob = ? LIMIT 1", (blob,)).fetchone():
+            return 0
+        row = self._db.execute("SELECT size FROM blob WHERE hash = ?", (blob,)).fetchone()
+        self._db.execute("DELETE FROM blob WHERE hash = ?", (blob,))
+        try:
+            os.remove(self._blob_path(blob))
+        except FileNotFoundError:
+            pass
+        return row[0] if row else 0
+
+    def _blob_path(self, blob):
+        return os.path.join(self.directory, "blobs", blob[:2], blob)
+
+
+_cache = None
+_cache_configured = False
+_cache_lock = threading.Lock()
+
+
+def configure_page_cache(directory=CACHE_DIR, max_bytes=MAX_CACHE_BYTES, ttls=None, replay_only=False,
+                         enabled=True):
+    """Set up the process-wide cache; with enabled=False every fetch goes to the network"""
+    global _cache, _cache_configured
+    with _cache_lock:
+        if _cache is not None:
+            _cache.close()
+        _cache = PageCache(directory, max_bytes, ttls, replay_only) if enabled else None
+        _cache_configured = True
+        return _cache
+
+
+def get_page_cache():
+    """Return the process-wide cache, creating the default one on first use. None when caching is off."""
+    global _cache, _cache_configured
+    with _cache_lock:
+        if not _cache_configured:
+            _cache = PageCache()
+            _cache_configured = True
+        return _cache
+
+
+def cached_fetch(kind, url, fetch, cacheable=None):
+    """Return the cached text for url, or call fetch() and cache its result if it is a non-empty string and,
+    when given, `cacheable(text)` holds.
+
+    In replay-only mode a miss returns None without calling fetch.
+    """
+    cache = get_page_cache()
+    if cache is None:
+        return fetch()
+
+    text = cache.get(kind, url)
+    if text is not None:
+        return text
+    if cache.replay_only:
+        logging.error(f"Replay-only cache miss for {kind} {url}")
+        return None
+
+    text = fetch()
+    if text and isinstance(text, str) and (cacheable is None or cacheable(text)):
+        cache.put(kind, url, text)
+    return text
+
+
+async def cached_fetch_async(kind, url, fetch):
+    """Async counterpart of cached_fetch, `fetch` returns an awaitable"""
+    cache = get_page_cache()
+    if cache is None:
+        return await fetch()
+
+    text = cache.get(kind, url)
+    if text is not None:
+        return text
+    if cache.replay_only:
+        logging.error(f"Replay-only cache miss for {kind} {url}")
+        return None
+
+    text = await fetch()
+    if text and isinstance(text, str):
+        cache.put(kind, url, text)
+    return text
+
+
+def cache_stats_summary():
+    cache = get_page_cache()
+    if cache is None:
+        return "Page cache disabled"
+    stats = cache.stats
+    return (f"Page cache hits: {stats['hit']}, misses: {stats['miss']}, expired: {stats['expired']}, "
+            f"stored: {stats['store']}, evicted: {stats['evicted']}")
@@ -0,0 +1,193 @@
+import logging
+
+try:
+    from lxml import etree, html as lxml_html
+except ImportError:  # optional backend
+    lxml_html = None
+
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:  # optional backend
+    LexborHTMLParser = None
+
+DANISH_TO_ENGLISH = str.maketrans({
+    'æ': 'ae',
+    'ø': 'oe',
+    'å': 'aa',
+    'Æ': 'Ae',
+    'Ø': 'Oe',
+    'Å': 'Aa'
+})
+
+DETAIL_KEYS = {
+    "Sprog": "Language",
+    "Sidetal": "PageCount",
+    "Udgivelsesdato": "PublishedDate",
+    "ISBN13": "ISBN",
+    "Forlag": "Publisher",
+    "Format": "Format",
+}
+
+
+def has_class(name):
+    """XPath predicate matching elements with `name` among their classes"""
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+if lxml_html is not None:
+    XPATH_TITLE = etree.XPath('//h1[normalize-space(@class)="text-xl sm:text-l text-800 mb-0"]')
+    XPATH_AUTHOR_BOX = etree.XPath('(//div[normalize-space(@class)="text-s product-autor"])[1]')
+    XPATH_AUTHORS = etree.XPath('.//a[normalize-space(@class)="link link--black"]')
+    XPATH_DETAILS = etree.XPath(f'(//ul[{has_class("description-dot-list")}])[1]')
+    XPATH_DETAIL_ITEMS = etree.XPath('.//li')
+    XPATH_DETAIL_KEY = etree.XPath(f'(.//span[{has_class("text-700")}])[1]')
+    XPATH_DESCRIPTION = etree.XPath(f'(//p[{has_class("mb-0")}])[1]')
+    XPATH_RATING_BOX = etree.XPath(f'(//div[{has_class("product-rating")}])[1]')
+    XPATH_RATING = etree.XPath('(.//span[normalize-space(@class)="text-l text-800"])[1]')
+    XPATH_NUM_OF_RATINGS = etree.XPath(f'(.//span[{has_class("text-s")}])[1]')
+    XPATH_SLIDER = etree.XPath(f'((//div[@id="product-page-banner-container"])[1]'
+                               f'//div[{has_class("book-slick-slider")}])[1]')
+    XPATH_TEASERS = etree.XPath(".//div[starts-with(normalize-space(@class), 'new-teaser')"
+                                " or contains(concat(' ', normalize-space(@class)), ' new-teaser')]")
+    XPATH_COVER_LINK = etree.XPath(f'(.//a[{has_class("cover-container")}])[1]')
+
+# selectolax compiles selectors itself, these are the CSS equivalents of the XPaths above
+CSS_TITLE = 'h1[class="text-xl sm:text-l text-800 mb-0"]'
+CSS_AUTHOR_BOX = 'div[class="text-s product-autor"]'
+CSS_AUTHORS = 'a[class="link link--black"]'
+CSS_DETAILS = "ul.description-dot-list"
+CSS_DETAIL_KEY = "span.text-700"
+CSS_DESCRIPTION = "p.mb-0"
+CSS_RATING_BOX = "div.product-rating"
+CSS_RATING = 'span[class="text-l text-800"]'
+CSS_NUM_OF_RATINGS = "span.text-s"
+CSS_SLIDER = "#product-page-banner-container div.book-slick-slider"
+CSS_TEASERS = 'div[class^="new-teaser"], div[class*=" new-teaser"]'
+CSS_COVER_LINK = "a.cover-container"
+
+BACKENDS = tuple(name for name, module in (("lxml", lxml_html), ("selectolax", LexborHTMLParser)) if module is not None)
+
+
+def translate(text):
+    return text.translate(DANISH_TO_ENGLISH)
+
+
+def required(node, what):
+    if node is None:
+        raise AttributeError(f"The book page has no {what}")
+    return node
+
+
+def parse_rating(rating_text, num_of_ratings_text):
+    rating = float(rating_text.strip().replace(",", ".")) if rating_text is not None else 0
+    if num_of_ratings_text is not None:
+        num_of_ratings = num_of_ratings_text.strip().split(" ")[0]
+        num_of_ratings = int(num_of_ratings.replace("(", "").replace(")", ""))
+    else:
+        num_of_ratings = 0
+    return rating, num_of_ratings
+
+
+def add_detail(book_details, key, value):
+    if key in DETAIL_KEYS:
+        if DETAIL_KEYS[key] in ["PageCount"]:
+            value = int(value)
+        book_details[DETAIL_KEYS[key]] = value
+
+
+def build_details_dict(book_details, title, authors, rating, num_of_ratings, description, recommendations):
+    book_details["Title"] = title
+    book_details["Authors"] = authors
+    book_details["NumOfRatings"] = num_of_ratings
+    book_details["Rating"] = rating
+    book_details["Description"] = description
+    book_details["Recommendations"] = recommendations
+    return book_details
+
+
+def parse_book_page_lxml(book_page_html, with_recommendations=True):
+    tree = lxml_html.fromstring(book_page_html)
+
+    title = translate(required(first(XPATH_TITLE(tree)), "title").text_content().strip())
+    author_box = required(first(XPATH_AUTHOR_BOX(tree)), "author list")
+    authors = [translate("".join(text.strip() for text in tag.itertext())) for tag in XPATH_AUTHORS(author_box)]
+    description = required(first(XPATH_DESCRIPTION(tree)), "description").text_content().strip()
+
+    rating, num_of_ratings = 0, 0
+    rating_box = first(XPATH_RATING_BOX(tree))
+    if rating_box is not None:
+        rating_span = first(XPATH_RATING(rating_box))
+        num_of_ratings_span = first(XPATH_NUM_OF_RATINGS(rating_box))
+        rating, num_of_ratings = parse_rating(rating_span.text_content() if rating_span is not None else None,
+                                              num_of_ratings_span.text_content()
+                                              if num_of_ratings_span is not None else None)
+
+    book_details = {}
+    for li in XPATH_DETAIL_ITEMS(required(first(XPATH_DETAILS(tree)), "detail list")):
+        key_span = first(XPATH_DETAIL_KEY(li))
+        if key_span is not None:
+            key = key_span.text_content().strip()
+            key_span.drop_tree()  # keeps the text that follows the key
+            add_detail(book_details, key, li.text_content().strip())
+        if 'PageCount' not in book_details:
+            book_details['PageCount'] = 0
+
+    recommendations = []
+    slider = required(first(XPATH_SLIDER(tree)), "recommendation carousel") if with_recommendations else None
+    for teaser in XPATH_TEASERS(slider) if with_recommendations else []:
+        isbn = required(first(XPATH_COVER_LINK(teaser)), "cover link").get("data-product-identifier")
+        if isbn:
+            recommendations.append(isbn)
+        else:
+            logging.error("Failed to extract the recommendation from the book page.")
+
+    return build_details_dict(book_details, title, authors, rating, num_of_ratings, description, recommendations)
+
+
+def parse_book_page_selectolax(book_page_html, with_recommendations=True):
+    tree = LexborHTMLParser(book_page_html)
+
+    title = translate(required(tree.css_first(CSS_TITLE), "title").text(deep=True).strip())
+    author_box = required(tree.css_first(CSS_AUTHOR_BOX), "author list")
+    authors = [translate(tag.text(deep=True, separator="", strip=True)) for tag in author_box.css(CSS_AUTHORS)]
+    description = required(tree.css_first(CSS_DESCRIPTION), "description").text(deep=True).strip()
+
+    rating, num_of_ratings = 0, 0
+    rating_box = tree.css_first(CSS_RATING_BOX)
+    if rating_box is not None:
+        rating_span = rating_box.css_first(CSS_RATING)
+        num_of_ratings_span = rating_box.css_first(CSS_NUM_OF_RATINGS)
+        rating, num_of_ratings = parse_rating(rating_span.text(deep=True) if rating_span is not None else None,
+                                              num_of_ratings_span.text(deep=True)
+                                              if num_of_ratings_span is not None else None)
+
+    book_details = {}
+    for li in required(tree.css_first(CSS_DETAILS), "detail list").css("li"):
+        key_span = li.css_first(CSS_DETAIL_KEY)
+        if key_span is not None:
+            key = key_span.text(deep=True).strip()
+            key_span.decompose()
+            add_detail(book_details, key, li.text(deep=True).strip())
+        if 'PageCount' not in book_details:
+            book_details['PageCount'] = 0
+
+    recommendations = []
+    slider = required(tree.css_first(CSS_SLIDER), "recommendation carousel") if with_recommendations else None
+    for teaser in slider.css(CSS_TEASERS) if with_recommendations else []:
+        isbn = required(teaser.css_first(CSS_COVER_LINK), "cover link").attributes.get("data-product-identifier")
+        if isbn:
+            recommendations.append(isbn)
+        else:
+            logging.error("Failed to extract the recommendation from the book page.")
+
+    return build_details_dict(book_details, title, authors, rating, num_of_ratings, description, recommendations)
+
+
+def first(nodes):
+    return nodes[0] if nodes else None
+
+
+PARSERS = {
+    "lxml": parse_book_page_lxml,
+    "selectolax": parse_book_page_selectolax,
+}
@@ -0,0 +1,208 @@
+import logging
+import os
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from book_io import input_total, progress_message
+from bulk_writer import BATCH_SIZE
+from database import DONE, FAILED as JOB_FAILED, NOT_FOUND as JOB_NOT_FOUND
+from job_state import JobState
+from metrics import PARSE, SEARCH_MATCH, observe
+from scraping_common import fetch_book_page_html, parse_book_page, prepare_search_terms, \
+    query_saxo_with_title_or_isbn, step_find_book_in_search_results
+import scraping_common
+from scraping_sql import book_not_found_in_search_results_title, close_crawl_session, create_crawl_session, \
+    save_book_details_to_database
+
+FETCHERS = 4
+PARSE_WORKERS = os.cpu_count() or 2
+
+# kinds of work items passed between the stages
+SEARCH = "search"
+PAGE = "page"
+FOUND = "found"
+NOT_FOUND = "not_found"
+FAILED = "failed"
+STOP = None
+
+
+def match_search_results(search_page, author, title):
+    """Parser worker: pick the matching book from a search page and return its detail page URL or 'N/A',
+    with the seconds it took"""
+    start = time.perf_counter()
+    search_page_book_info = step_find_book_in_search_results(search_page, author, title)
+    if search_page_book_info == 'N/A' or not search_page_book_info:
+        return search_page_book_info, time.perf_counter() - start
+    return search_page_book_info["Url"], time.perf_counter() - start
+
+
+def parse_book_page_html(book_page_html, backend):
+    """Parser worker: turn a book page into the dict saved by scraping_sql, with the seconds it took"""
+    start = time.perf_counter()
+    return parse_book_page(book_page_html, backend=backend), time.perf_counter() - start
+
+
+class Pipeline:
+    """Fetch, parse and save books in three decoupled stages.
+
+    Fetcher threads only do network I/O and push raw html onto the parse queue. A dispatcher hands the html
+    to a ProcessPoolExecutor, so BeautifulSoup/lxml never hold up the fetchers, and routes each result
+    either back to the fetchers (the detail page of a matched search result) or to the single writer thread
+    that owns the database session. At most `max_in_flight` input rows are inside the pipeline at once,
+    which bounds every queue and keeps memory flat however long the input list is.
+
+    Recommended books go onto the crawl `frontier`: scraped inline, they would be fetched and parsed on the
+    writer thread and make it the bottleneck.
+    """
+
+    def __init__(self, fetchers=FETCHERS, parse_workers=PARSE_WORKERS, max_in_flight=None, batch_size=BATCH_SIZE,
+                 frontier=None):
+        if frontier is None:
+            raise ValueError("The pipeline engine queues recommended books on a crawl frontier, none was given")
+        self.fetchers = fetchers
+        self.parse_workers = parse_workers
+        self.max_in_flight = max_in_flight or 2 * (fetchers + parse_workers)
+        self.batch_size = batch_size
+        self.frontier = frontier
+        self.in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        self.fetch_queue = queue.Queue(maxsize=self.max_in_flight)
+        self.parse_queue = queue.Queue(maxsize=self.max_in_flight)
+        self.write_queue = queue.Queue(maxsize=self.max_in_flight)
+        self.parse_slots = threading.BoundedSemaphore(2 * parse_workers)
+
+    def run(self, book_info, job_state=None):
+        self.job_state = job_state or JobState()
+        parser_pool = ProcessPoolExecutor(max_workers=self.parse_workers)
+        fetcher_threads = [threading.Thread(target=self.fetch_loop, name=f"fetcher-{n}", daemon=True)
+                           for n in range(self.fetchers)]
+        dispatcher = threading.Thread(target=self.dispatch_loop, args=(parser_pool,), name="parse-dispatcher",
+                                      daemon=True)
+        writer = threading.Thread(target=self.write_loop, name="db-writer", daemon=True)
+        for thread in fetcher_threads + [dispatcher, writer]:
+            thread.start()
+
+        try:
+            self.produce(book_info)
+            # every row has been written once all in-flight slots are free again
+            for _ in range(self.max_in_flight):
+                self.in_flight.acquire()
+        finally:
+            for _ in fetcher_threads:
+                self.fetch_queue.put(STOP)
+            self.parse_queue.put(STOP)
+            self.write_queue.put(STOP)
+            for thread in fetcher_threads + [dispatcher, writer]:
+                thread.join()
+            parser_pool.shutdown(wait=True)
+
+    def produce(self, book_info):
+        total = input_total(book_info)
+        for row, title, author in book_info:
+            print(progress_message(row, total))
+            if not self.job_state.should_scrape(row):
+                print(f"Book {row} is {self.job_state.status(row)} in a previous session")
+                continue
+
+            self.in_flight.acquire()
+            self.job_state.start(row, title)
+            title, author = prepare_search_terms(title, author)
+            self.fetch_queue.put((SEARCH, row, title, author, None))
+
+    def fetch_loop(self):
+        while True:
+            item = self.fetch_queue.get()
+            if item is STOP:
+                return
+            kind, row, title, author, url = item
+            try:
+                if kind == SEARCH:
+                    self.parse_queue.put((SEARCH, row, title, author, query_saxo_with_title_or_isbn(title)))
+                else:
+                    book_page_html = fetch_book_page_html(url)
+                    if not book_page_html:
+                        raise ValueError(f"No book page at {url}")
+                    self.parse_queue.put((PAGE, row, title, author, book_page_html))
+            except Exception as e:
+                self.fail(row, title, author, e)
+
+    def dispatch_loop(self, parser_pool):
+        while True:
+            item = self.parse_queue.get()
+            if item is STOP:
+                return
+            kind, row, title, author, html = item
+            self.parse_slots.acquire()
+            if kind == SEARCH:
+                future = parser_pool.submit(match_search_results, html, author, title)
+            else:
+                future = parser_pool.submit(parse_book_page_html, html, scraping_common.parser_backend)
+            future.add_done_callback(lambda done, item=item: self.route(item, done))
+
+    def route(self, item, future):
+        """Send a parse result to the next stage"""
+        self.parse_slots.release()
+        kind, row, title, author, _ = item
+        try:
+            result, seconds = future.result()
+        except Exception as e:
+            self.fail(row, title, author, e)
+            return
+        # the parser processes have metrics of their own, so their timings are recorded here
+        observe(PARSE if kind == PAGE else SEARCH_MATCH, seconds)
+
+        if kind == PAGE:
+            result["Top10k"] = row
+            self.write_queue.put((FOUND, row, result))
+        elif result == 'N/A':
+            self.write_queue.put((NOT_FOUND, row, (title, author)))
+        elif not result:
+            self.fail(row, title, author, ValueError("Failed to parse the search results"))
+        else:
+            self.fetch_queue.put((PAGE, row, title, author, result))
+
+    def fail(self, row, title, author, error):
+        logging.error(f"Failed to scrape book {row}: {title} by {author}: {error}")
+        logging.error("".join(traceback.format_exception(type(error), error, error.__traceback__)))
+        self.write_queue.put((FAILED, row, str(error)))
+
+    def write_loop(self):
+        session = create_crawl_session(self.batch_size, self.frontier)
+        try:
+            while True:
+                item = self.write_queue.get()
+                if item is STOP:
+                    return
+                outcome, row, payload = item
+                try:
+                    if outcome == FOUND:
+                        logging.debug(payload)
+                        saved = save_book_details_to_database(payload, session)
+                        status, error = (DONE, None) if saved else (JOB_FAILED, "Saving the book failed")
+                    elif outcome == NOT_FOUND:
+                        book_not_found_in_search_results_title(*payload, session)
+                        status, error = JOB_NOT_FOUND, None
+                    else:
+                        print(f"Failed to scrape book {row}")
+                        status, error = JOB_FAILED, payload
+                    self.job_state.record(session, row, status, error)
+                except Exception as e:
+                    # the writer is the only thread saving results, it must outlive a bad row
+                    logging.error(f"Saving book {row}: {e}")
+                    logging.error(traceback.format_exc())
+                    session.rollback()
+                    try:
+                        self.job_state.record(session, row, JOB_FAILED, str(e))
+                    except Exception:
+                        logging.error(traceback.format_exc())
+                finally:
+                    self.in_flight.release()
+        finally:
+            close_crawl_session(session)
+
+
+def run_pipeline(book_info, fetchers=FETCHERS, parse_workers=PARSE_WORKERS, job_state=None, batch_size=BATCH_SIZE,
+                 frontier=None):
+    Pipeline(fetchers, parse_workers, batch_size=batch_size, frontier=frontier).run(book_info, job_state=job_state)
@@ -0,0 +1,220 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+
+import requests
+
+from metrics import count, get_metrics
+
+REQUESTS_PER_SECOND = float(os.environ.get("SAXO_RPS", 1.0))
+MAX_REQUESTS_PER_SECOND = float(os.environ.get("SAXO_MAX_RPS", 4.0))
+MIN_REQUESTS_PER_SECOND = 0.05
+# the rate grows by this much after every healthy response and is multiplied by SLOWDOWN on a throttled one
+SPEEDUP_STEP = 0.05
+SLOWDOWN = 0.5
+
+MAX_RETRIES = 4
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+# consecutive failures that open the circuit, and how long it stays open
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 120.0
+# while the half-open circuit's probe request is out, other requests check this often whether it came back;
+# a probe that never reports back is given up on after PROBE_TIMEOUT
+PROBE_POLL_INTERVAL = 0.05
+PROBE_TIMEOUT = 60.0
+
+# states of the circuit breaker
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# responses that mean "slow down" rather than "this page does not exist"
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+class AdaptiveRateLimiter:
+    """Token bucket shared by every request to Saxo.com, whether it is sent over HTTP or by a browser.
+
+    Each request reserves the next free slot in the schedule, so the limiter works for threads (acquire) and
+    coroutines (acquire_async) alike. The rate increases additively while responses are healthy, up to
+    `max_rate`, and is halved when Saxo answers with 429 or a 5xx. A Retry-After header pauses every request.
+    After `breaker_threshold` consecutive failures the circuit opens and nothing is sent for
+    `breaker_cooldown` seconds. Then it is half open: a single probe request goes out while every other
+    request waits for its outcome. A success closes the circuit, a failure opens it again right away.
+    """
+
+    def __init__(self, requests_per_second=REQUESTS_PER_SECOND, max_rate=MAX_REQUESTS_PER_SECOND,
+                 min_rate=MIN_REQUESTS_PER_SECOND, breaker_threshold=BREAKER_THRESHOLD,
+                 breaker_cooldown=BREAKER_COOLDOWN):
+        self.rate = requests_per_second
+        self.max_rate = max(max_rate, requests_per_second)
+        self.min_rate = min(min_rate, requests_per_second)
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.consecutive_failures = 0
+        self.throttled = 0
+        self.circuit_opened = 0
+        self._next_slot = time.monotonic()
+        self._paused_until = 0.0
+        self._open_until = None
+        self._probe_sent_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def circuit_state(self):
+        if self._open_until is None:
+            return CLOSED
+        return OPEN if time.monotonic() < self._open_until else HALF_OPEN
+
+    def reserve(self):
+        """Claim the next request slot. Return (granted, seconds): after waiting that many seconds the request
+        may go out if granted; if not, the circuit is open or its probe is out and the caller asks again."""
+        with self._lock:
+            now = time.monotonic()
+            if self._open_until is not None:
+                if now < self._open_until:
+                    return False, self._open_until - now
+                if self._probe_sent_at is not None and now - self._probe_sent_at < PROBE_TIMEOUT:
+                    return False, PROBE_POLL_INTERVAL
+                self._probe_sent_at = now
+            slot = max(now, self._next_slot, self._paused_until)
+            self._next_slot = slot + 1 / self.rate
+            return True, slot - now
+
+    def acquire(self):
+        while True:
+            granted, delay = self.reserve()
+            if delay > 0:
+                time.sleep(delay)
+            if granted:
+                return
+
+    async def acquire_async(self):
+        while True:
+            granted, delay = self.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if granted:
+                return
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.rate = min(self.max_rate, self.rate + SPEEDUP_STEP)
+            if self._open_until is not None and time.monotonic() >= self._open_until:
+                self._open_until = None
+                self._probe_sent_at = None
+
+    def record_throttle(self, retry_after=None):
+        """Saxo asked us to slow down: halve the rate and honour its Retry-After"""
+        with self._lock:
+            self.throttled += 1
+            self.rate = max(self.min_rate, self.rate * SLOWDOWN)
+            if retry_after:
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            self._count_failure()
+
+    def record_failure(self):
+        """A request failed without a response (timeout, connection error, browser crash)"""
+        with self._lock:
+            self._count_failure()
+
+    def record_status(self, status_code, retry_after=None):
+        if status_code in RETRY_STATUSES:
+            self.record_throttle(retry_after)
+        else:
+            self.record_success()
+
+    def _count_failure(self):
+        now = time.monotonic()
+        if self._open_until is not None:
+            # requests sent before the circuit opened don't extend the pause, a failed probe reopens it
+            if now >= self._open_until:
+                self._open_circuit(now, "The circuit breaker's probe request failed")
+            return
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.breaker_threshold:
+            self._open_circuit(now, f"{self.consecutive_failures} failed requests in a row")
+
+    def _open_circuit(self, now, reason):
+        logging.error(f"{reason}, pausing for {self.breaker_cooldown:.0f}s")
+        self.circuit_opened += 1
+        count("circuit_opened")
+        self.consecutive_failures = 0
+        self._open_until = now + self.breaker_cooldown
+        self._probe_sent_at = None
+        self._paused_until = max(self._paused_until, self._open_until)
+
+    def stats(self):
+        return {"rate": round(self.rate, 3), "throttled": self.throttled, "circuit_opened": self.circuit_opened,
+                "circuit": self.circuit_state}
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_MAX):
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def parse_retry_after(value):
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def get_with_retries(session, url, timeout, max_retries=MAX_RETRIES, limiter=None, headers=None):
+    """GET `url` through the rate limiter, retrying throttled responses and network errors.
+
+    Returns the last response; raises the last requests.RequestException when no attempt got one.
+    """
+    limiter = limiter or get_rate_limiter()
+    for attempt in range(max_retries + 1):
+        limiter.acquire()
+        try:
+            response = session.get(url, timeout=timeout, headers=headers)
+        except requests.RequestException as e:
+            limiter.record_failure()
+            if attempt == max_retries:
+                raise
+            count("retries", reason="error")
+            logging.warning(f"Request to {url} failed ({e}), retrying")
+        else:
+            limiter.record_status(response.status_code, parse_retry_after(response.headers.get("Retry-After")))
+            if response.status_code not in RETRY_STATUSES or attempt == max_retries:
+                return response
+            count("retries", reason=str(response.status_code))
+            logging.warning(f"Saxo.com answered {response.status_code} for {url}, retrying")
+        time.sleep(backoff_delay(attempt))
+
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = AdaptiveRateLimiter()
+        return _rate_limiter
+
+
+get_metrics().gauge("request_rate", lambda: get_rate_limiter().rate)
+
+
+def rate_limiter_summary():
+    stats = get_rate_limiter().stats()
+    return (f"Request rate at the end: {stats['rate']}/s, throttled responses: {stats['throttled']}, "
+            f"circuit opened: {stats['circuit_opened']} times")
+
+
+def configure_rate_limiter(requests_per_second=REQUESTS_PER_SECOND, max_rate=MAX_REQUESTS_PER_SECOND, **kwargs):
+    global _rate_limiter
+    with _rate_limiter_lock:
+        _rate_limiter = AdaptiveRateLimiter(requests_per_second, max_rate, **kwargs)
+        return _rate_limiter
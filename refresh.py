@@ -0,0 +1,304 @@
+import heapq
+import logging
+import math
+import time
+import traceback
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import bindparam, func, select
+
+from bulk_writer import BATCH_SIZE
+from database import Author, Book, book_author, get_engine, recommendation_table
+from metrics import count
+from rate_limiter import get_with_retries
+from scraping_common import FETCH_MODE_BROWSER, HTTP_TIMEOUT, build_search_url, fetch_book_page_uncached, \
+    get_http_session, has_book_page_data, load_lazy_recommendations, parse_book_page, \
+    step_find_book_in_search_results
+from scraping_sql import AUTHORS, ISBN, RECOMMENDATIONS, TOP10K, book_content_hash, book_row
+from storage import get_storage
+
+# seconds a book of average popularity goes unchecked; more popular books are due proportionally sooner
+REFRESH_INTERVAL = 7 * 24 * 3600
+REFRESH_LIMIT = 1000
+REFRESH_WORKERS = 4
+# a top10k book counts as this many extra recommendations-worth of popularity, scaled down with its rank
+TOP10K_WEIGHT = 2.0
+TOP10K_SIZE = 10000
+
+# outcomes of refreshing a book
+NOT_MODIFIED = "not_modified"
+UNCHANGED = "unchanged"
+CHANGED = "changed"
+GONE = "gone"
+SUPERSEDED = "superseded"
+FAILED = "failed"
+
+# columns of the book table a refresh compares and updates; authors are diffed in book_author
+REFRESH_COLUMNS = ("title", "page_count", "published_date", "publisher", "format", "num_of_ratings", "rating",
+                   "description")
+AUTHORS_COLUMN = "authors"
+
+book_table = Book.__table__
+
+
+def popularity(top10k, in_degree):
+    score = 1 + math.log1p(in_degree)
+    if top10k and top10k > 0:
+        score += TOP10K_WEIGHT * max(0.0, 1 - (top10k - 1) / TOP10K_SIZE)
+    return score
+
+
+def schedule_refresh(engine=None, limit=REFRESH_LIMIT, interval=REFRESH_INTERVAL, now=None):
+    """Return up to `limit` books due for a refresh, most overdue first.
+
+    A book is due once its age times its popularity reaches `interval`; popularity grows with the number of
+    books recommending it and with a top10k rank. Books last scraped before refreshes existed have no
+    scrape time and are the most overdue. Books saved as not found, and books whose ISBN now leads to another
+    book, are left out.
+    """
+    now = now or time.time()
+    with (engine or get_engine()).connect() as connection:
+        in_degree = dict(connection.execute(select(recommendation_table.c.recommended_isbn, func.count())
+                                            .group_by(recommendation_table.c.recommended_isbn)).fetchall())
+        has_recommendations = set(connection.execute(select(recommendation_table.c.book_isbn).distinct()).scalars())
+        rows = connection.execution_options(stream_results=True).execute(
+            select(book_table.c.isbn, book_table.c.top10k, book_table.c.last_scraped_at, book_table.c.content_hash,
+                   book_table.c.etag, book_table.c.last_modified)
+            .where(book_table.c.title != 'N/A').where(book_table.c.superseded_by.is_(None)))
+
+        def due():
+            for isbn, top10k, last_scraped_at, content_hash, etag, last_modified in rows:
+                priority = (now - (last_scraped_at or 0)) * popularity(top10k, in_degree.get(isbn, 0))
+                if priority >= interval:
+                    yield {"isbn": isbn, "priority": priority, "content_hash": content_hash, "etag": etag,
+                           "last_modified": last_modified,
+                           "with_recommendations": isbn in has_recommendations or bool(top10k and top10k > 0)}
+
+        return heapq.nlargest(limit, due(), key=lambda stale: stale["priority"])
+
+
+def fetch_current_page(stale):
+    """Fetch the book page of a stale book from Saxo.com, bypassing the page cache.
+
+    The ISBN search is sent with the validators stored for the book, so an unchanged page may come back as
+    304 and NOT_MODIFIED is returned. Returns None when Saxo no longer has the ISBN, otherwise the html with
+    the response's ETag and Last-Modified. A lazily loaded carousel is filled in from the page already
+    fetched; only a page without its source goes to the browser.
+    """
+    headers = {}
+    if stale["etag"]:
+        headers["If-None-Match"] = stale["etag"]
+    if stale["last_modified"]:
+        headers["If-Modified-Since"] = stale["last_modified"]
+    response = get_with_retries(get_http_session(), build_search_url(stale["isbn"]), HTTP_TIMEOUT,
+                                headers=headers or None)
+    if response.status_code == 304:
+        return NOT_MODIFIED
+    etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+
+    page_url, mode = response.url, None
+    if response.status_code == 200 and 'query' in response.url:
+        # several results for the ISBN, like create_browser_and_wait_for_page_load's redirect case
+        match = step_find_book_in_search_results(response.text)
+        if match == 'N/A':
+            return None
+        if not match:
+            raise ValueError("Failed to parse the search results")
+        page_url = match["Url"]
+    elif response.status_code == 200:
+        if has_book_page_data(response.text, stale["with_recommendations"]):
+            return response.text, etag, last_modified
+        html = load_lazy_recommendations(response.text, page_url, get_http_session())
+        if html:
+            return html, etag, last_modified
+        # the page was just fetched over HTTP, only a browser can render its carousel
+        mode = FETCH_MODE_BROWSER
+
+    html = fetch_book_page_uncached(page_url, mode, with_recommendations=stale["with_recommendations"])
+    if not html:
+        raise ValueError(f"Failed to load the book page {page_url}")
+    return html, etag, last_modified
+
+
+def check_book(stale):
+    """Worker: fetch and parse a stale book. Return the outcome, the parsed details and the validators.
+
+    When Saxo shows another book under the ISBN, SUPERSEDED is returned with that book's details.
+    """
+    try:
+        fetched = fetch_current_page(stale)
+        if fetched == NOT_MODIFIED:
+            return NOT_MODIFIED, None, (stale["etag"], stale["last_modified"])
+        if fetched is None:
+            return GONE, None, (None, None)
+        html, etag, last_modified = fetched
+        book_details_dict = parse_book_page(html, with_recommendations=stale["with_recommendations"])
+    except Exception as e:
+        logging.error(f"Refreshing the book with ISBN {stale['isbn']}: {e}")
+        logging.error(traceback.format_exc())
+        return FAILED, None, None
+
+    book_details_dict[TOP10K] = 0
+    if book_details_dict[ISBN] != stale["isbn"]:
+        logging.warning(f"Refreshing {stale['isbn']} found the page of {book_details_dict[ISBN]}")
+        return SUPERSEDED, book_details_dict, None
+    if book_content_hash(book_details_dict) == stale["content_hash"]:
+        return UNCHANGED, None, (etag, last_modified)
+    return CHANGED, book_details_dict, (etag, last_modified)
+
+
+class Refresher:
+    """Re-scrape stale books and write back only what changed.
+
+    Pages are fetched and parsed by `workers` threads, paced by the shared rate limiter. An unchanged book,
+    by 304 or by content hash, only gets its scrape time updated. For a changed book the columns whose
+    values differ are updated in place, and its authors and recommendation edges are diffed: new pairs are
+    inserted, pairs Saxo no longer shows are deleted. With a frontier, newly recommended ISBNs are queued on it.
+    A book whose ISBN leads to another book's page is marked superseded by that ISBN once, and not checked
+    again. Writes are batched, `batch_size` books per transaction.
+    """
+
+    def __init__(self, engine=None, workers=REFRESH_WORKERS, batch_size=BATCH_SIZE, frontier=None):
+        self.engine = engine or get_engine()
+        self.storage = get_storage(self.engine)
+        self.workers = workers
+        self.batch_size = batch_size
+        self.frontier = frontier
+        self.outcomes = Counter()
+        self.changed_columns = Counter()
+        self.edges = Counter()
+        self._touched = {}
+        self._changed = {}
+        self._superseded = {}
+
+    def run(self, stale_books):
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="refresh") as pool:
+            for stale, (outcome, book_details_dict, validators) in zip(stale_books,
+                                                                        pool.map(check_book, stale_books)):
+                self.outcomes[outcome] += 1
+                count("refresh", outcome=outcome)
+                if outcome == CHANGED:
+                    self._changed[stale["isbn"]] = (book_details_dict, validators)
+                elif outcome == SUPERSEDED:
+                    self._superseded[stale["isbn"]] = book_details_dict[ISBN]
+                elif outcome != FAILED:
+                    self._touched[stale["isbn"]] = validators
+                if len(self._touched) + len(self._changed) + len(self._superseded) >= self.batch_size:
+                    self.flush()
+        self.flush()
+        return self.outcomes
+
+    def flush(self):
+        if not self._touched and not self._changed and not self._superseded:
+            return
+        now = time.time()
+        new_isbns = {}
+        with self.engine.begin() as connection:
+            if self._touched:
+                connection.execute(book_table.update().where(book_table.c.isbn == bindparam("b_isbn"))
+                                   .values(last_scraped_at=now, etag=bindparam("b_etag"),
+                                           last_modified=bindparam("b_last_modified")),
+                                   [{"b_isbn": isbn, "b_etag": etag, "b_last_modified": last_modified}
+                                    for isbn, (etag, last_modified) in self._touched.items()])
+            if self._superseded:
+                connection.execute(book_table.update().where(book_table.c.isbn == bindparam("b_isbn"))
+                                   .values(last_scraped_at=now, superseded_by=bindparam("b_superseded_by")),
+                                   [{"b_isbn": isbn, "b_superseded_by": superseded_by}
+                                    for isbn, superseded_by in self._superseded.items()])
+            if self._changed:
+                new_isbns = self._write_changes(connection, now)
+        self._touched.clear()
+        self._changed.clear()
+        self._superseded.clear()
+
+        if self.frontier is not None:
+            for parent_isbn, isbns in new_isbns.items():
+                self.frontier.push(isbns, 1, parent_isbn)
+
+    def _write_changes(self, connection, now):
+        """Update the changed columns and recommendation edges of the changed books; return the newly
+        recommended ISBNs by the book recommending them"""
+        isbns = list(self._changed)
+        current = {row.isbn: row for row in connection.execute(
+            select(book_table.c.isbn, *[book_table.c[column] for column in REFRESH_COLUMNS])
+            .where(book_table.c.isbn.in_(isbns)))}
+        current_edges = {}
+        for book_isbn, recommended_isbn in connection.execute(
+                select(recommendation_table.c.book_isbn, recommendation_table.c.recommended_isbn)
+                .where(recommendation_table.c.book_isbn.in_(isbns))):
+            current_edges.setdefault(book_isbn, set()).add(recommended_isbn)
+        current_authors = {}
+        for book_isbn, author_name in connection.execute(
+                select(book_author.c.book_isbn, book_author.c.author_name).where(book_author.c.book_isbn.in_(isbns))):
+            current_authors.setdefault(book_isbn, set()).add(author_name)
+
+        updates = {}
+        added, removed, new_isbns = [], [], {}
+        authors_added, authors_removed = [], []
+        for isbn, (book_details_dict, (etag, last_modified)) in self._changed.items():
+            new_row = book_row(book_details_dict)
+            old_row = current.get(isbn)
+            columns = tuple(column for column in REFRESH_COLUMNS
+                            if old_row is None or has_changed(old_row._mapping[column], new_row[column]))
+            new_authors = set(book_details_dict[AUTHORS])
+            old_authors = current_authors.get(isbn, set())
+            authors_added += [{"book_isbn": isbn, "author_name": name} for name in new_authors - old_authors]
+            authors_removed += [{"b_book_isbn": isbn, "b_author_name": name} for name in old_authors - new_authors]
+            changed = columns + ((AUTHORS_COLUMN,) if new_authors != old_authors else ())
+            self.changed_columns.update(changed)
+            for column in changed:
+                count("refresh_columns", column=column)
+            values = {column: new_row[column] for column in columns}
+            values.update(content_hash=new_row["content_hash"], last_scraped_at=now, etag=etag,
+                          last_modified=last_modified)
+            updates.setdefault(tuple(values), []).append(dict({"b_isbn": isbn}, **values))
+
+            if book_details_dict[RECOMMENDATIONS] or current_edges.get(isbn):
+                new_edges = set(book_details_dict[RECOMMENDATIONS])
+                old_edges = current_edges.get(isbn, set())
+                added += [{"book_isbn": isbn, "recommended_isbn": recommended}
+                          for recommended in new_edges - old_edges]
+                removed += [{"b_book_isbn": isbn, "b_recommended_isbn": recommended}
+                            for recommended in old_edges - new_edges]
+                if new_edges - old_edges:
+                    new_isbns[isbn] = sorted(new_edges - old_edges)
+
+        for columns, rows in updates.items():
+            # bind parameters can't share a column's name in an UPDATE ... WHERE
+            connection.execute(book_table.update().where(book_table.c.isbn == bindparam("b_isbn"))
+                               .values({column: bindparam(f"v_{column}") for column in columns}),
+                               [{"b_isbn": row["b_isbn"], **{f"v_{column}": row[column] for column in columns}}
+                                for row in rows])
+        self.storage.insert_ignore(connection, Author.__table__,
+                                   [{"name": name} for name in {row["author_name"] for row in authors_added}])
+        self.storage.insert_ignore(connection, book_author, authors_added)
+        if authors_removed:
+            connection.execute(book_author.delete()
+                               .where(book_author.c.book_isbn == bindparam("b_book_isbn"))
+                               .where(book_author.c.author_name == bindparam("b_author_name")),
+                               authors_removed)
+        self.storage.insert_ignore(connection, recommendation_table, added)
+        if removed:
+            connection.execute(recommendation_table.delete()
+                               .where(recommendation_table.c.book_isbn == bindparam("b_book_isbn"))
+                               .where(recommendation_table.c.recommended_isbn == bindparam("b_recommended_isbn")),
+                               removed)
+        self.edges.update(added=len(added), removed=len(removed))
+        count("refresh_edges", len(added), change="added")
+        count("refresh_edges", len(removed), change="removed")
+        return new_isbns
+
+    def summary(self):
+        return (f"Refreshed {sum(self.outcomes.values())} books: {dict(self.outcomes)}, changed columns: "
+                f"{dict(self.changed_columns)}, recommendation edges added: {self.edges['added']}, "
+                f"removed: {self.edges['removed']}")
+
+
+def has_changed(old, new):
+    """Compare a stored value with a scraped one; SQLite returns ratings stored in a text column as text"""
+    if old == new:
+        return False
+    if old is None or new is None:
+        return True
+    return str(old) != str(new)
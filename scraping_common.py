@@ -1,20 +1,56 @@
 import logging
 import os
-import re
-import time
-import json
+import threading
 import traceback
-from random import randint
+from collections import Counter
+from urllib.parse import urljoin
 
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
-import pandas as pd
-from selenium.webdriver import Chrome
-from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.by import By
-from selenium.common.exceptions import TimeoutException
+from selenium.common.exceptions import TimeoutException, WebDriverException
+
+from book_matcher import find_book_in_search_results
+from browser_pool import get_browser_pool
+from metrics import DETAIL_HTTP, PAGE_LOAD, PAGE_READY_WAIT, PARSE, SEARCH_HTTP, SEARCH_MATCH, count, timed, timer
+from page_cache import PAGE, SEARCH, cached_fetch
+from page_parser import BACKENDS, PARSERS
+from rate_limiter import get_rate_limiter, get_with_retries
+
+# "browser" renders every detail page in Chrome, "http" fetches the raw page first and only renders it
+# when the book details or the recommendation carousel are missing from the raw HTML
+FETCH_MODE_BROWSER = "browser"
+FETCH_MODE_HTTP = "http"
+FETCH_MODES = (FETCH_MODE_BROWSER, FETCH_MODE_HTTP)
+fetch_mode = os.environ.get("SAXO_FETCH_MODE", FETCH_MODE_BROWSER)
+
+# where searches are sent; benchmarks point it at a local server replaying recorded pages
+SAXO_URL = os.environ.get("SAXO_BASE_URL", "https://www.saxo.com").rstrip("/")
+
+HTTP_TIMEOUT = 20
+# a slide of the recommendation carousel, see extract_recommendations_list
+RECOMMENDATION_SELECTOR = "#product-page-banner-container .book-slick-slider [data-product-identifier]"
+# what a raw book page has when it can be parsed without a browser, see has_book_page_data
+TITLE_MARKER = "text-xl sm:text-l text-800 mb-0"
+CAROUSEL_MARKER = "book-slick-slider"
+SLIDE_MARKER = "data-product-identifier"
+HTTP_POOL_SIZE = 16
+HTTP_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36",
+    "Accept-Language": "da-DK,da;q=0.9,en;q=0.8",
+}
+
+# "bs4" is the original BeautifulSoup parser, "lxml" and "selectolax" parse the page in a single pass
+PARSER_BACKENDS = ("bs4",) + BACKENDS
+parser_backend = os.environ.get("SAXO_PARSER", "lxml" if "lxml" in BACKENDS else "bs4")
+
+# how detail pages were obtained: "http", "browser" (browser mode) and "browser_fallback" (http mode)
+fetch_stats = Counter()
+_fetch_stats_lock = threading.Lock()
+_http_session = None
+_http_session_lock = threading.Lock()
 
 
 def translate_danish_to_english(text):
@@ -33,10 +69,30 @@ def translate_danish_to_english(text):
     return text
 
 
+def prepare_search_terms(title, author):
+    """Normalize an input row's title and author before searching for the book"""
+    title = translate_danish_to_english(title)
+    author = translate_danish_to_english(author) if isinstance(author, str) else None
+    return title, author
+
+
+def build_search_url(title):
+    return f"{SAXO_URL}/dk/products/search?query={title.replace(' ', '+')}"
+
+
 def query_saxo_with_title_or_isbn(title):
     """Search for the book on Saxo.com """
-    search_url = f"https://www.saxo.com/dk/products/search?query={title.replace(' ', '+')}"
-    response = requests.get(search_url)
+    search_url = build_search_url(title)
+    return cached_fetch(SEARCH, search_url, lambda: fetch_search_page(search_url))
+
+
+@timed(SEARCH_HTTP)
+def fetch_search_page(search_url):
+    try:
+        response = get_with_retries(get_http_session(), search_url, HTTP_TIMEOUT)
+    except requests.RequestException as e:
+        logging.error(f"Failed to fetch search results from Saxo.com: {e}")
+        return None
 
     if response.status_code == 200:
         return response.text
@@ -46,72 +102,51 @@ def query_saxo_with_title_or_isbn(title):
         return None
 
 
-def normalize_author_name(name):
-    # Remove common business entity suffixes and punctuation
-    suffixes = ['Ltd', 'Inc', 'Co', 'LLC', 'LLP', 'PLC']
-    pattern = r'\b(?:' + '|'.join(suffixes) + r')\.?\b'
-    name = re.sub(pattern, '', name, flags=re.IGNORECASE)
-
-    # Remove any parenthesized content
-    name = re.sub(r'\(.*?\)', '', name)
-
-    # Remove any remaining punctuation and extra whitespace
-    name = re.sub(r'[^\w\s]', '', name)
-    name = re.sub(r'\s+', ' ', name).strip()
-
-    return name.lower()
-
-
-def is_book_correct(author_local, book_parsed):
-    """Parse the first author and compare it to the extracted authors. Return True if the names match."""
-    author_local = translate_danish_to_english(author_local.lower().replace('"', "").split(',')[0])
-    author_local_normalized = normalize_author_name(author_local)
+@timed(SEARCH_MATCH)
+def step_find_book_in_search_results(html_content_search_page, author=None, title=None):
+    """Parse the search page and rank its books against the author and title. Return the best match if any
+    matches, 'N/A' if none does and False if the page can't be parsed."""
+    return find_book_in_search_results(html_content_search_page, author, title)
 
-    author_extracted = [translate_danish_to_english(auth.lower()) for auth in list(book_parsed["Authors"])]
-    author_extracted_normalized = [normalize_author_name(auth) for auth in author_extracted]
 
-    return author_local_normalized in author_extracted_normalized  # and book_parsed["Work"] in ["Bog"]
-
-
-def step_find_book_in_search_results(html_content_search_page, author=None, title=None):
-    """Parse the search page and find the book's detail page link. Return it if found. Otherwise, return None."""
-    try:
-        soup_search_page = BeautifulSoup(html_content_search_page, "html.parser")
-        for book in soup_search_page.find_all("div", class_="product-list-teaser"):
-            book_parsed = translate_danish_to_english(book.find("a").get("data-val"))
-            book_parsed = json.loads(book_parsed)
-            # verify that the book matches the search criteria (author and paperbook)
-            if author is None or is_book_correct(author, book_parsed):
-                # print(book_parsed)
-                return book_parsed
-
-        return 'N/A'
-
-    except:
-        logging.error(f"Failed to parse the search results. Title: {title}, Author: {author}")
-        return False
+def carousel_ready(driver):
+    """The page is ready once the carousel holds a recommendation, or once it loaded without any"""
+    if driver.find_elements(By.CSS_SELECTOR, RECOMMENDATION_SELECTOR):
+        return True
+    return (bool(driver.find_elements(By.CLASS_NAME, "book-slick-slider"))
+            and driver.execute_script('return document.readyState') == 'complete')
 
 
 def create_browser_and_wait_for_page_load(book_detail_page_url):
-    """Create a browser and wait for the page to load, then return the page source"""
-    chrome_options = Options()
-    chrome_options.add_argument("--headless")
-    with Chrome(options=chrome_options) as browser:
-        browser.get(book_detail_page_url)
+    """Check out a pooled browser and wait for the page to load, then return the page source"""
+    limiter = get_rate_limiter()
+    with get_browser_pool().browser() as browser:
+        limiter.acquire()
+        try:
+            with timer(PAGE_LOAD):
+                browser.get(book_detail_page_url)
+        except WebDriverException:
+            limiter.record_failure()
+            raise
+        # the server answered; this also settles a probe of the half-open circuit
+        limiter.record_success()
 
         # case when the book isbn search yields multiple results
         is_url_redirected = 'query' in browser.current_url
-        print(browser.current_url)
         logging.info(f"URL: {book_detail_page_url}, Redirected: {is_url_redirected}")
         if is_url_redirected:
+            count("isbn_redirects")
             return False
 
         try:
-            WebDriverWait(browser, 20).until(lambda d: d.execute_script('return document.readyState') == 'complete')
-            WebDriverWait(browser, 20).until(EC.presence_of_element_located((By.CLASS_NAME, "book-slick-slider")))
+            with timer(PAGE_READY_WAIT):
+                WebDriverWait(browser, 20).until(carousel_ready)
             html = browser.page_source
+            # the page may still be loading; stop it rather than let it run on in the idle browser
+            browser.execute_script("window.stop()")
         except TimeoutException:
-            print('kurdefiks')
+            # the server answered, the page just never showed the carousel: not a reason to back off
+            count("page_ready_timeouts")
             logging.error(f"Failed to load the page. URL: {book_detail_page_url}")
             logging.error(traceback.format_exc())
             html = ""
@@ -119,10 +154,167 @@ def create_browser_and_wait_for_page_load(book_detail_page_url):
     return html
 
 
-def extract_book_details_dict(book_page_html):
-    """ Scrape the book's details and recommendations from its page """
+def set_fetch_mode(mode):
+    global fetch_mode
+    if mode not in FETCH_MODES:
+        raise ValueError(f"Unknown fetch mode {mode}, expected one of {FETCH_MODES}")
+    fetch_mode = mode
+
+
+def get_http_session():
+    """Return the shared requests.Session with a connection pool sized for concurrent fetches"""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update(HTTP_HEADERS)
+            _http_session = session
+        return _http_session
+
+
+def record_fetch(source):
+    with _fetch_stats_lock:
+        fetch_stats[source] += 1
+    count("detail_fetches", source=source)
+
+
+def fetch_stats_summary():
+    """Describe how many detail pages needed the browser"""
+    with _fetch_stats_lock:
+        http, fallback, browser = fetch_stats["http"], fetch_stats["browser_fallback"], fetch_stats["browser"]
+    attempted = http + fallback
+    fallback_rate = 100 * fallback / attempted if attempted else 0
+    return (f"Detail pages over HTTP: {http}, browser fallbacks: {fallback} ({fallback_rate:.1f}%), "
+            f"browser only: {browser}")
+
+
+def fetch_book_page_html(book_detail_page_url, mode=None, with_recommendations=True):
+    """Return the book page html in the configured fetch mode.
+
+    Follows the create_browser_and_wait_for_page_load contract: False when the URL lands on a search page
+    with multiple results, an empty string when the page could not be loaded. Without `with_recommendations`
+    a raw page lacking the recommendation carousel is good enough, but it is not cached: the cache is keyed
+    by URL and a later fetch of the same URL may need the carousel.
+    """
+    html = cached_fetch(PAGE, book_detail_page_url,
+                        lambda: fetch_book_page_uncached(book_detail_page_url, mode, with_recommendations),
+                        cacheable=has_book_page_data)
+    return "" if html is None else html
+
+
+def fetch_book_page_uncached(book_detail_page_url, mode=None, with_recommendations=True):
+    mode = mode or fetch_mode
+    if mode == FETCH_MODE_BROWSER:
+        record_fetch("browser")
+        return create_browser_and_wait_for_page_load(book_detail_page_url)
+
+    html = fetch_book_page_over_http(book_detail_page_url, with_recommendations)
+    if html or html is False:
+        record_fetch("http")
+        return html
+
+    record_fetch("browser_fallback")
+    logging.info(f"Falling back to the browser for {book_detail_page_url}")
+    return create_browser_and_wait_for_page_load(book_detail_page_url)
+
+
+@timed(DETAIL_HTTP)
+def fetch_book_page_over_http(book_detail_page_url, with_recommendations=True):
+    """Fetch the raw book page. Return None when the page lacks the data that otherwise needs a browser, and
+    False when an ISBN search stays on the search page because it has several results."""
+    session = get_http_session()
+    try:
+        response = get_with_retries(session, book_detail_page_url, HTTP_TIMEOUT)
+    except requests.RequestException as e:
+        logging.error(f"Failed to fetch {book_detail_page_url} over HTTP: {e}")
+        return None
+    if response.status_code != 200:
+        return None
+    if 'query' in response.url:
+        count("isbn_redirects")
+        return False
+
+    html = response.text
+    if has_book_page_data(html, with_recommendations):
+        return html
+    return load_lazy_recommendations(html, response.url, session)
 
+
+def has_book_page_data(book_page_html, with_recommendations=True):
+    """Check that the raw html has the book title and, when wanted, a slide in the recommendation carousel.
+
+    Only looks for the markers parse_book_page relies on; the page is parsed once, downstream.
+    """
+    if not book_page_html or TITLE_MARKER not in book_page_html:
+        return False
+    if not with_recommendations:
+        return True
+    carousel = book_page_html.find(CAROUSEL_MARKER)
+    return carousel >= 0 and book_page_html.find(SLIDE_MARKER, carousel) >= 0
+
+
+def load_lazy_recommendations(book_page_html, page_url, session):
+    """Fill an empty recommendation carousel from the URL it loads its slides from.
+
+    Return the page with the slides spliced in, or None if the carousel has no such source.
+    """
     soup = BeautifulSoup(book_page_html, "html.parser")
+    if soup.find("h1", class_="text-xl sm:text-l text-800 mb-0") is None:
+        return None
+    container = soup.find("div", id="product-page-banner-container")
+    source = container.find(attrs={"data-url": True}) if container else None
+    if source is None:
+        return None
+
+    try:
+        response = get_with_retries(session, urljoin(page_url, source["data-url"]), HTTP_TIMEOUT)
+    except requests.RequestException as e:
+        logging.error(f"Failed to fetch the recommendations of {page_url}: {e}")
+        return None
+    if response.status_code != 200 or "html" not in response.headers.get("Content-Type", ""):
+        return None
+
+    slider = container.find("div", class_="book-slick-slider")
+    if slider is None:
+        slider = soup.new_tag("div", attrs={"class": "book-slick-slider"})
+        source.append(slider)
+    slider.append(BeautifulSoup(response.text, "html.parser"))
+    html = str(soup)
+    return html if has_book_page_data(html) else None
+
+
+def set_parser_backend(backend):
+    global parser_backend
+    if backend not in PARSER_BACKENDS:
+        raise ValueError(f"Unknown parser backend {backend}, expected one of {PARSER_BACKENDS}")
+    parser_backend = backend
+
+
+@timed(PARSE)
+def parse_book_page(book_page_html, with_recommendations=True, backend=None):
+    """Parse the book page once and return its details dict, including the "Recommendations" list.
+
+    Raises like extract_book_details_dict and extract_recommendations_list when the page lacks the details,
+    or the recommendation carousel when with_recommendations is set.
+    """
+    backend = backend or parser_backend
+    if backend != "bs4":
+        return PARSERS[backend](book_page_html, with_recommendations)
+
+    soup = BeautifulSoup(book_page_html, "html.parser")
+    recommendations = extract_recommendations_list(soup) if with_recommendations else []
+    book_details_dict = extract_book_details_dict(soup)
+    book_details_dict["Recommendations"] = recommendations
+    return book_details_dict
+
+
+def extract_book_details_dict(book_page_html):
+    """ Scrape the book's details and recommendations from its page (html or an already parsed soup) """
+
+    soup = book_page_html if isinstance(book_page_html, BeautifulSoup) else BeautifulSoup(book_page_html, "html.parser")
 
     # Extract the title
     title = translate_danish_to_english(soup.find("h1", class_="text-xl sm:text-l text-800 mb-0").text.strip())
@@ -171,19 +363,19 @@ def extract_book_details_dict(book_page_html):
 
 
 def extract_recommendations_list(book_page_html):  # TODO extract only andre kobte ogsa, not the author recommendations
-    """Scrape the book's recommendations from its page"""
-    soup = BeautifulSoup(book_page_html, "html.parser")
+    """Scrape the book's recommendations from its page (html or an already parsed soup)"""
+    soup = book_page_html if isinstance(book_page_html, BeautifulSoup) else BeautifulSoup(book_page_html, "html.parser")
     recommendations_isbn = []
 
-    recommendations = soup.find("div", id="product-page-banner-container").find("div",
-                                                                                class_="book-slick-slider slick-initialized slick-slider")
+    # match on the single class, the raw html does not carry the classes slick adds once the carousel runs
+    recommendations = soup.find("div", id="product-page-banner-container").find("div", class_="book-slick-slider")
     cover_container = recommendations.find_all("div", class_=lambda e: e.startswith('new-teaser') if e else False)
     for cover in cover_container:
         isbn = cover.find("a", class_="cover-container").get('data-product-identifier')
         if isbn:
             recommendations_isbn.append(isbn)
         else:
-            logging.error(f"Failed to extract the recommendation from the book page.")
+            logging.error("Failed to extract the recommendation from the book page.")
     return recommendations_isbn
 
 
@@ -1,11 +1,16 @@
+import hashlib
+import json
 import logging
 import time
 import traceback
-from random import randint
 
-from database import Author, Book
-from scraping_common import create_browser_and_wait_for_page_load, extract_book_details_dict, \
+from book_io import get_output_sink
+from bulk_writer import BATCH_SIZE, attach_bulk_writer, get_bulk_writer
+from database import Author, Book, create_session, recommendation_table
+from metrics import DB_WRITE, RECOMMENDATION_EXPANSION, count, timed
+from scraping_common import build_search_url, fetch_book_page_html, parse_book_page, \
     query_saxo_with_title_or_isbn, step_find_book_in_search_results
+from storage import get_storage
 
 ISBN = "ISBN"
 TITLE = "Title"
@@ -20,6 +25,13 @@ TOP10K = "Top10k"
 AUTHORS = "Authors"
 RECOMMENDATIONS = "Recommendations"
 
+# the scraped fields a refresh compares; the content hash covers these and the recommendations
+CONTENT_FIELDS = (TITLE, AUTHORS, PAGE_COUNT, PUBLISHED_DATE, PUBLISHER, FORMAT, NUM_OF_RATINGS, RATING,
+                  DESCRIPTION)
+
+# key of the recommendation crawl frontier in Session.info, see create_crawl_session
+FRONTIER = "frontier"
+
 BOOK_NOT_AVAILABLE = {ISBN: '9788763840958',
                       PAGE_COUNT: 0,
                       PUBLISHED_DATE: 'N/A',
@@ -34,8 +46,44 @@ BOOK_NOT_AVAILABLE = {ISBN: '9788763840958',
                       TOP10K: 0}
 
 
+def create_crawl_session(batch_size=BATCH_SIZE, frontier=None):
+    """Create a session for a crawl, optionally buffering its writes and queueing recommendations on a frontier"""
+    session = create_session()
+    if batch_size:
+        attach_bulk_writer(session, batch_size)
+    if frontier is not None:
+        session.info[FRONTIER] = frontier
+    return session
+
+
+def close_crawl_session(session):
+    """Flush the buffered writes of a crawl session and close it"""
+    writer = get_bulk_writer(session)
+    try:
+        if writer is not None:
+            writer.flush()
+    finally:
+        session.close()
+
+
 def save_book_details_to_database(book_details, session, parent=None):
-    """Save the scraped data into the database."""
+    """Save the scraped data into the database, and to the output file if one is configured.
+    Return False if it could not be saved."""
+    writer = get_bulk_writer(session)
+    if writer is not None:
+        # the writer passes the book on to the output file once its batch is committed
+        return save_book_details_to_bulk_writer(book_details, writer, session, parent)
+
+    saved = save_book_details_to_session(book_details, session, parent)
+    sink = get_output_sink()
+    if saved and sink is not None:
+        sink.write(book_details)
+    return saved
+
+
+@timed(DB_WRITE)
+def save_book_details_to_session(book_details, session, parent=None):
+    """Save the scraped data with the ORM and commit"""
     try:
         book = get_book_by_isbn(session, book_details[ISBN])
         if book is None:
@@ -54,20 +102,55 @@ def save_book_details_to_database(book_details, session, parent=None):
             save_recommended_books(book, book_details[RECOMMENDATIONS], session)
 
         session.commit()
+        return True
 
     except Exception as e:
         session.rollback()
         print(f"An error occurred while saving the book {book_details[TITLE]} details: {e}")
         logging.error(f"In book {book_details[TITLE]} an error occurred while saving the book details: {e}")
         logging.error(traceback.format_exc())
+        return False
+
+
+def save_book_details_to_bulk_writer(book_details, writer, session, parent_isbn=None):
+    """Buffer the scraped data in the session's BulkBookWriter; the parent is given by its ISBN."""
+    try:
+        writer.add_book(book_row(book_details), book_details[AUTHORS], book_details)
+
+        if parent_isbn:
+            writer.add_recommendation(parent_isbn, book_details[ISBN])
+
+        # add the recommendations
+        if book_details[TOP10K]:
+            save_recommended_books(book_details[ISBN], book_details[RECOMMENDATIONS], session)
+        return True
+
+    except Exception as e:
+        print(f"An error occurred while saving the book {book_details[TITLE]} details: {e}")
+        logging.error(f"In book {book_details[TITLE]} an error occurred while saving the book details: {e}")
+        logging.error(traceback.format_exc())
+        return False
 
 
 def get_book_by_isbn(session, isbn):
     return session.query(Book).filter_by(isbn=isbn).first()
 
 
+def is_book_saved(session, isbn):
+    """Check if a book with this ISBN is in the database, or buffered to be written to it"""
+    writer = get_bulk_writer(session)
+    if writer is not None:
+        return writer.has_book(isbn)
+    return get_book_by_isbn(session, isbn) is not None
+
+
 def create_new_book(book_details):
-    return Book(
+    return Book(**book_row(book_details))
+
+
+def book_row(book_details):
+    """Map the scraped dict to the columns of the book table"""
+    return dict(
         isbn=book_details[ISBN],
         title=book_details[TITLE],
         page_count=book_details[PAGE_COUNT],
@@ -77,10 +160,19 @@ def create_new_book(book_details):
         num_of_ratings=int(book_details[NUM_OF_RATINGS]),
         rating=book_details[RATING],
         description=book_details[DESCRIPTION],
-        top10k=book_details[TOP10K]
+        top10k=book_details[TOP10K],
+        last_scraped_at=time.time(),
+        content_hash=book_content_hash(book_details)
     )
 
 
+def book_content_hash(book_details):
+    """Hash of what a book page says about the book, independent of the markup around it"""
+    content = {field: book_details.get(field) for field in CONTENT_FIELDS}
+    content[RECOMMENDATIONS] = sorted(book_details.get(RECOMMENDATIONS) or [])
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
 def add_authors_to_book(book, authors, session):
     for author_name in authors:
         author = session.query(Author).filter_by(name=author_name).first()
@@ -90,54 +182,69 @@ def add_authors_to_book(book, authors, session):
         book.authors.append(author)
 
 
-def save_recommended_books(book, recommended_isbns, session):
+@timed(RECOMMENDATION_EXPANSION)
+def save_recommended_books(book, recommended_isbns, session, depth=0):
+    """Save the recommendations of a book (a Book, or its ISBN when using a BulkBookWriter).
+
+    Without a frontier the recommended books are scraped right away. With one, the recommendation edges are
+    saved and the ISBNs are queued for the frontier's workers.
+    """
+    frontier = session.info.get(FRONTIER)
+    if frontier is not None:
+        parent_isbn = getattr(book, "isbn", book)
+        save_recommendation_edges(parent_isbn, recommended_isbns, session)
+        frontier.push(recommended_isbns, depth + 1, parent_isbn)
+        return
+
     for recommended_isbn in recommended_isbns:
         scrape_and_save_recommended_book(book, recommended_isbn, session)
-        time.sleep(1)
 
 
-def scrape_and_save_recommended_book(parent_book, book_isbn, session):  # todo optimize
+def save_recommendation_edges(parent_isbn, recommended_isbns, session):
+    writer = get_bulk_writer(session)
+    if writer is not None:
+        for recommended_isbn in recommended_isbns:
+            writer.add_recommendation(parent_isbn, recommended_isbn)
+    else:
+        get_storage(session).insert_ignore(session, recommendation_table,
+                                           [{"book_isbn": parent_isbn, "recommended_isbn": recommended_isbn}
+                                            for recommended_isbn in recommended_isbns])
+
+
+def scrape_and_save_recommended_book(parent_book, book_isbn, session):
     """Scrape the details of a recommended book if it does not exist in the database"""
     try:
-        recommended_book = get_book_by_isbn(session, book_isbn)
-        if not recommended_book:
-            book_page_html = get_book_page_html(book_isbn)
-            if book_page_html:
-                book_details_dict = get_book_details_dict(book_page_html)
+        if not is_book_saved(session, book_isbn):
+            book_details_dict = scrape_book_by_isbn(book_isbn)
+            if book_details_dict is None:
+                book_not_found_in_search_results_isbn(book_isbn, session)
+            else:
                 save_book_details_to_database(book_details_dict, session, parent_book)
-            else:  # case when there's many book results for the same isbn
-                search_page = query_saxo_with_title_or_isbn(book_isbn)  # get the search page requrst.text
-                search_page_book_info = step_find_book_in_search_results(search_page)
-                if search_page_book_info == 'N/A':
-                    book_not_found_in_search_results_isbn(book_isbn, session)
-
-                book_page_html = create_browser_and_wait_for_page_load(search_page_book_info["Url"])
-                book_details_dict = get_book_details_dict(book_page_html)
-                save_book_details_to_database(book_details_dict, session, parent_book)
-                logging.info(f"Recovery succeeded for {book_isbn}")
     except Exception as e:
-        logging.error(f"Scraping the recommended book with ISBN {book_isbn}: {e}\n possibly many entries -- retrying.")
+        logging.error(f"Scraping the recommended book with ISBN {book_isbn} failed: {e}")
         logging.error(traceback.format_exc())
-        # try:
-        #     search_page = query_saxo_with_title_or_isbn(book_isbn)  # get the search page requrst.text
-        #     search_page_book_info = step_find_book_in_search_results(search_page)
-        #     book_page_html = create_browser_and_wait_for_page_load(search_page_book_info["Url"])
-        #     book_details_dict = get_book_details_dict(book_page_html)
-        #     save_book_details_to_database(book_details_dict, session, parent_book)
-        #     logging.info(f"Recovery succeeded for {book_isbn}")
-        # except Exception as e:
-        #     logging.error(f"Recovery failed for {book_isbn}: {e}")
-        #     logging.error(traceback.format_exc())
-
-
-def get_book_page_html(book_isbn):
-    search_url = "https://www.saxo.com/dk/products/search?query={}".format(book_isbn)
-    return create_browser_and_wait_for_page_load(search_url)
-
-
-def get_book_details_dict(book_page_html):
-    book_details_dict = extract_book_details_dict(book_page_html)
-    book_details_dict[RECOMMENDATIONS] = []
+
+
+def scrape_book_by_isbn(book_isbn, with_recommendations=False):
+    """Scrape a book by its ISBN. Return its details dict, or None when Saxo has no such book."""
+    book_page_html = get_book_page_html(book_isbn, with_recommendations)
+    if not book_page_html:  # case when there's many book results for the same isbn
+        search_page = query_saxo_with_title_or_isbn(book_isbn)  # get the search page requrst.text
+        search_page_book_info = step_find_book_in_search_results(search_page)
+        if search_page_book_info == 'N/A':
+            return None
+
+        book_page_html = fetch_book_page_html(search_page_book_info["Url"], with_recommendations=with_recommendations)
+        logging.info(f"Recovery succeeded for {book_isbn}")
+    return get_book_details_dict(book_page_html, with_recommendations)
+
+
+def get_book_page_html(book_isbn, with_recommendations=True):
+    return fetch_book_page_html(build_search_url(book_isbn), with_recommendations=with_recommendations)
+
+
+def get_book_details_dict(book_page_html, with_recommendations=False):
+    book_details_dict = parse_book_page(book_page_html, with_recommendations=with_recommendations)
     book_details_dict[TOP10K] = 0
     return book_details_dict
 
@@ -145,15 +252,14 @@ def get_book_details_dict(book_page_html):
 def book_not_found_in_search_results_isbn(isbn, session):
     """Log the error and save the book with a default dict"""
     logging.error(f"No search results found for {isbn}")
+    count("not_found", lookup="isbn")
     new = BOOK_NOT_AVAILABLE.copy()
     new[ISBN] = isbn
-    save_book_details_to_database(new, session)
+    return save_book_details_to_database(new, session)
 
 
 def book_not_found_in_search_results_title(title, author, session):
-    """Log the error and save the book with a default dict"""
+    """Log the error and save the shared placeholder book; the input row is recorded as not found in job_state"""
     logging.error(f"No search results found for {title} by {author}")
-    new = BOOK_NOT_AVAILABLE.copy()
-    new[TITLE] = title
-    new[AUTHORS] = [author]
-    save_book_details_to_database(BOOK_NOT_AVAILABLE, session)
+    count("not_found", lookup="title")
+    return save_book_details_to_database(BOOK_NOT_AVAILABLE, session)
@@ -0,0 +1,211 @@
+import os
+
+from sqlalchemy import column, create_engine, event, select, table as table_clause
+from sqlalchemy.dialects import postgresql, sqlite
+
+# WAL lets reader processes work while the crawler writes; a busy connection waits instead of failing
+SQLITE_BUSY_TIMEOUT = 30
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",  # safe with WAL, only the last transactions can be lost on power failure
+    "cache_size": -64 * 1024,  # in KiB
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+    "busy_timeout": SQLITE_BUSY_TIMEOUT * 1000,
+}
+
+POSTGRES_POOL_SIZE = int(os.environ.get("SAXO_DB_POOL_SIZE", 10))
+POSTGRES_MAX_OVERFLOW = int(os.environ.get("SAXO_DB_MAX_OVERFLOW", 20))
+POSTGRES_POOL_RECYCLE = 1800
+# below this many rows an executemany INSERT is cheaper than staging the rows with COPY
+COPY_MIN_ROWS = 500
+# pg_advisory_xact_lock key that serializes schema migrations across crawler nodes
+MIGRATION_LOCK_KEY = 0x5A30
+
+
+class StorageBackend:
+    """What the crawler needs from a database beyond plain SQLAlchemy: how to connect, and how to insert
+    rows in bulk while skipping or updating the ones that already exist.
+
+    Both dialects support INSERT ... ON CONFLICT, so the default bulk methods use it with executemany.
+    """
+
+    name = None
+    dialect = None
+
+    def create_engine(self, url):
+        return create_engine(url)
+
+    def create_read_only_engine(self, url):
+        """An engine for readers that must not change the database, not even its settings"""
+        return self.create_engine(url)
+
+    def lock_for_migration(self, connection):
+        """Keep other processes from migrating the schema until the connection's transaction ends"""
+
+    def lock_for_claim(self, connection):
+        """Start the transaction in which queued rows are claimed, so no other process claims the same ones.
+
+        Claims select with FOR UPDATE SKIP LOCKED, which is enough where the database supports it.
+        """
+
+    def insert(self, table):
+        return self.dialect.insert(table)
+
+    def insert_ignore(self, connection, table, rows, index_elements=None):
+        """Insert the rows, skipping those that conflict with existing ones"""
+        if rows:
+            connection.execute(self.insert(table).on_conflict_do_nothing(index_elements=index_elements), rows)
+
+    def upsert(self, connection, table, rows, index_elements, update_columns, where=None):
+        """Insert the rows; for existing ones set `update_columns`, if `where(excluded)` holds when given"""
+        if rows:
+            connection.execute(self.upsert_statement(self.insert(table), index_elements, update_columns, where),
+                               rows)
+
+    @staticmethod
+    def upsert_statement(statement, index_elements, update_columns, where=None):
+        return statement.on_conflict_do_update(
+            index_elements=index_elements,
+            set_={name: statement.excluded[name] for name in update_columns},
+            where=where(statement.excluded) if where is not None else None)
+
+
+class SQLiteBackend(StorageBackend):
+    """A local SQLite file in WAL mode with tuned pragmas"""
+
+    name = "sqlite"
+    dialect = sqlite
+
+    def create_engine(self, url):
+        engine = create_engine(url, connect_args={"timeout": SQLITE_BUSY_TIMEOUT, "check_same_thread": False})
+
+        @event.listens_for(engine, "connect")
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in SQLITE_PRAGMAS.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+            cursor.close()
+
+        return engine
+
+    def create_read_only_engine(self, url):
+        # no pragmas: journal_mode=WAL alone would switch the file to WAL for good
+        path = url.split(":///", 1)[1]
+        return create_engine(f"sqlite:///file:{path}?mode=ro&uri=true",
+                             connect_args={"timeout": SQLITE_BUSY_TIMEOUT, "check_same_thread": False})
+
+    def lock_for_migration(self, connection):
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+    def lock_for_claim(self, connection):
+        # SQLite has no row locks: take the write lock before reading what to claim
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+class PostgresBackend(StorageBackend):
+    """A shared PostgreSQL catalog that several crawler nodes write to.
+
+    Connections are pooled and checked before use. Large batches are streamed into a temporary staging
+    table with COPY and moved into the real table with one INSERT ... SELECT ... ON CONFLICT, which is much
+    faster than executemany over the network.
+    """
+
+    name = "postgresql"
+    dialect = postgresql
+
+    def create_engine(self, url):
+        # COPY goes through psycopg2's copy_expert, whatever driver SQLAlchemy would pick by default
+        if url.startswith("postgresql://"):
+            url = "postgresql+psycopg2://" + url[len("postgresql://"):]
+        return create_engine(url, pool_size=POSTGRES_POOL_SIZE, max_overflow=POSTGRES_MAX_OVERFLOW,
+                             pool_pre_ping=True, pool_recycle=POSTGRES_POOL_RECYCLE)
+
+    def lock_for_migration(self, connection):
+        connection.exec_driver_sql(f"SELECT pg_advisory_xact_lock({MIGRATION_LOCK_KEY})")
+
+    def insert_ignore(self, connection, table, rows, index_elements=None):
+        if len(rows) < COPY_MIN_ROWS:
+            return super().insert_ignore(connection, table, rows, index_elements)
+        staging, columns = self.copy_to_staging(connection, table, rows)
+        connection.execute(self.insert(table).from_select(columns, select(staging))
+                           .on_conflict_do_nothing(index_elements=index_elements))
+
+    def upsert(self, connection, table, rows, index_elements, update_columns, where=None):
+        if len(rows) < COPY_MIN_ROWS:
+            return super().upsert(connection, table, rows, index_elements, update_columns, where)
+        staging, columns = self.copy_to_staging(connection, table, rows)
+        statement = self.insert(table).from_select(columns, select(staging))
+        connection.execute(self.upsert_statement(statement, index_elements, update_columns, where))
+
+    def copy_to_staging(self, connection, table, rows):
+        """COPY the rows into a temporary table shaped like `table`; return it and the copied columns.
+
+        Columns the rows leave out get their Python-side defaults, the staging table has none. It lives as
+        long as the pooled connection and is emptied at every commit.
+        """
+        columns = list(rows[0])
+        defaults = {name: table.c[name].default.arg for name in table.c.keys()
+                    if name not in columns and table.c[name].default is not None and table.c[name].default.is_scalar}
+        columns += list(defaults)
+        staging_name = f"staging_{table.name}"
+        cursor = connection.connection.cursor()
+        try:
+            cursor.execute(f"CREATE TEMP TABLE IF NOT EXISTS {staging_name} "
+                           f"(LIKE {table.name}) ON COMMIT DELETE ROWS")
+            cursor.execute(f"TRUNCATE {staging_name}")
+            cursor.copy_expert(f"COPY {staging_name} ({', '.join(columns)}) FROM STDIN",
+                               CopyBuffer(({**defaults, **row} for row in rows), columns))
+        finally:
+            cursor.close()
+        return table_clause(staging_name, *[column(name) for name in columns]), columns
+
+
+class CopyBuffer:
+    """File-like object producing rows in COPY's text format, a few at a time, for cursor.copy_expert"""
+
+    def __init__(self, rows, columns):
+        self._lines = (format_copy_row(row, columns) for row in rows)
+        self._pending = ""
+
+    def read(self, size=-1):
+        while size < 0 or len(self._pending) < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            self._pending += line
+        if size < 0:
+            size = len(self._pending)
+        chunk, self._pending = self._pending[:size], self._pending[size:]
+        return chunk
+
+
+def format_copy_row(row, columns):
+    return "\t".join(format_copy_value(row[name]) for name in columns) + "\n"
+
+
+def format_copy_value(value):
+    if value is None:
+        return r"\N"
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+            .replace("\r", "\\r"))
+
+
+BACKENDS = {
+    "sqlite": SQLiteBackend(),
+    "postgresql": PostgresBackend(),
+}
+
+
+def backend_for_url(url):
+    name = url.split("://", 1)[0].split("+", 1)[0]
+    if name not in BACKENDS:
+        raise ValueError(f"Unsupported database {name}, expected one of {tuple(BACKENDS)}")
+    return BACKENDS[name]
+
+
+def get_storage(bind):
+    """The backend of an engine, connection or session"""
+    if hasattr(bind, "get_bind"):
+        bind = bind.get_bind()
+    return BACKENDS[bind.dialect.name]
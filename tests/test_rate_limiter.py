@@ -0,0 +1,201 @@
+"""The rate limiter and get_with_retries against a local stub server answering with scripted statuses"""
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import rate_limiter
+from rate_limiter import CLOSED, HALF_OPEN, OPEN, SLOWDOWN, SPEEDUP_STEP, AdaptiveRateLimiter, backoff_delay, \
+    get_with_retries
+
+
+class StubServer(ThreadingHTTPServer):
+    """Answers every GET with the next (status, Retry-After) of its script, `latency` seconds after it came in;
+    the last one repeats"""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.script = [(200, None)]
+        self.latency = 0
+        self.requests = []
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/dk/products/search?query=x"
+
+    def next_response(self):
+        with self._lock:
+            self.requests.append(time.monotonic())
+            return self.script.pop(0) if len(self.script) > 1 else self.script[0]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        status, retry_after = self.server.next_response()
+        time.sleep(self.server.latency)
+        self.send_response(status)
+        if retry_after is not None:
+            self.send_header("Retry-After", str(retry_after))
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = StubServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def backoffs(monkeypatch):
+    """Record the attempts get_with_retries backs off after, without sleeping"""
+    attempts = []
+    monkeypatch.setattr(rate_limiter, "backoff_delay", lambda attempt: attempts.append(attempt) or 0)
+    return attempts
+
+
+def test_backoff_delay_grows_exponentially_with_jitter():
+    for attempt in range(8):
+        delays = [backoff_delay(attempt, base=1.0, cap=30.0) for _ in range(200)]
+        assert all(0 <= delay <= min(30.0, 2 ** attempt) for delay in delays)
+    assert max(backoff_delay(6, base=1.0, cap=30.0) for _ in range(200)) > 16
+
+
+def test_throttled_requests_are_retried_after_retry_after(server, backoffs):
+    server.script = [(429, 0.3), (503, None), (200, None)]
+    limiter = AdaptiveRateLimiter(requests_per_second=50, max_rate=100)
+
+    response = get_with_retries(requests.Session(), server.url, 5, limiter=limiter)
+
+    assert response.status_code == 200
+    assert len(server.requests) == 3
+    assert server.requests[1] - server.requests[0] >= 0.3
+    assert backoffs == [0, 1]
+    assert limiter.throttled == 2
+    assert limiter.rate == pytest.approx(50 * SLOWDOWN * SLOWDOWN + SPEEDUP_STEP)
+    assert limiter.consecutive_failures == 0
+
+
+def test_the_last_response_is_returned_without_backing_off_after_it(server, backoffs):
+    server.script = [(503, None)]
+    limiter = AdaptiveRateLimiter(requests_per_second=100, breaker_threshold=100)
+
+    response = get_with_retries(requests.Session(), server.url, 5, max_retries=3, limiter=limiter)
+
+    assert response.status_code == 503
+    assert len(server.requests) == 4
+    assert backoffs == [0, 1, 2]
+
+
+def test_network_errors_are_retried_then_raised(backoffs):
+    server = StubServer()
+    url = server.url
+    server.server_close()
+    limiter = AdaptiveRateLimiter(requests_per_second=100, breaker_threshold=100)
+
+    with pytest.raises(requests.ConnectionError):
+        get_with_retries(requests.Session(), url, 1, max_retries=2, limiter=limiter)
+    assert backoffs == [0, 1]
+    assert limiter.consecutive_failures == 3
+
+
+def test_the_rate_recovers_additively_up_to_the_maximum(server, backoffs, monkeypatch):
+    monkeypatch.setattr(rate_limiter, "SPEEDUP_STEP", 10.0)
+    limiter = AdaptiveRateLimiter(requests_per_second=100, max_rate=100)
+    session = requests.Session()
+    server.script = [(429, None), (200, None)]
+
+    get_with_retries(session, server.url, 5, limiter=limiter)
+    assert limiter.rate == pytest.approx(100 * SLOWDOWN + 10)
+    rates = []
+    for _ in range(5):
+        get_with_retries(session, server.url, 5, limiter=limiter)
+        rates.append(limiter.rate)
+    assert rates == pytest.approx([70, 80, 90, 100, 100])
+
+
+def test_the_circuit_opens_half_opens_and_closes(server, backoffs):
+    limiter = AdaptiveRateLimiter(requests_per_second=100, max_rate=100, breaker_threshold=3,
+                                  breaker_cooldown=0.5)
+    session = requests.Session()
+    server.script = [(503, None)]
+
+    get_with_retries(session, server.url, 5, max_retries=2, limiter=limiter)
+    assert limiter.circuit_opened == 1
+    assert limiter.circuit_state == OPEN
+    granted, delay = limiter.reserve()
+    assert not granted and delay > 0.3
+
+    # the first request after the cooldown is held back until the circuit half-opens, and reopens it
+    opened_at = server.requests[-1]
+    get_with_retries(session, server.url, 5, max_retries=0, limiter=limiter)
+    assert server.requests[-1] - opened_at >= 0.45
+    assert limiter.circuit_opened == 2
+    assert limiter.circuit_state == OPEN
+
+    time.sleep(0.55)
+    assert limiter.circuit_state == HALF_OPEN
+    server.script = [(200, None)]
+    assert get_with_retries(session, server.url, 5, limiter=limiter).status_code == 200
+    assert limiter.circuit_state == CLOSED
+    assert limiter.stats()["circuit"] == CLOSED
+
+
+def test_one_probe_goes_out_while_half_open_and_the_others_wait_for_it(server, backoffs):
+    limiter = AdaptiveRateLimiter(requests_per_second=100, max_rate=100, breaker_threshold=1,
+                                  breaker_cooldown=0.3)
+    limiter.record_failure()
+    assert limiter.circuit_state == OPEN
+    # the first probe fails and reopens the circuit, the second one closes it
+    server.script = [(503, None), (200, None)]
+    server.latency = 0.1
+    session = requests.Session()
+    statuses = []
+    waiters = [threading.Thread(target=lambda: statuses.append(
+        get_with_retries(session, server.url, 5, max_retries=0, limiter=limiter).status_code)) for _ in range(4)]
+    for waiter in waiters:
+        waiter.start()
+    for waiter in waiters:
+        waiter.join()
+
+    first_probe, second_probe, *rest = server.requests
+    assert second_probe - first_probe >= 0.3 + 0.1
+    assert all(sent - second_probe >= 0.1 for sent in rest)
+    assert sorted(statuses) == [200, 200, 200, 503]
+    assert limiter.circuit_opened == 2
+    assert limiter.circuit_state == CLOSED
+
+
+def test_a_probe_that_never_reports_back_is_given_up_on(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "PROBE_TIMEOUT", 0.2)
+    limiter = AdaptiveRateLimiter(requests_per_second=100, breaker_threshold=1, breaker_cooldown=0.1)
+    limiter.record_failure()
+    time.sleep(0.15)
+    assert limiter.reserve()[0]
+    assert limiter.reserve() == (False, rate_limiter.PROBE_POLL_INTERVAL)
+    time.sleep(0.25)
+    assert limiter.reserve()[0]
+
+
+def test_failures_while_open_do_not_extend_the_pause():
+    limiter = AdaptiveRateLimiter(requests_per_second=100, breaker_threshold=2, breaker_cooldown=60)
+    limiter.record_failure()
+    limiter.record_failure()
+    assert limiter.circuit_opened == 1
+    limiter.record_failure()
+    limiter.record_success()
+    assert limiter.circuit_opened == 1
+    assert limiter.circuit_state == OPEN
@@ -0,0 +1,46 @@
+"""Book pages fetched with and without recommendations share one page cache entry per URL."""
+import pytest
+
+import scraping_common
+from page_cache import PAGE, configure_page_cache
+from scraping_common import CAROUSEL_MARKER, SLIDE_MARKER, TITLE_MARKER, fetch_book_page_html
+
+URL = "https://www.saxo.com/dk/a-book_9780000000001"
+PAGE_WITHOUT_CAROUSEL = f'<h1 class="{TITLE_MARKER}">A book</h1>'
+PAGE_WITH_CAROUSEL = (f'{PAGE_WITHOUT_CAROUSEL}<div class="{CAROUSEL_MARKER}">'
+                      f'<a {SLIDE_MARKER}="9780000000002"></a></div>')
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = configure_page_cache(str(tmp_path / "cache"))
+    yield cache
+    configure_page_cache(enabled=False)
+
+
+@pytest.fixture
+def fetches(monkeypatch):
+    """Record the uncached fetches; the raw page has the carousel only when it is asked for"""
+    calls = []
+
+    def fetch_book_page_uncached(url, mode=None, with_recommendations=True):
+        calls.append(with_recommendations)
+        return PAGE_WITH_CAROUSEL if with_recommendations else PAGE_WITHOUT_CAROUSEL
+
+    monkeypatch.setattr(scraping_common, "fetch_book_page_uncached", fetch_book_page_uncached)
+    return calls
+
+
+def test_page_without_carousel_is_not_served_to_a_full_fetch(cache, fetches):
+    assert fetch_book_page_html(URL, with_recommendations=False) == PAGE_WITHOUT_CAROUSEL
+    assert cache.get(PAGE, URL) is None
+
+    assert fetch_book_page_html(URL) == PAGE_WITH_CAROUSEL
+    assert fetches == [False, True]
+
+
+def test_page_with_carousel_is_a_cache_hit_for_both(cache, fetches):
+    assert fetch_book_page_html(URL) == PAGE_WITH_CAROUSEL
+    assert fetch_book_page_html(URL) == PAGE_WITH_CAROUSEL
+    assert fetch_book_page_html(URL, with_recommendations=False) == PAGE_WITH_CAROUSEL
+    assert fetches == [True]
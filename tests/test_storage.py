@@ -0,0 +1,173 @@
+"""Storage backends against SQLite, a PostgreSQL server when SAXO_TEST_DATABASE_URL points at one, and a stub
+connection standing in for psycopg2 to check what is sent through COPY.
+
+    SAXO_TEST_DATABASE_URL=postgresql://postgres@localhost/saxo_test python -m pytest tests
+"""
+import io
+import os
+
+import pytest
+from sqlalchemy import or_, select
+from sqlalchemy.dialects import postgresql
+
+import storage
+from database import Base, Book, JobRow, create_database_engine, recommendation_table
+from storage import CopyBuffer, PostgresBackend, format_copy_row, get_storage
+
+TEST_DATABASE_URL = os.environ.get("SAXO_TEST_DATABASE_URL")
+
+book_table = Book.__table__
+job_table = JobRow.__table__
+
+
+@pytest.fixture(params=["sqlite", "postgresql"])
+def engine(request, tmp_path):
+    if request.param == "sqlite":
+        engine = create_database_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    elif TEST_DATABASE_URL:
+        engine = create_database_engine(TEST_DATABASE_URL)
+    else:
+        pytest.skip("SAXO_TEST_DATABASE_URL is not set")
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    yield engine
+    # pooled connections hold the COPY staging tables
+    engine.dispose()
+    Base.metadata.drop_all(engine)
+    engine.dispose()
+
+
+@pytest.fixture(params=[None, 2], ids=["executemany", "copy"])
+def copy_min_rows(request, monkeypatch):
+    """Run a test with the default batch threshold, and with one low enough for COPY to stage every batch"""
+    if request.param is not None:
+        monkeypatch.setattr(storage, "COPY_MIN_ROWS", request.param)
+
+
+def book(isbn, title="Title", top10k=0):
+    return {"isbn": isbn, "title": title, "top10k": top10k}
+
+
+def test_insert_ignore_skips_existing_rows(engine, copy_min_rows):
+    backend = get_storage(engine)
+    with engine.begin() as connection:
+        backend.insert_ignore(connection, book_table, [book("1", "First"), book("2")])
+    with engine.begin() as connection:
+        backend.insert_ignore(connection, book_table, [book("1", "Changed"), book("3")])
+    with engine.connect() as connection:
+        rows = dict(connection.execute(select(book_table.c.isbn, book_table.c.title)).fetchall())
+    assert rows == {"1": "First", "2": "Title", "3": "Title"}
+
+
+def test_upsert_updates_only_where_the_condition_holds(engine, copy_min_rows):
+    backend = get_storage(engine)
+    with engine.begin() as connection:
+        backend.insert_ignore(connection, book_table, [book("1", top10k=5), book("2", top10k=0)])
+    with engine.begin() as connection:
+        backend.upsert(connection, book_table, [book("1", "New", 0), book("2", "New", 7), book("3", "New", 0)],
+                       ["isbn"], ["top10k"], where=lambda excluded: excluded.top10k > 0)
+    with engine.connect() as connection:
+        rows = {isbn: (title, top10k) for isbn, title, top10k in connection.execute(
+            select(book_table.c.isbn, book_table.c.title, book_table.c.top10k))}
+    assert rows == {"1": ("Title", 5), "2": ("Title", 7), "3": ("New", 0)}
+
+
+def test_upsert_fills_python_side_defaults(engine, copy_min_rows):
+    """Like BulkBookWriter.flush, which leaves out the NOT NULL attempts column of job_state"""
+    backend = get_storage(engine)
+    rows = [{"row": row, "status": "done", "last_error": None} for row in range(1, 4)]
+    with engine.begin() as connection:
+        backend.upsert(connection, job_table, rows, ["row"], ["status", "last_error"],
+                       where=lambda excluded: or_(job_table.c.status == "pending", job_table.c.status == "done"))
+    with engine.connect() as connection:
+        stored = connection.execute(select(job_table.c.row, job_table.c.status, job_table.c.attempts)
+                                    .order_by(job_table.c.row)).fetchall()
+    assert [tuple(row) for row in stored] == [(1, "done", 0), (2, "done", 0), (3, "done", 0)]
+
+
+def test_copied_values_round_trip(engine, copy_min_rows):
+    backend = get_storage(engine)
+    awkward = ["tab\there", "line\nbreak", "back\\slash", "carriage\rreturn", "\\N", "æøå"]
+    with engine.begin() as connection:
+        backend.insert_ignore(connection, book_table, [book("1")])
+        # recommended books need not be saved yet
+        backend.insert_ignore(connection, recommendation_table,
+                              [{"book_isbn": "1", "recommended_isbn": value} for value in awkward])
+    with engine.connect() as connection:
+        stored = set(connection.execute(select(recommendation_table.c.recommended_isbn)).scalars())
+    assert stored == set(awkward)
+
+
+def test_format_copy_row_escapes_the_text_format():
+    row = {"a": None, "b": "x\ty\nz\\w\r", "c": 3, "d": ""}
+    assert format_copy_row(row, ["a", "b", "c", "d"]) == "\\N\tx\\ty\\nz\\\\w\\r\t3\t\n"
+
+
+def test_copy_buffer_reads_in_chunks():
+    rows = [{"a": str(i) * 3} for i in range(50)]
+    buffer = CopyBuffer(rows, ["a"])
+    chunks = []
+    while True:
+        chunk = buffer.read(7)
+        if not chunk:
+            break
+        assert len(chunk) <= 7
+        chunks.append(chunk)
+    assert "".join(chunks) == "".join(f"{i}{i}{i}\n" for i in range(50))
+
+
+class StubCursor:
+    def __init__(self, log):
+        self.log = log
+
+    def execute(self, sql):
+        self.log.append(("execute", sql))
+
+    def copy_expert(self, sql, file):
+        data = io.StringIO()
+        while True:
+            chunk = file.read(8192)
+            if not chunk:
+                break
+            data.write(chunk)
+        self.log.append(("copy", sql, data.getvalue()))
+
+    def close(self):
+        pass
+
+
+class StubConnection:
+    """Stands in for a SQLAlchemy connection on psycopg2: records the raw cursor calls and the statements"""
+
+    def __init__(self):
+        self.log = []
+        self.connection = self
+
+    def cursor(self):
+        return StubCursor(self.log)
+
+    def execute(self, statement, parameters=None):
+        self.log.append(("statement", str(statement.compile(dialect=postgresql.dialect()))))
+
+
+def test_postgres_upsert_stages_large_batches_with_copy(monkeypatch):
+    monkeypatch.setattr(storage, "COPY_MIN_ROWS", 2)
+    connection = StubConnection()
+    rows = [{"row": 1, "status": "done", "last_error": "bad\tvalue"}, {"row": 2, "status": "failed", "last_error": None}]
+    PostgresBackend().upsert(connection, job_table, rows, ["row"], ["status", "last_error"])
+
+    calls = [entry[0] for entry in connection.log]
+    assert calls == ["execute", "execute", "copy", "statement"]
+    assert "(LIKE job_state)" in connection.log[0][1]
+    _, copy_sql, data = connection.log[2]
+    assert copy_sql.startswith("COPY staging_job_state (row, status, last_error, attempts) FROM STDIN")
+    assert data == "1\tdone\tbad\\tvalue\t0\n2\tfailed\t\\N\t0\n"
+    statement = connection.log[3][1]
+    assert "INSERT INTO job_state (row, status, last_error, attempts) SELECT" in statement
+    assert "ON CONFLICT (row) DO UPDATE" in statement
+
+
+def test_postgres_small_batches_skip_copy():
+    connection = StubConnection()
+    PostgresBackend().insert_ignore(connection, book_table, [book("1")])
+    assert [entry[0] for entry in connection.log] == ["statement"]
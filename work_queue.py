@@ -0,0 +1,196 @@
+import logging
+import os
+import socket
+import threading
+import time
+
+from sqlalchemy import and_, func, or_, select
+
+from database import IN_PROGRESS, PENDING, get_engine
+from job_state import FINISHED, job_table
+from storage import get_storage
+
+WORKER_ID = os.environ.get("SAXO_WORKER_ID", f"{socket.gethostname()}-{os.getpid()}")
+# seconds a claimed row stays with its worker without a heartbeat; keep it well above the clock skew
+# between crawler nodes and the time a row takes to scrape
+LEASE_TIMEOUT = float(os.environ.get("SAXO_LEASE_TIMEOUT", 600))
+# leases are extended this many times per timeout
+HEARTBEATS_PER_LEASE = 4
+# input rows leased by a worker at a time
+LEASE_BATCH = 20
+ENQUEUE_CHUNK = 1000
+
+
+class LeaseTable:
+    """Rows of a status table (job_state, crawl_frontier) handed out to one worker at a time.
+
+    A claimed row is in progress, owned by the worker and leased until `lease_timeout` seconds from now.
+    The heartbeat extends the leases of every row the worker still has in progress, so a row only goes to
+    another worker once its lease expired: its owner crashed, was killed or lost the database. Rows in
+    progress without a lease were left behind by runs from before leases existed and can be claimed too.
+    """
+
+    def __init__(self, engine, table, key, order_by, worker_id=WORKER_ID, lease_timeout=LEASE_TIMEOUT):
+        self.engine = engine
+        self.storage = get_storage(engine)
+        self.table = table
+        self.key = table.c[key]
+        self.order_by = order_by
+        self.worker_id = worker_id
+        self.lease_timeout = lease_timeout
+        self._stopping = threading.Event()
+        self._heartbeat_thread = None
+
+    def claimable(self, now):
+        columns = self.table.c
+        return or_(columns.status == PENDING,
+                   and_(columns.status == IN_PROGRESS,
+                        or_(columns.lease_expires_at.is_(None), columns.lease_expires_at < now)))
+
+    def claim(self, limit, columns=(), finished=None, **values):
+        """Lease up to `limit` claimable rows to this worker and return their keys and `columns`.
+
+        `values` are set on the claimed rows along with the lease. `finished(key)` may return the status a row
+        already finished with as far as the worker knows; such rows are set to it in the same transaction
+        and not returned.
+        """
+        now = time.time()
+        with self.engine.begin() as connection:
+            self.storage.lock_for_claim(connection)
+            rows = connection.execute(select(self.key, *columns)
+                                      .where(self.claimable(now))
+                                      .order_by(*self.order_by)
+                                      .limit(limit)
+                                      .with_for_update(skip_locked=True)).fetchall()
+            done = {}
+            if finished is not None:
+                for row in rows:
+                    status = finished(row[0])
+                    if status is not None:
+                        done.setdefault(status, []).append(row[0])
+                for status, keys in done.items():
+                    connection.execute(self.table.update().where(self.key.in_(keys))
+                                       .values(status=status, lease_owner=None, lease_expires_at=None))
+                skipped = {key for keys in done.values() for key in keys}
+                rows = [row for row in rows if row[0] not in skipped]
+            if rows:
+                connection.execute(self.table.update()
+                                   .where(self.key.in_([row[0] for row in rows]))
+                                   .values(status=IN_PROGRESS, lease_owner=self.worker_id,
+                                           lease_expires_at=now + self.lease_timeout, **values))
+        return rows
+
+    def heartbeat(self):
+        """Extend the leases of the rows this worker has in progress; return how many there are"""
+        with self.engine.begin() as connection:
+            return connection.execute(self.table.update()
+                                      .where(self.table.c.lease_owner == self.worker_id)
+                                      .where(self.table.c.status == IN_PROGRESS)
+                                      .values(lease_expires_at=time.time() + self.lease_timeout)).rowcount
+
+    def release(self):
+        """Put the rows this worker still has in progress back in the queue, for a worker stopping early"""
+        with self.engine.begin() as connection:
+            return connection.execute(self.table.update()
+                                      .where(self.table.c.lease_owner == self.worker_id)
+                                      .where(self.table.c.status == IN_PROGRESS)
+                                      .values(status=PENDING, lease_owner=None, lease_expires_at=None)).rowcount
+
+    def claimable_count(self):
+        with self.engine.connect() as connection:
+            return connection.execute(select(func.count()).select_from(self.table)
+                                      .where(self.claimable(time.time()))).scalar()
+
+    def start_heartbeat(self):
+        self._stopping.clear()
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat_loop, name=f"{self.table.name}-heartbeat",
+                                                  daemon=True)
+        self._heartbeat_thread.start()
+
+    def stop_heartbeat(self):
+        if self._heartbeat_thread is not None:
+            self._stopping.set()
+            self._heartbeat_thread.join()
+            self._heartbeat_thread = None
+
+    def _heartbeat_loop(self):
+        while not self._stopping.wait(self.lease_timeout / HEARTBEATS_PER_LEASE):
+            try:
+                self.heartbeat()
+            except Exception as e:
+                logging.error(f"Extending the leases of {self.worker_id} on {self.table.name} failed: {e}")
+
+
+class WorkQueue:
+    """The input list shared by crawler nodes through the job_state table of a common database.
+
+    The coordinator enqueues the rows it would scrape itself. Each worker iterates over the queue instead
+    of the input file: rows are leased `batch_size` at a time and yielded as (row, title, author), so any
+    crawl engine can run on them. Used as a context manager, the worker heartbeats its leases while it
+    crawls and hands back the rows it did not finish when it stops.
+
+    With the worker's `job_state`, rows it would skip as finished are not handed out. They keep the status
+    the worker knows of instead of staying leased and in progress.
+    """
+
+    def __init__(self, engine=None, batch_size=LEASE_BATCH, worker_id=WORKER_ID, lease_timeout=LEASE_TIMEOUT,
+                 job_state=None):
+        self.engine = engine or get_engine()
+        self.job_state = job_state
+        self.storage = get_storage(self.engine)
+        self.batch_size = batch_size
+        self.leases = LeaseTable(self.engine, job_table, "row", [job_table.c.row], worker_id, lease_timeout)
+        self.claimed = 0
+
+    def enqueue(self, book_info, job_state, chunk_size=ENQUEUE_CHUNK):
+        """Queue the input rows `job_state` would scrape and return how many were queued.
+
+        Finished rows being retried are queued again; rows in progress keep their leases.
+        """
+        queued = 0
+        chunk = []
+        for row, title, author in book_info:
+            if not job_state.should_scrape(row):
+                continue
+            chunk.append({"row": row, "title": title, "author": author, "status": PENDING, "attempts": 0})
+            if len(chunk) >= chunk_size:
+                queued += self._enqueue(chunk)
+                chunk = []
+        return queued + self._enqueue(chunk)
+
+    def _enqueue(self, rows):
+        with self.engine.begin() as connection:
+            self.storage.upsert(connection, job_table, rows, ["row"], ["title", "author", "status"],
+                                where=lambda excluded: or_(*(job_table.c.status == status for status in FINISHED)))
+        return len(rows)
+
+    def __iter__(self):
+        while True:
+            rows = self.leases.claim(self.batch_size, [job_table.c.title, job_table.c.author],
+                                     finished=self.finished_status if self.job_state is not None else None)
+            if not rows:
+                return
+            self.claimed += len(rows)
+            for row, title, author in rows:
+                yield row, title, author
+
+    def finished_status(self, row):
+        if not self.job_state.should_scrape(row):
+            return self.job_state.status(row)
+        return None
+
+    def __enter__(self):
+        self.leases.start_heartbeat()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.leases.stop_heartbeat()
+        released = self.leases.release()
+        if released:
+            print(f"Handed {released} unfinished input rows back to the queue")
+
+    def counts(self):
+        with self.engine.connect() as connection:
+            rows = connection.execute(select(job_table.c.status, func.count())
+                                      .group_by(job_table.c.status)).fetchall()
+        return dict(rows)